@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import math
+import re
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from fastapi import status
+from fastapi.responses import JSONResponse
+
+from config import ADMISSION_LIMITS, ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_MS
+from config import LOGIN_CLIENT_RATE, LOGIN_CLIENT_BURST, LOGIN_EMAIL_RATE, LOGIN_EMAIL_BURST
+from metrics import ADMISSION_QUEUE_SECONDS, ADMISSION_REJECTED
+from profiling import add_phase
+
+logger = logging.getLogger("uvicorn.error")
+
+MAX_KEYS = 100000  # buckets kept per limit, the least recently used are dropped (they are full again by then)
+
+
+class RateLimited(Exception):
+    """
+    Raised when a client or an account sends more requests than its rate.
+    """
+
+    def __init__(self, retry_after: float):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+def retry_after(seconds: float) -> str:
+    return str(max(1, math.ceil(seconds)))
+
+
+class TokenBuckets:
+    """
+    One token bucket per key (a client address, an email): ``burst``
+    tokens at most, refilled at ``per_minute``. Every request takes a
+    token; without one it is refused until the next token.
+
+    Used from the event loop only, no lock.
+    """
+
+    def __init__(self, per_minute: float, burst: int, max_keys: int = MAX_KEYS):
+        self.rate = per_minute / 60
+        self.burst = max(1, burst)
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()  # key -> (tokens, at)
+
+    def take(self, key: str) -> float:
+        """
+        Take a token for ``key``: 0 if there was one, else the seconds
+        until there is.
+        """
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        tokens, at = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - at) * self.rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait
+
+
+login_clients = TokenBuckets(LOGIN_CLIENT_RATE, LOGIN_CLIENT_BURST)
+login_emails = TokenBuckets(LOGIN_EMAIL_RATE, LOGIN_EMAIL_BURST)
+
+
+class RouteLimit:
+    """
+    At most ``limit`` requests of a route served at once, the others wait
+    their turn in order. A request is shed (``acquire`` returns False)
+    when ``queue_size`` are already waiting or when it waited
+    ``queue_seconds`` without its turn coming: it would time out anyway,
+    better to refuse it before doing any work.
+
+    Used from the event loop only, no lock.
+    """
+
+    def __init__(self, name: str, limit: int, queue_size: int = ADMISSION_QUEUE_SIZE,
+                 queue_seconds: float = ADMISSION_QUEUE_MS / 1000):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_seconds = queue_seconds
+        self.active = 0
+        self.service = 0.0  # moving average of the time a request takes, seconds
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self) -> bool:
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return True
+        if len(self._waiters) >= self.queue_size:
+            return False
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_seconds)
+            return True  # release() handed its slot over
+        except BaseException as e:  # timed out or cancelled
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # the slot came too late, pass it on
+            else:
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.TimeoutError):
+                return False
+            raise
+
+    def release(self, seconds: Optional[float] = None) -> None:
+        if seconds is not None:
+            self.service = seconds if not self.service else 0.9 * self.service + 0.1 * seconds
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def retry_after(self) -> float:
+        # time for the queue to drain, at the current pace
+        return (self.waiting + 1) * self.service / self.limit
+
+
+def parse_limits(text: str) -> Dict[str, int]:
+    """
+    ``"POST /login=4,GET /tweets=8"`` to ``{"POST /login": 4, ...}``.
+    """
+    limits = {}
+    for item in filter(None, (part.strip() for part in text.split(","))):
+        route, _, limit = item.rpartition("=")
+        method, _, path = route.strip().partition(" ")
+        if not path or not limit.strip().isdigit():
+            raise ValueError("Invalid admission limit: {!r}".format(item))
+        limits["{} {}".format(method.upper(), path.strip())] = int(limit)
+    return limits
+
+
+def _reject(status_code: int, detail: str, seconds: float) -> JSONResponse:
+    return JSONResponse(
+        status_code=status_code,
+        content={"detail": detail},
+        headers={"X-Error": detail, "Retry-After": retry_after(seconds)}
+    )
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware admitting the requests of the routes in ``limits``
+    (``"METHOD /path": concurrency``, see RouteLimit) and rate limiting
+    the clients of the routes in ``client_rates`` by address (429),
+    before the request body is read or any work done. Other routes go
+    straight through: their latency doesn't depend on a storm elsewhere.
+
+    The routes are matched with the patterns of the app's routes, the
+    first time a request comes.
+    """
+
+    def __init__(self, app, limits: Optional[Dict[str, int]] = None,
+                 client_rates: Optional[Dict[str, TokenBuckets]] = None):
+        self.app = app
+        self.limits = {name: RouteLimit(name, limit)
+                       for name, limit in (parse_limits(ADMISSION_LIMITS) if limits is None else limits).items()}
+        self.client_rates = {"POST /login": login_clients} if client_rates is None else client_rates
+        self._routes: Optional[List[Tuple[str, str, re.Pattern, object]]] = None  # (name, method, regex, endpoint)
+
+    def _compile(self, app) -> List[Tuple[str, str, re.Pattern, object]]:
+        wanted = set(self.limits) | set(self.client_rates)
+        routes = []
+        for route in getattr(app, "routes", ()):
+            for method in getattr(route, "methods", None) or ():
+                name = "{} {}".format(method, getattr(route, "path", ""))
+                if name in wanted:
+                    routes.append((name, method, route.path_regex, route.endpoint))
+                    wanted.discard(name)
+        for name in sorted(wanted):
+            logger.warning("Admission control: no route %s", name)
+        return routes
+
+    def _match(self, scope) -> Optional[str]:
+        if self._routes is None:
+            self._routes = self._compile(scope.get("app"))
+        method, path = "GET" if scope["method"] == "HEAD" else scope["method"], scope["path"]
+        for name, route_method, regex, endpoint in self._routes:
+            if route_method == method and regex.match(path):
+                scope["endpoint"] = endpoint  # so a refused request is labelled with its route (metrics)
+                return name
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        name = self._match(scope)
+        if name is None:
+            await self.app(scope, receive, send)
+            return
+
+        buckets = self.client_rates.get(name)
+        if buckets is not None:
+            client = scope.get("client")
+            wait = buckets.take(client[0] if client else "unknown")
+            if wait:
+                ADMISSION_REJECTED.inc((name, "client_rate"))
+                await _reject(status.HTTP_429_TOO_MANY_REQUESTS, "Too many requests", wait)(scope, receive, send)
+                return
+
+        limit = self.limits.get(name)
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+        queued = time.perf_counter()
+        admitted = await limit.acquire()
+        started = time.perf_counter()
+        ADMISSION_QUEUE_SECONDS.observe(started - queued, (name,))
+        add_phase("queue", started - queued)
+        if not admitted:
+            ADMISSION_REJECTED.inc((name, "overloaded"))
+            await _reject(status.HTTP_503_SERVICE_UNAVAILABLE, "Server busy", limit.retry_after())(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limit.release(time.perf_counter() - started)
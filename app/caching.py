@@ -0,0 +1,68 @@
+import hashlib
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import Request, Response, status
+
+
+def make_etag(request: Request, tokens: List[str]) -> str:
+    """
+    The version tokens of the data plus what selects the representation
+    (query string and Accept header).
+    """
+    key = "|".join(tokens + [request.url.query, request.headers.get("accept", "")])
+    return '"{}"'.format(hashlib.blake2b(key.encode("utf-8"), digest_size=12).hexdigest())
+
+
+def conditional_get(request: Request, versions: List[Tuple[str, float]]) -> Tuple[Dict[str, str], Optional[Response]]:
+    """
+    Validators of a GET whose data has the given storage versions.
+
+    Returns the ETag / Last-Modified headers to send and, when the
+    client already has this version (If-None-Match, or If-Modified-Since
+    without If-None-Match), a 304 response to return right away.
+    """
+    etag = make_etag(request, [token for token, _ in versions])
+    modified = max(modified for _, modified in versions)
+    headers = {"ETag": etag, "Last-Modified": formatdate(modified, usegmt=True), "Vary": "Accept"}
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # proxies compressing the body (nginx gzip) make the ETag weak
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        if "*" in tags or etag in [tag[2:] if tag.startswith("W/") else tag for tag in tags]:
+            return headers, Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    elif "if-modified-since" in request.headers:
+        try:
+            since = parsedate_to_datetime(request.headers["if-modified-since"]).timestamp()
+        except (TypeError, ValueError):
+            since = None
+        if since is not None and int(modified) <= since:
+            return headers, Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    return headers, None
+
+
+class BodyCache:
+    """
+    Serialized bodies of the hottest responses (full listings), kept
+    while their ETag doesn't change.
+    """
+
+    def __init__(self):
+        self._bodies: Dict[str, Tuple[str, bytes]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str, etag: str) -> Optional[bytes]:
+        cached = self._bodies.get(key)
+        if cached is not None and cached[0] == etag:
+            return cached[1]
+        return None
+
+    def put(self, key: str, etag: str, body: bytes) -> None:
+        with self._lock:
+            self._bodies[key] = (etag, body)
+
+
+bodies = BodyCache()
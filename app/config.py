@@ -1,9 +1,135 @@
 from dotenv import load_dotenv
-from os import getenv
+from os import cpu_count, getenv
 
 load_dotenv()
 
 APP_NAME = getenv("APP_NAME")
 HOST = getenv("HOST")
 PORT = getenv("PORT")
-DEBUG = getenv("DEBUG")
\ No newline at end of file
+DEBUG = getenv("DEBUG")
+
+# Storage: json (one JSON file per entity), memory, sqlite or segment
+# (read only, files written by `python -m storage segment convert`)
+STORAGE_BACKEND = getenv("STORAGE_BACKEND", "memory")
+DATA_DIR = getenv("DATA_DIR", ".")
+SQLITE_PATH = getenv("SQLITE_PATH", "twitter.db")
+LOG_COMPACT_BYTES = int(getenv("LOG_COMPACT_BYTES") or 8 * 1024 * 1024)
+
+# Warm start (memory backend): the records and indexes of each collection
+# are saved to <name>.warm on shutdown, and every WARM_START_SAVE_SECONDS
+# if set (writes wait while one is saved), with the position in the log
+# they cover. The next start loads them and replays the newer log only.
+WARM_START = (getenv("WARM_START") or "1") == "1"
+WARM_START_SAVE_SECONDS = float(getenv("WARM_START_SAVE_SECONDS") or 0)
+
+# Partitioned tweets: split by a hash of the author into
+# TWEET_PARTITION_BUCKETS buckets ("author"), by the month they were
+# created in ("month") or both ("author,month"); empty for a single
+# collection. Existing tweets are moved with `python -m storage rebalance`.
+TWEET_PARTITIONS = getenv("TWEET_PARTITIONS") or ""
+TWEET_PARTITION_BUCKETS = int(getenv("TWEET_PARTITION_BUCKETS") or 8)
+
+# Hot / cold tiering: every TIER_INTERVAL_SECONDS (0 = off, the default) the
+# process owning the data moves the users and tweets deleted more than
+# TIER_TOMBSTONE_DAYS ago, and the tweets created more than
+# TIER_TWEET_MAX_AGE_DAYS ago (0 = never), to compressed cold segments
+# (<name>.cold). A tweet looked up by id is still found there; once there
+# are COLD_MAX_FILES files they are merged into one.
+TIER_INTERVAL_SECONDS = float(getenv("TIER_INTERVAL_SECONDS") or 0)
+TIER_TOMBSTONE_DAYS = float(getenv("TIER_TOMBSTONE_DAYS") or 30)
+TIER_TWEET_MAX_AGE_DAYS = float(getenv("TIER_TWEET_MAX_AGE_DAYS") or 0)
+TIER_BATCH = int(getenv("TIER_BATCH") or 10000)
+COLD_MAX_FILES = int(getenv("COLD_MAX_FILES") or 8)
+
+# In-memory tweets (memory backend and reader workers): "dict" keeps one
+# dict per tweet, "columnar" packs them in typed arrays (less memory per
+# tweet, dicts built when read)
+TWEET_STORE = getenv("TWEET_STORE") or "dict"
+
+# Active user ids are kept in memory to check tweet authors; changes
+# made by other processes are picked up within ACTIVE_USERS_RECHECK_MS
+ACTIVE_USERS_RECHECK_MS = float(getenv("ACTIVE_USERS_RECHECK_MS") or 1000)
+
+# Home timelines: newest tweets kept per timeline, timelines cached (the
+# last read ones) and followers above which an account's tweets are
+# merged into timelines when read instead of pushed when written
+TIMELINE_SIZE = int(getenv("TIMELINE_SIZE") or 800)
+TIMELINE_USERS = int(getenv("TIMELINE_USERS") or 100000)
+FANOUT_MAX_FOLLOWERS = int(getenv("FANOUT_MAX_FOLLOWERS") or 10000)
+
+# Group commit of the memory backend: max mutations per fsync and max
+# time (ms) a mutation waits for others to join its batch
+WRITE_BATCH_SIZE = int(getenv("WRITE_BATCH_SIZE") or 256)
+WRITE_MAX_LINGER_MS = float(getenv("WRITE_MAX_LINGER_MS") or 2)
+
+# Multi-worker mode (memory backend only, checked on startup): one
+# "writer" process owns the data and publishes snapshots every
+# SNAPSHOT_PUBLISH_MS at most, "reader" workers serve GET requests from
+# them. "single" runs everything in one process.
+WORKER_ROLE = getenv("WORKER_ROLE") or "single"
+SNAPSHOT_PUBLISH_MS = float(getenv("SNAPSHOT_PUBLISH_MS") or 100)
+
+# Production profile (gunicorn.conf.py): worker processes, one per CPU by
+# default (always 1 for the single process and the writer: they keep the
+# trends and timelines in memory). A worker is replaced after SERVER_MAX_REQUESTS
+# requests (plus up to SERVER_MAX_REQUESTS_JITTER so they don't all
+# restart together, 0 = never) and gets SERVER_GRACEFUL_TIMEOUT seconds to
+# finish its requests; one silent for SERVER_TIMEOUT seconds (loading the
+# data included) is killed. Idle connections are kept SERVER_KEEPALIVE
+# seconds, longer than nginx keeps its upstream connections.
+SERVER_WORKERS = int(getenv("SERVER_WORKERS") or 0) or cpu_count() or 1
+SERVER_MAX_REQUESTS = int(getenv("SERVER_MAX_REQUESTS") or 20000)
+SERVER_MAX_REQUESTS_JITTER = int(getenv("SERVER_MAX_REQUESTS_JITTER") or 2000)
+SERVER_GRACEFUL_TIMEOUT = int(getenv("SERVER_GRACEFUL_TIMEOUT") or 30)
+SERVER_TIMEOUT = int(getenv("SERVER_TIMEOUT") or 120)
+SERVER_KEEPALIVE = int(getenv("SERVER_KEEPALIVE") or 75)
+
+# Password hashing pool: processes (one per CPU by default, divided
+# between the workers of the production profile) and max operations
+# queued or running before the auth endpoints answer 503
+PASSWORD_WORKERS = int(getenv("PASSWORD_WORKERS") or cpu_count() or 1)
+PASSWORD_MAX_PENDING = int(getenv("PASSWORD_MAX_PENDING") or 4 * PASSWORD_WORKERS)
+
+# Admission control. ADMISSION_LIMITS caps the requests of a route running
+# at once ("METHOD /path=N,...", paths as declared in main.py); the others
+# wait in a queue of ADMISSION_QUEUE_SIZE at most, ADMISSION_QUEUE_MS at
+# most, then get a 503 with Retry-After. Login attempts are rate limited
+# (429) with token buckets per client address and per email: RATE per
+# minute, bursts of BURST (0 = no limit).
+ADMISSION_LIMITS = getenv("ADMISSION_LIMITS") or "POST /login={0},POST /singup={0},GET /tweets={1}".format(
+    2 * PASSWORD_WORKERS, 2 * (cpu_count() or 1))
+ADMISSION_QUEUE_SIZE = int(getenv("ADMISSION_QUEUE_SIZE") or 64)
+ADMISSION_QUEUE_MS = float(getenv("ADMISSION_QUEUE_MS") or 1000)
+LOGIN_CLIENT_RATE = float(getenv("LOGIN_CLIENT_RATE") or 30)
+LOGIN_CLIENT_BURST = int(getenv("LOGIN_CLIENT_BURST") or 10)
+LOGIN_EMAIL_RATE = float(getenv("LOGIN_EMAIL_RATE") or 10)
+LOGIN_EMAIL_BURST = int(getenv("LOGIN_EMAIL_BURST") or 5)
+
+# Hashing policy: passlib scheme and rounds (library default if empty).
+# With PASSWORD_CALIBRATE=1 and no rounds, the rounds are picked at
+# startup to take about PASSWORD_TARGET_MS per hash.
+PASSWORD_SCHEME = getenv("PASSWORD_SCHEME") or "bcrypt"
+PASSWORD_ROUNDS = int(getenv("PASSWORD_ROUNDS") or 0) or None
+PASSWORD_TARGET_MS = float(getenv("PASSWORD_TARGET_MS") or 250)
+PASSWORD_CALIBRATE = getenv("PASSWORD_CALIBRATE") == "1"
+
+# Fast responses: serialize stored records straight to json (orjson when
+# installed), without building and validating the response models
+FAST_RESPONSES = getenv("FAST_RESPONSES") == "1"
+
+# Profiling: PROFILE=1 samples the stacks of the worker from startup at
+# PROFILE_RATE_HZ (also started / stopped with the /admin/profile
+# endpoints, for PROFILE_MAX_SECONDS at most). Requests slower than
+# SLOW_REQUEST_MS (0 = off) are logged with the time of each phase, the
+# last SLOW_REQUESTS_KEPT are kept for /admin/slow. The /admin endpoints
+# need the X-Admin-Token header, they are off without ADMIN_TOKEN.
+PROFILE = getenv("PROFILE") == "1"
+PROFILE_RATE_HZ = float(getenv("PROFILE_RATE_HZ") or 100)
+PROFILE_MAX_SECONDS = float(getenv("PROFILE_MAX_SECONDS") or 300)
+SLOW_REQUEST_MS = float(getenv("SLOW_REQUEST_MS") or 1000)
+SLOW_REQUESTS_KEPT = int(getenv("SLOW_REQUESTS_KEPT") or 100)
+ADMIN_TOKEN = getenv("ADMIN_TOKEN") or ""
+
+# Metrics (per-route latency, sizes, storage I/O, password hashing) at
+# /metrics in the Prometheus text format, one set per worker process
+METRICS = (getenv("METRICS") or "1") == "1"
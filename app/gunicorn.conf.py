@@ -0,0 +1,46 @@
+"""
+Production profile, from the app directory:
+
+    gunicorn main:app -c gunicorn.conf.py
+
+Uvicorn workers with uvloop and httptools (installed with
+uvicorn[standard], picked by uvicorn's "auto" loop and parser), no
+reload watcher. Workers are recycled one at a time after a number of
+requests and stopped gracefully. See SERVER_* in config.py.
+"""
+import os
+
+from config import HOST, PORT, WORKER_ROLE
+from config import SERVER_WORKERS, SERVER_MAX_REQUESTS, SERVER_MAX_REQUESTS_JITTER
+from config import SERVER_GRACEFUL_TIMEOUT, SERVER_TIMEOUT, SERVER_KEEPALIVE
+
+# one process owns the data (json, memory) and the state kept in memory:
+# trends, home timelines. That's the single process, whatever the backend
+# (sqlite workers would each count their own writes only), or the writer
+# of the multi-worker mode. It isn't recycled either, the reader workers
+# are.
+owner = WORKER_ROLE in ("single", "writer")
+
+bind = "{}:{}".format(HOST or "0.0.0.0", PORT or 80)
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = 1 if owner else SERVER_WORKERS
+max_requests = 0 if owner else SERVER_MAX_REQUESTS
+max_requests_jitter = 0 if owner else SERVER_MAX_REQUESTS_JITTER
+graceful_timeout = SERVER_GRACEFUL_TIMEOUT
+timeout = SERVER_TIMEOUT
+keepalive = SERVER_KEEPALIVE
+
+# behind nginx, the only one reaching the app: trust its X-Forwarded-*
+# headers (uvicorn --proxy-headers); it sets X-Forwarded-For to the client
+# address, uvicorn takes the first address of the header
+forwarded_allow_ips = "*"
+# worker heartbeats in memory, not on the container's disk
+worker_tmp_dir = "/dev/shm"
+
+
+def post_fork(server, worker):
+    # every worker has its own password hashing pool: they share the CPUs
+    # (unless PASSWORD_WORKERS is set)
+    if not os.getenv("PASSWORD_WORKERS"):
+        from passwords import hasher
+        hasher.workers = max(1, (os.cpu_count() or 1) // workers)
@@ -1,33 +1,138 @@
 import json
-from typing import List
+import time
+from typing import Dict, Iterable, Iterator, Optional, Set
 from uuid import UUID
 
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # optional, json is used without it
+    orjson = None
+
+from metrics import SERIALIZE_SECONDS
+from profiling import add_phase
+from storage import users
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
 
 def verifyUser(id: UUID) -> bool:
     """
-    Verify if the user exists.
+    Verify if the user exists and is not deleted (in memory, no read
+    of the users storage).
+    """
+    return users.is_active(str(id))
+
+
+def verifyUsers(ids: Iterable[UUID]) -> Set[str]:
+    """
+    Verify many users at once, return the ids (str) of the active ones.
+    """
+    return users.active(str(id) for id in ids)
+
+
+def isoFormat(value: Optional[str]) -> Optional[str]:
+    """
+    Stored dates use str(datetime), the API returns ISO 8601.
+    """
+    return value.replace(" ", "T", 1) if value is not None else None
+
+
+def publicUser(user: Dict) -> Dict:
+    """
+    Stored user to the json returned by the API (UserOut).
+    """
+    return {
+        "id": user["id"],
+        "email": user["email"],
+        "first_name": user["first_name"],
+        "last_name": user["last_name"],
+        "born_date": user["born_date"],
+        "created_at": isoFormat(user["created_at"]),
+        "updated_at": isoFormat(user["updated_at"]),
+        "deleted_at": isoFormat(user["deleted_at"]),
+    }
+
+
+def publicTweet(tweet: Dict) -> Dict:
+    """
+    Stored tweet to the json returned by the API (Tweet).
+    """
+    return {
+        "id": tweet["id"],
+        "content": tweet["content"],
+        "created_by": tweet["created_by"],
+        "created_at": isoFormat(tweet["created_at"]),
+        "updated_at": isoFormat(tweet["updated_at"]),
+        "deleted_at": isoFormat(tweet["deleted_at"]),
+    }
+
+
+def publicFollow(follow: Dict) -> Dict:
+    """
+    Stored follow to the json returned by the API (Follow).
     """
-    with open("users.json", "r", encoding="utf-8") as f:
-        users = json.loads(f.read())
-        
-        if len(users) > 0:
-            for user in users:
-                if user["id"] == str(id):
-                    return True
-    return False
+    return {
+        "follower_id": follow["follower_id"],
+        "followed_id": follow["followed_id"],
+        "created_at": isoFormat(follow["created_at"]),
+        "deleted_at": isoFormat(follow["deleted_at"]),
+    }
+
+
+def jsonBytes(content) -> bytes:
+    """
+    Encode like FastAPI's JSONResponse does (same bytes), with orjson
+    when it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    Response for content that is already json compatible (publicUser,
+    publicTweet): no validation, no jsonable_encoder.
+    """
+
+    def render(self, content) -> bytes:
+        start = time.perf_counter()
+        body = jsonBytes(content)
+        elapsed = time.perf_counter() - start
+        SERIALIZE_SECONDS.observe(elapsed, ("fast",))
+        add_phase("encode", elapsed)
+        return body
+
+
+class ModelJSONResponse(JSONResponse):
+    """
+    FastAPI's JSONResponse (the default of the app), timed: the encoding
+    of the content that went through the response models.
+    """
+
+    def render(self, content) -> bytes:
+        start = time.perf_counter()
+        body = super().render(content)
+        elapsed = time.perf_counter() - start
+        SERIALIZE_SECONDS.observe(elapsed, ("model",))
+        add_phase("encode", elapsed)
+        return body
 
 
-# verify if users json file exists and if not create it
-def verifyJsonDb(files: List[str]) -> bool:
+def ndjsonStream(records: Iterable[Dict], public) -> Iterator[bytes]:
     """
-    Verify if json file exists and if not create it.
+    Encode records as NDJSON, one chunk of about STREAM_CHUNK_SIZE bytes
+    at a time, so only one chunk is in memory.
     """
-    if len(files) > 0:
-        for f in files:
-            try:
-                with open("{}.json".format(f), "r", encoding="utf-8") as f:
-                    pass
-            except FileNotFoundError:
-                with open("{}.json".format(f), "w", encoding="utf-8") as f:
-                    f.write("[]")
-                    f.close()
+    lines, size = [], 0
+    for record in records:
+        line = jsonBytes(public(record)) + b"\n"
+        lines.append(line)
+        size += len(line)
+        if size >= STREAM_CHUNK_SIZE:
+            yield b"".join(lines)
+            lines, size = [], 0
+    if lines:
+        yield b"".join(lines)
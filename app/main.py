@@ -1,30 +1,233 @@
+import time
+STARTED = time.perf_counter()  # before the imports: loading the storage is part of the startup
+
 from datetime import datetime
+import hmac
+import logging
+import os
 import uvicorn
-import json
-from typing import List
+from typing import Any, Dict, List, Optional
 from uuid import UUID
-import os
 
-from config import APP_NAME
+from config import APP_NAME, FAST_RESPONSES, PASSWORD_CALIBRATE, PASSWORD_ROUNDS, PASSWORD_SCHEME, PASSWORD_TARGET_MS
+from config import ADMIN_TOKEN, DATA_DIR, PROFILE, PROFILE_RATE_HZ, STORAGE_BACKEND, WORKER_ROLE
+from config import TIER_INTERVAL_SECONDS
 
-from fastapi import FastAPI, status, Body, Form, Path, HTTPException
-from passlib.context import CryptContext
+from fastapi import FastAPI, BackgroundTasks, Request, Response, status, Body, Form, Header, Path, Query, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from pydantic import ValidationError
 
 # models
 from models import User, UserIn, UserOut
-from models import Tweet
+from models import Tweet, TweetResult
+from models import Trends
+from models import Follow
 
 # Helpers
-from helpers import verifyUser, verifyJsonDb
+from helpers import verifyUser, verifyUsers, publicUser, publicTweet, publicFollow, ndjsonStream, jsonBytes, FastJSONResponse, ModelJSONResponse
+
+# ETag / conditional GET
+from caching import conditional_get, bodies
+
+# Storage
+from storage import backend, users as user_repository, tweets as tweet_repository, follows as follow_repository
+from storage import check_tweets
+from storage.base import DuplicateId, ReadOnlyError
+from storage.repository import InvalidCursor
+from storage.tiering import TieringJob
+
+# for password hash and verify (in a process pool)
+from passwords import hasher, calibrate, HasherBusy
+
+# Trending hashtags / mentions
+from trends import trends, extract, WINDOWS
+
+# Home timelines (fan-out of the new tweets to the followers)
+from timelines import timelines
+
+# Prometheus metrics
+import metrics
+
+# Stack sampling and slow request tracing
+from profiling import sampler, slow_requests, limit_seconds, trace_model_building, TracingMiddleware
+
+# Admission control (concurrency limits, load shedding, login rate limits)
+from admission import AdmissionMiddleware, RateLimited, login_emails, retry_after
+
+
+
+logger = logging.getLogger("uvicorn.error")
+
+# refuse to start on tweets not laid out as TWEET_PARTITIONS says
+check_tweets(backend, tweet_repository.collection)
+
+app = FastAPI(title=APP_NAME, default_response_class=ModelJSONResponse)
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
+trace_model_building()
+
+DEFAULT_PAGE_SIZE = 100  # when a cursor is sent without limit
+BATCH_MAX = 1000  # tweets of a batch, ids of a lookup
+NDJSON = "application/x-ndjson"
+
+
+@app.on_event("startup")
+def log_startup_time():
+    # the storage is loaded when main is imported, missing files are created by the first write
+    logger.info("Started in %.0fms (%s storage, %s worker)",
+                (time.perf_counter() - STARTED) * 1000, STORAGE_BACKEND, WORKER_ROLE)
+
+
+@app.on_event("startup")
+def calibrate_password_hasher():
+    if PASSWORD_CALIBRATE and not PASSWORD_ROUNDS:
+        rounds = calibrate(PASSWORD_SCHEME, PASSWORD_TARGET_MS)
+        hasher.configure(PASSWORD_SCHEME, rounds)
+        logger.info("Password hashing: %s with %s rounds (~%sms)", PASSWORD_SCHEME, rounds, PASSWORD_TARGET_MS)
 
-# for password hash and verify
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+@app.on_event("startup")
+def start_profile():
+    if PROFILE:
+        sampler.start(PROFILE_RATE_HZ, 0)
+        logger.info("Profiling: sampling stacks at %sHz", PROFILE_RATE_HZ)
 
 
-app = FastAPI(title=APP_NAME)
+# moves old tweets and tombstones to the cold tier, in the processes that can write
+tiering = TieringJob(user_repository, tweet_repository, TIER_INTERVAL_SECONDS)
+
+
+@app.on_event("startup")
+def start_tiering():
+    if TIER_INTERVAL_SECONDS > 0 and WORKER_ROLE != "reader" and STORAGE_BACKEND != "segment":
+        tiering.start()
+
+
+@app.on_event("shutdown")
+def stop_tiering():
+    tiering.stop()
+
+
+@app.on_event("shutdown")
+def save_profile():
+    # a profile started with PROFILE=1 runs until the worker stops
+    if PROFILE:
+        sampler.stop()
+        path = os.path.join(DATA_DIR, "profile-{}.folded".format(os.getpid()))
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(sampler.collapsed())
+        logger.info("Profiling: %s samples written to %s", sampler.samples, path)
+
+
+@app.on_event("shutdown")
+def shutdown_password_hasher():
+    hasher.shutdown()
+
+
+@app.on_event("shutdown")
+def save_search_index():
+    # so the next start only indexes the tweets changed meanwhile
+    tweet_repository.search_index.save()
+
+
+@app.on_event("shutdown")
+def close_storage():
+    # commits the queued writes; the memory backend saves its warm start files
+    start = time.perf_counter()
+    backend.close()
+    logger.info("Storage closed in %.0fms", (time.perf_counter() - start) * 1000)
+
+
+# Too many logins / singups waiting for bcrypt
+@app.exception_handler(HasherBusy)
+def password_hasher_busy(request: Request, exc: HasherBusy):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Too many authentication requests"},
+        headers={"X-Error": "Too many authentication requests", "Retry-After": "1"}
+    )
+
+
+# Too many login attempts for an email
+@app.exception_handler(RateLimited)
+def rate_limited(request: Request, exc: RateLimited):
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        content={"detail": "Too many requests"},
+        headers={"X-Error": "Too many requests", "Retry-After": retry_after(exc.retry_after)}
+    )
+
+
+# Writes sent to a reader worker (multi-worker mode)
+@app.exception_handler(ReadOnlyError)
+def read_only_storage(request: Request, exc: ReadOnlyError):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Read only worker"},
+        headers={"X-Error": "Read only worker"}
+    )
 
-verifyJsonDb(["users", "tweets"] ) # create JSON files if not exists
+
+def wants_stream(request: Request, stream: bool) -> bool:
+    return stream or NDJSON in request.headers.get("accept", "")
+
+
+def tweet_record(tweet: Tweet) -> Dict:
+    # Tweet model to the stored record
+    tweet_dict = tweet.dict()
+    tweet_dict["id"] = str(tweet_dict["id"])
+    tweet_dict["created_at"] = str(tweet_dict["created_at"])
+    tweet_dict["created_by"] = str(tweet_dict["created_by"])
+    return tweet_dict
+
+
+def too_many(what: str) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail="Too many {} (max {})".format(what, BATCH_MAX),
+        headers={"X-Error": "Too many {}".format(what)}
+    )
+
+
+def lookup_tweets(ids: List[str]) -> List[Dict]:
+    # the tweets with the given ids in one storage pass, in the order
+    # asked, unknown ids are left out
+    if len(ids) > BATCH_MAX:
+        raise too_many("ids")
+    found = tweet_repository.get_many(ids)
+    return [found[id] for id in dict.fromkeys(ids) if id in found]
+
+
+def verify_admin(token: Optional[str]) -> None:
+    # the /admin endpoints are off without ADMIN_TOKEN; compared in
+    # constant time, the time taken doesn't tell how much of it matched
+    if not ADMIN_TOKEN or token is None or not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Forbidden",
+            headers={"X-Error": "Forbidden"}
+        )
+
+
+@app.exception_handler(DuplicateId)
+def duplicate_id(request: Request, exc: DuplicateId):
+    # a user or tweet sent with the id of an existing one
+    return JSONResponse(
+        status_code=status.HTTP_409_CONFLICT,
+        content={"detail": "Already exists"},
+        headers={"X-Error": "Already exists"}
+    )
+
+
+@app.exception_handler(InvalidCursor)
+def invalid_cursor(request: Request, exc: InvalidCursor):
+    return JSONResponse(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        content={"detail": "Invalid cursor"},
+        headers={"X-Error": "Invalid cursor"}
+    )
 
 
 # Path Operations
@@ -39,7 +242,7 @@ verifyJsonDb(["users", "tweets"] ) # create JSON files if not exists
     summary="Register a User",
     tags=["Users"],
 )
-def singup(user: UserIn = Body(...)):
+async def singup(user: UserIn = Body(...)):
     """
     **SINGUP**  
     This path operation register a User in the app.
@@ -49,7 +252,7 @@ def singup(user: UserIn = Body(...)):
         - **user:** UserIn  
         
     **Return:**  
-    A json with the basic user information.  
+    A json with the basic user information, 409 if the id is already used.  
         - **id:** uuid  
         - **email:** Emailstr  
         - **first_name:** str  
@@ -58,20 +261,14 @@ def singup(user: UserIn = Body(...)):
         - **created_at:** datetime  
         - **updated_at:** datetime
     """
-    with open("users.json", "r+", encoding="utf-8") as f:
-        results = json.loads(f.read())  # lista de diccionarios
-
-        user_dict = user.dict()  # crea un nuevo diccionario
-        user_dict["id"] = str(user_dict["id"])  # cambia el id a str 
-        user_dict["password"] = pwd_context.hash(user_dict['password'])
-        user_dict["born_date"] = str(user_dict["born_date"])
-        user_dict["created_at"] = str(user_dict["created_at"]) 
-        results.append(user_dict)
+    user_dict = user.dict()  # crea un nuevo diccionario
+    user_dict["id"] = str(user_dict["id"])  # cambia el id a str 
+    user_dict["password"] = await hasher.hash(user_dict['password'])
+    user_dict["born_date"] = str(user_dict["born_date"])
+    user_dict["created_at"] = str(user_dict["created_at"]) 
+    await run_in_threadpool(user_repository.create, user_dict)
 
-        f.seek(0)  # posiciona el cursor al inicio del archivo
-        f.write(json.dumps(results))  # escribe el json en la posicion del cursor
-
-        return user
+    return user
 
 
 ### Login a User
@@ -82,7 +279,8 @@ def singup(user: UserIn = Body(...)):
     summary="Login a User",
     tags=["Users"],
 )
-def login(
+async def login(
+    background_tasks: BackgroundTasks,
     email: str = Form(
         ...,
         title="Email",
@@ -115,20 +313,26 @@ def login(
     If autentication is INCORRECT return a message.  
         - **message:** str
     """
-    with open("users.json", "r", encoding="utf-8") as f:
-        results = json.loads(f.read())  # lista de diccionarios
-        
-        if len(results) > 0:
-            for user in results:
-                if user["deleted_at"] is None and user["email"] == email:
-                    if pwd_context.verify(password, user["password"]):
-                        return User(id=user["id"], email=user['email'], first_name=user["first_name"], last_name=user["last_name"], born_date=user["born_date"], created_at=user["created_at"], updated_at=user["updated_at"], deleted_at=user["deleted_at"])
+    # before any lookup or hashing (the client is limited by AdmissionMiddleware)
+    wait = login_emails.take(email.strip().casefold())
+    if wait:
+        metrics.ADMISSION_REJECTED.inc(("POST /login", "email_rate"))
+        raise RateLimited(wait)
 
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Email and Password are incorrects",
-            headers={ "X-Error": "Email and Password are incorrects." }
-        )
+    user = await run_in_threadpool(user_repository.get_by_email, email)
+
+    if user is not None:
+        valid, new_hash = await hasher.verify_and_update(password, user["password"])
+        if valid:
+            if new_hash is not None:  # stored with an older hashing policy
+                background_tasks.add_task(user_repository.update, user["id"], {"password": new_hash})
+            return User(id=user["id"], email=user['email'], first_name=user["first_name"], last_name=user["last_name"], born_date=user["born_date"], created_at=user["created_at"], updated_at=user["updated_at"], deleted_at=user["deleted_at"])
+
+    raise HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Email and Password are incorrects",
+        headers={ "X-Error": "Email and Password are incorrects." }
+    )
 
 
 
@@ -140,16 +344,28 @@ def login(
     summary="Show all Users",
     tags=["Users"],
 )
-def show_all_users():
+def show_all_users(
+    request: Request,
+    response: Response,
+    stream: bool = Query(False, description="Stream the users as NDJSON"),
+    limit: Optional[int] = Query(None, ge=1, le=1000, description="Page size"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous page"),
+    ):
     """
     **SHOW USERS**  
     This path operation show all users in the app.  
     
     **Parameters:**  
-        - 
+        - Query parameters (optional)  
+        - **stream:** bool  
+        - **limit:** int  
+        - **cursor:** str  
         
     **Return:**  
-    A json list with all Users.  
+    A json list with all Users, or a page of them when limit or cursor
+    are sent. The cursor of the next page is in the X-Next-Cursor header.  
+    With stream=true or "Accept: application/x-ndjson" all the Users are
+    streamed, one json per line.  
         - **id:** uuid  
         - **email:** Emailstr  
         - **first_name:** str  
@@ -159,16 +375,28 @@ def show_all_users():
         - **updated_at:** datetime  
 
     """
-    with open("users.json", "r", encoding="utf-8") as f:
-        results = json.loads(f.read())  # lista de diccionarios
-        users = [] # Only User where deleted_at is None
-
-        if len(results) > 0:
-            for user in results:
-                if user["deleted_at"] is None:
-                    users.append(user)
-
-        return users
+    headers, not_modified = conditional_get(request, [user_repository.collection.version()])
+    if not_modified is not None:
+        return not_modified
+
+    if wants_stream(request, stream):
+        return StreamingResponse(ndjsonStream(user_repository.iter_active(), publicUser), media_type=NDJSON, headers=headers)
+
+    if limit is None and cursor is None:
+        body = bodies.get("users", headers["ETag"])
+        if body is None:
+            # Only User where deleted_at is None
+            body = jsonBytes([publicUser(u) for u in user_repository.iter_active()])
+            bodies.put("users", headers["ETag"], body)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    users, next_cursor = user_repository.page(limit or DEFAULT_PAGE_SIZE, cursor)
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = next_cursor
+    if FAST_RESPONSES:
+        return FastJSONResponse([publicUser(u) for u in users], headers=headers)
+    response.headers.update(headers)
+    return users
 
 
 ### Show a User
@@ -179,7 +407,11 @@ def show_all_users():
     summary="Show a User",
     tags=["Users"],
 )
-def show_a_user(user_id: UUID = Path(...)):
+def show_a_user(
+    request: Request,
+    response: Response,
+    user_id: UUID = Path(...),
+    ):
     """
     **SHOW A USER**  
     This path operation show a active user in the app.  
@@ -198,14 +430,18 @@ def show_a_user(user_id: UUID = Path(...)):
         - **created_at:** datetime  
         - **updated_at:** datetime  
     """
-    with open("users.json", "r", encoding="utf-8") as f:
-        users = json.loads(f.read())  # lista de diccionarios
-        
-        if len(users) > 0:
-            for u in users:
-                if u["id"] == str(user_id) and u["deleted_at"] is None:
-                    return UserOut(id=u["id"], email=u['email'], first_name=u["first_name"], last_name=u["last_name"], born_date=u["born_date"], created_at=u["created_at"], updated_at=u["updated_at"], deleted_at=u["deleted_at"])
-    
+    headers, not_modified = conditional_get(request, [user_repository.collection.version(str(user_id))])
+    if not_modified is not None:
+        return not_modified
+
+    u = user_repository.get(str(user_id))
+
+    if u is not None:
+        if FAST_RESPONSES:
+            return FastJSONResponse(publicUser(u), headers=headers)
+        response.headers.update(headers)
+        return UserOut(id=u["id"], email=u['email'], first_name=u["first_name"], last_name=u["last_name"], born_date=u["born_date"], created_at=u["created_at"], updated_at=u["updated_at"], deleted_at=u["deleted_at"])
+
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND,
         detail="User not found",
@@ -244,39 +480,34 @@ def update_a_user(
         - **created_at:** datetime  
         - **updated_at:** datetime  
     """
-    with open("users.json", "r+", encoding="utf-8") as f:
-        users = json.loads(f.read())  # lista de diccionarios
-        
-        if len(users) > 0:
-            for i,u in enumerate(users):
-                if u["id"] == str(user_id) and u["deleted_at"] is None:
-                    user_dict = user.dict()
-                    users[i]["email"] = user_dict["email"]
-                    users[i]["first_name"] = user_dict["first_name"]
-                    users[i]["last_name"] = user_dict["last_name"]
-                    users[i]["born_date"] = str(user_dict["born_date"])
-                    users[i]["created_at"] = str(user_dict["created_at"])
-                    users[i]["updated_at"] = str(datetime.now())
-                    
-                    f.seek(0)  # posiciona el cursor al inicio del archivo
-                    f.write(json.dumps(users))  # escribe el json en la posicion del cursor
-                    f.close()
-
-                    return UserOut(id=users[i]["id"], 
-                                    email=users[i]['email'], 
-                                    first_name=users[i]["first_name"], 
-                                    last_name=users[i]["last_name"], 
-                                    born_date=users[i]["born_date"], 
-                                    created_at=users[i]["created_at"], 
-                                    updated_at=users[i]["updated_at"], 
-                                    deleted_at=users[i]["deleted_at"]
-                                )
+    user_dict = user.dict()
+    u = user_repository.update(str(user_id), {
+        "email": user_dict["email"],
+        "first_name": user_dict["first_name"],
+        "last_name": user_dict["last_name"],
+        "born_date": str(user_dict["born_date"]),
+        "created_at": str(user_dict["created_at"]),
+        "updated_at": str(datetime.now()),
+    })
+
+    if u is not None:
+        if FAST_RESPONSES:
+            return FastJSONResponse(publicUser(u))
+        return UserOut(id=u["id"], 
+                        email=u['email'], 
+                        first_name=u["first_name"], 
+                        last_name=u["last_name"], 
+                        born_date=u["born_date"], 
+                        created_at=u["created_at"], 
+                        updated_at=u["updated_at"], 
+                        deleted_at=u["deleted_at"]
+                    )
 
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found",
-            headers={"X-Error": "User not found"}
-        )
+    raise HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail="User not found",
+        headers={"X-Error": "User not found"}
+    )
 
 
 
@@ -307,27 +538,20 @@ def delete_a_user(user_id: UUID = Path(...)):
         - **created_at:** datetime  
         - **updated_at:** datetime  
     """
-    with open("users.json", "r+", encoding="utf-8") as f:
-        users = json.loads(f.read())  # lista de diccionarios
-        
-        if len(users) > 0:
-            for i,u in enumerate(users):
-                if u["id"] == str(user_id) and u["deleted_at"] is None:
-                    users[i]["deleted_at"] = str(datetime.now())
-                    f.seek(0)  # posiciona el cursor al inicio del archivo
-                    f.write(json.dumps(users))  # escribe el json en la posicion del cursor
-                    f.close()
-
-                    return UserOut(id=users[i]["id"], 
-                                    email=users[i]['email'], 
-                                    first_name=users[i]["first_name"], 
-                                    last_name=users[i]["last_name"], 
-                                    born_date=users[i]["born_date"], 
-                                    created_at=users[i]["created_at"], 
-                                    updated_at=users[i]["updated_at"], 
-                                    deleted_at=users[i]["deleted_at"]
-                                )
-
+    u = user_repository.delete(str(user_id), str(datetime.now()))
+
+    if u is not None:
+        if FAST_RESPONSES:
+            return FastJSONResponse(publicUser(u))
+        return UserOut(id=u["id"], 
+                        email=u['email'], 
+                        first_name=u["first_name"], 
+                        last_name=u["last_name"], 
+                        born_date=u["born_date"], 
+                        created_at=u["created_at"], 
+                        updated_at=u["updated_at"], 
+                        deleted_at=u["deleted_at"]
+                    )
 
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND,
@@ -359,7 +583,7 @@ def create_a_tweet(tweet: Tweet = Body(...)):
         - **created_by:** uuid
 
     **Return:**  
-    A json with the basic tweet information.  
+    A json with the basic tweet information, 409 if the id is already used.  
         - **id:** uuid  
         - **content:** str  
         - **created_by:** uuid  
@@ -369,19 +593,13 @@ def create_a_tweet(tweet: Tweet = Body(...)):
     """
 
     if verifyUser(tweet.created_by):
-        with open("tweets.json", "r+", encoding="utf-8") as f:
-            results = json.loads(f.read())  # lista de diccionarios
+        tweet_dict = tweet_record(tweet)
+        tweet_repository.create(tweet_dict)
+        trends.record(tweet_dict["content"])
 
-            tweet_dict = tweet.dict()
-            tweet_dict["id"] = str(tweet_dict["id"])
-            tweet_dict["created_at"] = str(tweet_dict["created_at"])
-            tweet_dict["created_by"] = str(tweet_dict["created_by"])
-            results.append(tweet_dict)
-
-            f.seek(0)
-            f.write(json.dumps(results))
-
-            return tweet
+        if FAST_RESPONSES:
+            return FastJSONResponse(publicTweet(tweet_dict), status_code=status.HTTP_201_CREATED)
+        return tweet
     
     raise HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -391,6 +609,124 @@ def create_a_tweet(tweet: Tweet = Body(...)):
 
 
 
+### Register many Tweets
+@app.post(
+    path="/tweets/batch",
+    response_model=List[TweetResult],
+    status_code=status.HTTP_207_MULTI_STATUS,
+    summary="Register many Tweets",
+    tags=["Tweets"],
+)
+def create_many_tweets(
+    items: List[Dict[str, Any]] = Body(..., example=[
+        {"content": "This is my first tweet", "created_by": "5e9f8f8f-e9b1-4b7b-b8b1-f9f9f9f9f9f9"},
+        {"content": "This is my second tweet", "created_by": "5e9f8f8f-e9b1-4b7b-b8b1-f9f9f9f9f9f9"},
+    ]),
+    ):
+    """
+    **CREATE MANY TWEETS**  
+    This path operation create many Tweets in the app, in one write.  
+    
+    **Parameters:**  
+        - Request body parameter  
+        - **items:** list of Tweet (1000 at most)  
+    
+    **Return:**  
+    A json list with one result per item, in the same order. Every item
+    is validated and checked on its own: a failed item doesn't stop the
+    others.  
+        - **index:** int  
+        - **status:** int (201, 401 unknown or deleted author, 409 id already used, 422 invalid)  
+        - **tweet:** Tweet (when created)  
+        - **error:** str (when not created)
+    """
+    if len(items) > BATCH_MAX:
+        raise too_many("tweets")
+
+    results: List[Optional[Dict]] = [None] * len(items)
+    valid = []
+    for index, item in enumerate(items):
+        try:
+            valid.append((index, Tweet(**item)))
+        except ValidationError as e:
+            error = e.errors()[0]
+            results[index] = {"index": index, "status": status.HTTP_422_UNPROCESSABLE_ENTITY,
+                              "error": "{}: {}".format(".".join(str(l) for l in error["loc"]), error["msg"])}
+
+    # every author and every id checked in one storage pass each (the ids
+    # not found also in the cold tier)
+    authors = verifyUsers(tweet.created_by for _, tweet in valid)
+    used = tweet_repository.used(str(tweet.id) for _, tweet in valid)
+    created = []
+    for index, tweet in valid:
+        tweet_dict = tweet_record(tweet)
+        if tweet_dict["created_by"] not in authors:
+            results[index] = {"index": index, "status": status.HTTP_401_UNAUTHORIZED, "error": "Unauthorized"}
+        elif tweet_dict["id"] in used:
+            results[index] = {"index": index, "status": status.HTTP_409_CONFLICT, "error": "Tweet already exists"}
+        else:
+            used.add(tweet_dict["id"])
+            created.append((index, tweet_dict))
+
+    while created:
+        try:
+            tweet_repository.create_many([tweet_dict for _, tweet_dict in created])
+            break
+        except DuplicateId:
+            # an id taken by a concurrent insert since the check: that
+            # item is a conflict, the others are written again
+            taken = tweet_repository.used(tweet_dict["id"] for _, tweet_dict in created)
+            if not taken:
+                raise
+            for index, tweet_dict in created:
+                if tweet_dict["id"] in taken:
+                    results[index] = {"index": index, "status": status.HTTP_409_CONFLICT, "error": "Tweet already exists"}
+            created = [(index, tweet_dict) for index, tweet_dict in created if tweet_dict["id"] not in taken]
+    for index, tweet_dict in created:
+        trends.record(tweet_dict["content"])
+        results[index] = {"index": index, "status": status.HTTP_201_CREATED, "tweet": publicTweet(tweet_dict)}
+
+    if FAST_RESPONSES:
+        return FastJSONResponse(results, status_code=status.HTTP_207_MULTI_STATUS)
+    return results
+
+
+
+### Show many Tweets
+@app.post(
+    path="/tweets/lookup",
+    response_model=List[Tweet],
+    status_code=status.HTTP_200_OK,
+    summary="Show many Tweets",
+    tags=["Tweets"],
+)
+def lookup_many_tweets(ids: List[UUID] = Body(..., embed=True)):
+    """
+    **SHOW MANY TWEETS**  
+    This path operation show the Tweets with the given ids, for lists
+    too long for GET /tweets?ids=...  
+    
+    **Parameters:**  
+        - Request body parameter  
+        - **ids:** list of uuid (1000 at most)  
+    
+    **Return:**  
+    A json list with the Tweets found, in the order of the ids. Unknown
+    ids are left out.  
+        - **id:** uuid  
+        - **content:** str  
+        - **created_by:** uuid  
+        - **created_at:** datetime  
+        - **updated_at:** datetime  
+        - **deleted_at:** datetime
+    """
+    tweets = lookup_tweets([str(id) for id in ids])
+    if FAST_RESPONSES:
+        return FastJSONResponse([publicTweet(t) for t in tweets])
+    return tweets
+
+
+
 ### Show all Tweets
 @app.get(
     path="/tweets",
@@ -399,16 +735,32 @@ def create_a_tweet(tweet: Tweet = Body(...)):
     summary="Show all Tweets",
     tags=["Tweets"],
 )
-def show_all_tweets() -> List[Tweet]:
+def show_all_tweets(
+    request: Request,
+    response: Response,
+    stream: bool = Query(False, description="Stream the tweets as NDJSON"),
+    limit: Optional[int] = Query(None, ge=1, le=1000, description="Page size"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous page"),
+    ids: Optional[str] = Query(None, description="Comma separated ids of the Tweets to show"),
+    ) -> List[Tweet]:
     """
     **SHOW ALL TWEETS**  
     This path operation show all Tweets in the app.  
     
     **Parameters:**  
-        - 
+        - Query parameters (optional)  
+        - **stream:** bool  
+        - **limit:** int  
+        - **cursor:** str  
+        - **ids:** str  
         
     **Return:**  
-    A json list with all Tweets.  
+    A json list with all Tweets, or a page of them when limit or cursor
+    are sent. The cursor of the next page is in the X-Next-Cursor header.  
+    With ids, only the Tweets with those ids (1000 at most), in the same
+    order, unknown ids are left out.  
+    With stream=true or "Accept: application/x-ndjson" all the Tweets are
+    streamed, one json per line.  
         - **id:** uuid  
         - **content:** str  
         - **created_by:** uuid  
@@ -416,16 +768,141 @@ def show_all_tweets() -> List[Tweet]:
         - **updated_at:** datetime  
         - **deleted_at:** datetime
     """
-    with open("tweets.json", "r", encoding="utf-8") as f:
-        results = json.loads(f.read())  # lista de diccionarios
-        tweets = []
+    headers, not_modified = conditional_get(request, [tweet_repository.collection.version()])
+    if not_modified is not None:
+        return not_modified
+
+    if ids is not None:
+        try:
+            tweets = lookup_tweets([str(UUID(id.strip())) for id in ids.split(",") if id.strip()])
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="Invalid tweet id",
+                headers={"X-Error": "Invalid tweet id"}
+            )
+        if FAST_RESPONSES:
+            return FastJSONResponse([publicTweet(t) for t in tweets], headers=headers)
+        response.headers.update(headers)
+        return tweets
 
-        if len(results) > 0:
-            for t in results:
-                if t["deleted_at"] is None:
-                    tweets.append(t)
+    if wants_stream(request, stream):
+        return StreamingResponse(ndjsonStream(tweet_repository.iter_active(), publicTweet), media_type=NDJSON, headers=headers)
 
-        return tweets
+    if limit is None and cursor is None:
+        body = bodies.get("tweets", headers["ETag"])
+        if body is None:
+            body = jsonBytes([publicTweet(t) for t in tweet_repository.iter_active()])
+            bodies.put("tweets", headers["ETag"], body)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    tweets, next_cursor = tweet_repository.page(limit or DEFAULT_PAGE_SIZE, cursor)
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = next_cursor
+    if FAST_RESPONSES:
+        return FastJSONResponse([publicTweet(t) for t in tweets], headers=headers)
+    response.headers.update(headers)
+    return tweets
+
+
+
+### Search Tweets
+@app.get(
+    path="/tweets/search",
+    response_model=List[Tweet],
+    status_code=status.HTTP_200_OK,
+    summary="Search Tweets",
+    tags=["Tweets"],
+)
+def search_tweets(
+    q: str = Query(..., min_length=1, max_length=280, description="Words to search"),
+    order: str = Query("relevance", regex="^(relevance|recent)$", description="relevance or recent"),
+    limit: int = Query(20, ge=1, le=100, description="Max number of Tweets"),
+    ) -> List[Tweet]:
+    """
+    **SEARCH TWEETS**  
+    This path operation search the active Tweets containing every word
+    of q (case insensitive).  
+    
+    **Parameters:**  
+        - Query parameters  
+        - **q:** str  
+        - **order:** str (relevance, the default, or recent)  
+        - **limit:** int  
+        
+    **Return:**  
+    A json list with the Tweets found, most relevant (BM25) or newest
+    first.  
+        - **id:** uuid  
+        - **content:** str  
+        - **created_by:** uuid  
+        - **created_at:** datetime  
+        - **updated_at:** datetime  
+        - **deleted_at:** datetime
+    """
+    tweets = tweet_repository.search(q, limit, order)
+    if FAST_RESPONSES:
+        return FastJSONResponse([publicTweet(t) for t in tweets])
+    return tweets
+
+
+
+### Show the Tweets of a User
+@app.get(
+    path="/users/{user_id}/tweets",
+    response_model=List[Tweet],
+    status_code=status.HTTP_200_OK,
+    summary="Show the Tweets of a User",
+    tags=["Tweets"],
+)
+def show_user_tweets(
+    request: Request,
+    response: Response,
+    user_id: UUID = Path(...),
+    limit: int = Query(20, ge=1, le=1000, description="Page size"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous page"),
+    ):
+    """
+    **SHOW THE TWEETS OF A USER**  
+    This path operation show the Tweets of an active user, newest first.  
+    
+    **Parameters:**  
+        - Path parameter and Query parameters  
+        - **user_id:** uuid  
+        - **limit:** int  
+        - **cursor:** str  
+        
+    **Return:**  
+    A json list with a page of Tweets. The cursor of the next page is in
+    the X-Next-Cursor header.  
+        - **id:** uuid  
+        - **content:** str  
+        - **created_by:** uuid  
+        - **created_at:** datetime  
+        - **updated_at:** datetime  
+        - **deleted_at:** datetime
+    """
+    headers, not_modified = conditional_get(request, [
+        user_repository.collection.version(str(user_id)),
+        tweet_repository.collection.version(),
+    ])
+    if not_modified is not None:
+        return not_modified
+
+    if user_repository.get(str(user_id)) is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found",
+            headers={"X-Error": "User not found"}
+        )
+
+    tweets, next_cursor = tweet_repository.by_author(str(user_id), limit, cursor)
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = next_cursor
+    if FAST_RESPONSES:
+        return FastJSONResponse([publicTweet(t) for t in tweets], headers=headers)
+    response.headers.update(headers)
+    return tweets
 
 
 
@@ -437,7 +914,11 @@ def show_all_tweets() -> List[Tweet]:
     summary="Show a Tweet",
     tags=["Tweets"],
 )
-def show_a_tweet(tweet_id: UUID = Path(...)):
+def show_a_tweet(
+    request: Request,
+    response: Response,
+    tweet_id: UUID = Path(...),
+    ):
     """
     **SHOW A TWEET**  
     This path operation show a Tweet in the app.  
@@ -455,20 +936,24 @@ def show_a_tweet(tweet_id: UUID = Path(...)):
         - **updated_at:** datetime  
         - **deleted_at:** datetime
     """
-    with open("tweets.json", "r", encoding="utf-8") as f:
-        tweets = json.loads(f.read())
-
-        if len(tweets) > 0:
-            for t in tweets:
-                if t["id"] == str(tweet_id):
-                    return Tweet(id=t["id"], 
-                                content=t["content"], 
-                                created_by=t["created_by"], 
-                                created_at=t["created_at"], 
-                                updated_at=t["updated_at"], 
-                                deleted_at=t["deleted_at"]
-                            )
-    
+    headers, not_modified = conditional_get(request, [tweet_repository.collection.version(str(tweet_id))])
+    if not_modified is not None:
+        return not_modified
+
+    t = tweet_repository.get(str(tweet_id))
+
+    if t is not None:
+        if FAST_RESPONSES:
+            return FastJSONResponse(publicTweet(t), headers=headers)
+        response.headers.update(headers)
+        return Tweet(id=t["id"], 
+                    content=t["content"], 
+                    created_by=t["created_by"], 
+                    created_at=t["created_at"], 
+                    updated_at=t["updated_at"], 
+                    deleted_at=t["deleted_at"]
+                )
+
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND,
         detail="Tweet not found",
@@ -508,26 +993,28 @@ def update_a_tweet(
         - **updated_at:** datetime  
         - **deleted_at:** datetime
     """
-    with open("tweets.json", "r+", encoding="utf-8") as f:
-        tweets = json.loads(f.read())
-
-        if len(tweets) > 0:
-            for t in tweets:
-                if t["id"] == str(tweet_id) and t["deleted_at"] is None and t["created_by"] == str(tweet.created_by):
-                    t["content"] = tweet.content
-                    t["updated_at"] = str(datetime.now())
-                    
-                    f.seek(0)
-                    f.write(json.dumps(tweets))
-                    f.close()
-
-                    return Tweet(id=t["id"], 
-                                content=t["content"], 
-                                created_by=t["created_by"], 
-                                created_at=t["created_at"], 
-                                updated_at=t["updated_at"], 
-                                deleted_at=t["deleted_at"]
-                            )
+    # trends only count the hashtags / mentions added by the update
+    previous = None
+    if any(extract(tweet.content)):
+        old = tweet_repository.get(str(tweet_id))
+        previous = old["content"] if old is not None else None
+
+    t = tweet_repository.update(str(tweet_id), str(tweet.created_by), {
+        "content": tweet.content,
+        "updated_at": str(datetime.now()),
+    })
+
+    if t is not None:
+        trends.record(t["content"], previous)
+        if FAST_RESPONSES:
+            return FastJSONResponse(publicTweet(t))
+        return Tweet(id=t["id"], 
+                    content=t["content"], 
+                    created_by=t["created_by"], 
+                    created_at=t["created_at"], 
+                    updated_at=t["updated_at"], 
+                    deleted_at=t["deleted_at"]
+                )
 
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND,
@@ -566,28 +1053,370 @@ def delete_a_tweet(
         - **updated_at:** datetime  
         - **deleted_at:** datetime
     """
-    with open("tweets.json", "r+", encoding="utf-8") as f:
-        tweets = json.loads(f.read())
-
-        if len(tweets) > 0:
-            for t in tweets:
-                if t["id"] == str(tweet_id) and t["deleted_at"] is None and t["created_by"] == str(user_id):
-                    t["deleted_at"] = str(datetime.now())
-                    
-                    f.seek(0)
-                    f.write(json.dumps(tweets))
-                    f.close()
-
-                    return Tweet(id=t["id"], 
-                                content=t["content"], 
-                                created_by=t["created_by"], 
-                                created_at=t["created_at"], 
-                                updated_at=t["updated_at"], 
-                                deleted_at=t["deleted_at"]
-                            )
+    t = tweet_repository.delete(str(tweet_id), str(user_id), str(datetime.now()))
+
+    if t is not None:
+        if FAST_RESPONSES:
+            return FastJSONResponse(publicTweet(t))
+        return Tweet(id=t["id"], 
+                    content=t["content"], 
+                    created_by=t["created_by"], 
+                    created_at=t["created_at"], 
+                    updated_at=t["updated_at"], 
+                    deleted_at=t["deleted_at"]
+                )
 
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND,
         detail="Tweet not found",
         headers={"X-Error": "Tweet not found"}
     )
+
+
+
+## Follows
+
+### Follow a User
+@app.post(
+    path="/users/{user_id}/follow/{target_id}",
+    response_model=Follow,
+    status_code=status.HTTP_201_CREATED,
+    summary="Follow a User",
+    tags=["Follows"],
+)
+def follow_a_user(
+    response: Response,
+    user_id: UUID = Path(...),
+    target_id: UUID = Path(...),
+    ):
+    """
+    **FOLLOW A USER**  
+    This path operation make an active user follow another one: the
+    Tweets of target_id appear in the timeline of user_id.  
+    
+    **Parameters:**  
+        - Path parameters  
+        - **user_id:** uuid (the follower)  
+        - **target_id:** uuid (the user followed)
+        
+    **Return:**  
+    A json with the follow, 201 if it is new, 200 if user_id already
+    followed target_id.  
+        - **follower_id:** uuid  
+        - **followed_id:** uuid  
+        - **created_at:** datetime  
+        - **deleted_at:** datetime
+    """
+    if user_id == target_id:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="A user can't follow itself",
+            headers={"X-Error": "A user can't follow itself"}
+        )
+    if not user_repository.is_active(str(user_id)) or not user_repository.is_active(str(target_id)):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found",
+            headers={"X-Error": "User not found"}
+        )
+
+    follow, created = follow_repository.follow(str(user_id), str(target_id), str(datetime.now()))
+    status_code = status.HTTP_201_CREATED if created else status.HTTP_200_OK
+    if FAST_RESPONSES:
+        return FastJSONResponse(publicFollow(follow), status_code=status_code)
+    response.status_code = status_code
+    return follow
+
+
+
+### Unfollow a User
+@app.delete(
+    path="/users/{user_id}/follow/{target_id}",
+    response_model=Follow,
+    status_code=status.HTTP_200_OK,
+    summary="Unfollow a User",
+    tags=["Follows"],
+)
+def unfollow_a_user(
+    user_id: UUID = Path(...),
+    target_id: UUID = Path(...),
+    ):
+    """
+    **UNFOLLOW A USER**  
+    This path operation make a user stop following another one.  
+    
+    **Parameters:**  
+        - Path parameters  
+        - **user_id:** uuid (the follower)  
+        - **target_id:** uuid (the user followed)
+        
+    **Return:**  
+    A json with the ended follow.  
+        - **follower_id:** uuid  
+        - **followed_id:** uuid  
+        - **created_at:** datetime  
+        - **deleted_at:** datetime
+    """
+    follow = follow_repository.unfollow(str(user_id), str(target_id), str(datetime.now()))
+
+    if follow is not None:
+        if FAST_RESPONSES:
+            return FastJSONResponse(publicFollow(follow))
+        return follow
+
+    raise HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail="Follow not found",
+        headers={"X-Error": "Follow not found"}
+    )
+
+
+
+### Show the Timeline of a User
+@app.get(
+    path="/users/{user_id}/timeline",
+    response_model=List[Tweet],
+    status_code=status.HTTP_200_OK,
+    summary="Show the Timeline of a User",
+    tags=["Follows"],
+)
+def show_user_timeline(
+    request: Request,
+    response: Response,
+    user_id: UUID = Path(...),
+    limit: int = Query(20, ge=1, le=200, description="Page size"),
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor of the previous page"),
+    ):
+    """
+    **SHOW THE TIMELINE OF A USER**  
+    This path operation show the Tweets of the users followed by an
+    active user, and its own, newest first.  
+    
+    **Parameters:**  
+        - Path parameter and Query parameters  
+        - **user_id:** uuid  
+        - **limit:** int  
+        - **cursor:** str  
+        
+    **Return:**  
+    A json list with a page of Tweets. The cursor of the next page is in
+    the X-Next-Cursor header.  
+        - **id:** uuid  
+        - **content:** str  
+        - **created_by:** uuid  
+        - **created_at:** datetime  
+        - **updated_at:** datetime  
+        - **deleted_at:** datetime
+    """
+    headers, not_modified = conditional_get(request, [
+        user_repository.collection.version(str(user_id)),
+        follow_repository.collection.version(),
+        tweet_repository.collection.version(),
+    ])
+    if not_modified is not None:
+        return not_modified
+
+    if not user_repository.is_active(str(user_id)):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="User not found",
+            headers={"X-Error": "User not found"}
+        )
+
+    tweets, next_cursor = timelines.page(str(user_id), limit, cursor)
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = next_cursor
+    if FAST_RESPONSES:
+        return FastJSONResponse([publicTweet(t) for t in tweets], headers=headers)
+    response.headers.update(headers)
+    return tweets
+
+
+
+## Trends
+
+### Show the Trends
+@app.get(
+    path="/trends",
+    response_model=Trends,
+    status_code=status.HTTP_200_OK,
+    summary="Show the Trends",
+    tags=["Trends"],
+)
+def show_trends(
+    window: str = Query("1h", regex="^({})$".format("|".join(WINDOWS)), description=", ".join(WINDOWS)),
+    limit: int = Query(10, ge=1, le=100, description="Max number of hashtags and of mentions"),
+    ) -> Trends:
+    """
+    **SHOW THE TRENDS**  
+    This path operation show the most used hashtags and the most
+    mentioned names in the Tweets created or updated in the last window
+    of time.  
+    
+    **Parameters:**  
+        - Query parameters (optional)  
+        - **window:** str (5m, 15m, 1h, 6h or 24h)  
+        - **limit:** int  
+    
+    **Return:**  
+    A json with the estimated counts, highest first.  
+        - **window:** str  
+        - **hashtags:** list of {name, count}  
+        - **mentions:** list of {name, count}
+    """
+    top = trends.top(window, limit)
+    content = {
+        "window": window,
+        "hashtags": [{"name": name, "count": count} for name, count in top["hashtags"]],
+        "mentions": [{"name": name, "count": count} for name, count in top["mentions"]],
+    }
+    if FAST_RESPONSES:
+        return FastJSONResponse(content)
+    return content
+
+
+
+## Metrics
+
+### Show the Metrics
+@app.get(
+    path="/metrics",
+    response_class=PlainTextResponse,
+    status_code=status.HTTP_200_OK,
+    summary="Show the Metrics",
+    tags=["Metrics"],
+)
+def show_metrics():
+    """
+    **SHOW THE METRICS**  
+    This path operation show the metrics of the worker answering, in the
+    Prometheus text format.  
+    
+    **Return:**  
+    Per route latency histograms, request and response sizes, bytes read
+    from and written to the storage, time decoding stored JSON, time
+    encoding responses and time hashing passwords.
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+
+## Admin
+
+### Start a Profile
+@app.post(
+    path="/admin/profile",
+    status_code=status.HTTP_202_ACCEPTED,
+    summary="Start a Profile",
+    tags=["Admin"],
+)
+def start_a_profile(
+    seconds: float = Query(30, gt=0, description="Duration, PROFILE_MAX_SECONDS at most"),
+    rate: float = Query(PROFILE_RATE_HZ, gt=0, le=1000, description="Samples per second"),
+    x_admin_token: Optional[str] = Header(None),
+    ) -> Dict:
+    """
+    **START A PROFILE**  
+    This path operation start sampling the stacks of the worker answering.  
+    
+    **Parameters:**  
+        - Query parameters and the X-Admin-Token header  
+        - **seconds:** float  
+        - **rate:** float
+        
+    **Return:**  
+    A json with the state of the profile, 409 if one is already running.
+    """
+    verify_admin(x_admin_token)
+    if not sampler.start(rate, limit_seconds(seconds)):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="A profile is already running",
+            headers={"X-Error": "A profile is already running"}
+        )
+    return sampler.status()
+
+
+
+### Stop the Profile
+@app.delete(
+    path="/admin/profile",
+    status_code=status.HTTP_200_OK,
+    summary="Stop the Profile",
+    tags=["Admin"],
+)
+def stop_the_profile(x_admin_token: Optional[str] = Header(None)) -> Dict:
+    """
+    **STOP THE PROFILE**  
+    This path operation stop the running profile, its stacks are kept.  
+    
+    **Parameters:**  
+        - The X-Admin-Token header
+        
+    **Return:**  
+    A json with the state of the profile.
+    """
+    verify_admin(x_admin_token)
+    sampler.stop()
+    return sampler.status()
+
+
+
+### Show the Profile
+@app.get(
+    path="/admin/profile",
+    response_class=PlainTextResponse,
+    status_code=status.HTTP_200_OK,
+    summary="Show the Profile",
+    tags=["Admin"],
+)
+def show_the_profile(x_admin_token: Optional[str] = Header(None)):
+    """
+    **SHOW THE PROFILE**  
+    This path operation show the stacks sampled by the last profile of
+    the worker answering (running or not), ready for flamegraph.pl or
+    speedscope.  
+    
+    **Parameters:**  
+        - The X-Admin-Token header
+        
+    **Return:**  
+    One line per stack, outer frame first: thread;file:function;... count.
+    The state of the profile is in the X-Profile-* headers.
+    """
+    verify_admin(x_admin_token)
+    state = sampler.status()
+    headers = {
+        "X-Profile-Running": str(state["running"]).lower(),
+        "X-Profile-Samples": str(state["samples"]),
+        "X-Profile-Pid": str(state["pid"]),
+    }
+    return PlainTextResponse(sampler.collapsed(), headers=headers)
+
+
+
+### Show the Slow Requests
+@app.get(
+    path="/admin/slow",
+    status_code=status.HTTP_200_OK,
+    summary="Show the Slow Requests",
+    tags=["Admin"],
+)
+def show_slow_requests(x_admin_token: Optional[str] = Header(None)) -> List[Dict]:
+    """
+    **SHOW THE SLOW REQUESTS**  
+    This path operation show the last requests slower than
+    SLOW_REQUEST_MS served by the worker answering, oldest first, with
+    the time spent in each phase: storage (reads and writes), parse
+    (json.loads of stored records), scan (listings), hash (passwords),
+    model (response models) and encode (response body). Phases can
+    overlap: a scan includes the parsing of what it reads.  
+    
+    **Parameters:**  
+        - The X-Admin-Token header
+        
+    **Return:**  
+    A json list of {method, path, status, at, ms, phases_ms}.
+    """
+    verify_admin(x_admin_token)
+    return slow_requests.recent()
@@ -0,0 +1,227 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Dict, List, Sequence, Tuple
+
+from config import METRICS, WORKER_ROLE
+from profiling import add_phase
+
+# seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# bytes
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+Labels = Tuple[str, ...]
+
+
+class _Metric:
+    """
+    A metric of this worker process, without locks on the hot path.
+
+    Every thread updates its own shard (labels -> value), only the
+    first update of a thread takes a lock, to register its shard. A
+    scrape adds the shards up: values can be a few updates behind, never
+    lost.
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._shards: List[Dict] = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _shard(self) -> Dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def _label_text(self, labels: Labels, extra: str = "") -> str:
+        pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(self.labelnames, labels)]
+        if extra:
+            pairs.append(extra)
+        return "{{{}}}".format(",".join(pairs)) if pairs else ""
+
+    def collect(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+
+    kind = "counter"
+
+    def inc(self, labels: Labels = (), amount: float = 1) -> None:
+        if METRICS:
+            shard = self._shard()
+            shard[labels] = shard.get(labels, 0) + amount
+
+    def collect(self) -> List[str]:
+        totals: Dict[Labels, float] = {}
+        for shard in list(self._shards):
+            for labels, value in list(shard.items()):
+                totals[labels] = totals.get(labels, 0) + value
+        return ["{}{} {}".format(self.name, self._label_text(labels), _number(value))
+                for labels, value in sorted(totals.items())]
+
+
+class Histogram(_Metric):
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, labels: Labels = ()) -> None:
+        if METRICS:
+            shard = self._shard()
+            cells = shard.get(labels)
+            if cells is None:
+                # a count per bucket, then +Inf, then the sum
+                cells = shard[labels] = [0] * (len(self.buckets) + 2)
+            cells[bisect_left(self.buckets, value)] += 1
+            cells[-1] += value
+
+    def collect(self) -> List[str]:
+        totals: Dict[Labels, List[float]] = {}
+        for shard in list(self._shards):
+            for labels, cells in list(shard.items()):
+                total = totals.setdefault(labels, [0] * len(cells))
+                for i, value in enumerate(list(cells)):
+                    total[i] += value
+        lines = []
+        for labels, cells in sorted(totals.items()):
+            count = 0
+            for bound, value in zip(self.buckets + (float("inf"),), cells):
+                count += value
+                le = 'le="{}"'.format("+Inf" if bound == float("inf") else _number(bound))
+                lines.append("{}_bucket{} {}".format(self.name, self._label_text(labels, le), count))
+            lines.append("{}_sum{} {}".format(self.name, self._label_text(labels), _number(cells[-1])))
+            lines.append("{}_count{} {}".format(self.name, self._label_text(labels), count))
+        return lines
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REGISTRY: List[_Metric] = []
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Time to answer a request, body sent.", ("method", "route", "status"))
+REQUEST_BYTES = Histogram(
+    "http_request_size_bytes", "Size of the request bodies.", ("method", "route"), SIZE_BUCKETS)
+RESPONSE_BYTES = Histogram(
+    "http_response_size_bytes", "Size of the response bodies.", ("method", "route"), SIZE_BUCKETS)
+STORAGE_READ_BYTES = Counter(
+    "storage_read_bytes_total", "Bytes read from the storage (files, rows, segments).", ("collection",))
+STORAGE_WRITE_BYTES = Counter(
+    "storage_write_bytes_total", "Bytes written to the storage.", ("collection",))
+STORAGE_PARSE_SECONDS = Counter(
+    "storage_parse_seconds_total", "Time spent decoding stored JSON.", ("collection",))
+STORAGE_PARSED_RECORDS = Counter(
+    "storage_parsed_records_total", "Records decoded from stored JSON.", ("collection",))
+TIERED_RECORDS = Counter(
+    "storage_tiered_records_total", "Records moved to the cold tier.", ("collection",))
+SERIALIZE_SECONDS = Histogram(
+    "response_serialize_seconds", "Time to encode a response body to JSON.", ("encoder",))
+PASSWORD_SECONDS = Histogram(
+    "password_hash_seconds", "Time a hash or verify took, waiting for the pool included.", ("operation",))
+ADMISSION_QUEUE_SECONDS = Histogram(
+    "admission_queue_seconds", "Time requests of a limited route waited for their turn.", ("route",))
+ADMISSION_REJECTED = Counter(
+    "admission_rejected_total", "Requests refused before being served.", ("route", "reason"))
+
+
+def storage_read(collection: str, size: int, parse_seconds: float, records: int = 1) -> None:
+    """
+    Record ``size`` bytes read from ``collection`` and decoded into
+    ``records`` records in ``parse_seconds``.
+    """
+    STORAGE_READ_BYTES.inc((collection,), size)
+    STORAGE_PARSE_SECONDS.inc((collection,), parse_seconds)
+    STORAGE_PARSED_RECORDS.inc((collection,), records)
+    add_phase("parse", parse_seconds)
+
+
+def render() -> str:
+    """
+    Every metric of this worker in the Prometheus text format.
+    """
+    lines = [
+        "# HELP app_worker_info The worker process answering.",
+        "# TYPE app_worker_info gauge",
+        'app_worker_info{{pid="{}",role="{}"}} 1'.format(os.getpid(), _escape(WORKER_ROLE)),
+    ]
+    for metric in REGISTRY:
+        lines.append("# HELP {} {}".format(metric.name, metric.help))
+        lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every request and measuring its body and the
+    body of its response. Requests are labelled with their route path
+    (``/tweets/{tweet_id}``), not the url, so the series stay few;
+    requests matching no route are ``other``.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._routes: Dict = {}
+
+    def _route(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "other"
+        route = self._routes.get(endpoint)
+        if route is None:
+            app = scope.get("app")
+            self._routes = {
+                getattr(r, "endpoint", None): r.path for r in getattr(app, "routes", ()) if hasattr(r, "path")
+            }
+            route = self._routes.get(endpoint, "other")
+        return route
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS:
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        sizes = [0, 0]  # request, response
+        status = [500]
+
+        async def counted_receive():
+            message = await receive()
+            sizes[0] += len(message.get("body", b""))
+            return message
+
+        async def counted_send(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            elif message["type"] == "http.response.body":
+                sizes[1] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, counted_receive, counted_send)
+        finally:
+            method, route = scope["method"], self._route(scope)
+            REQUEST_SECONDS.observe(time.perf_counter() - start, (method, route, str(status[0])))
+            REQUEST_BYTES.observe(sizes[0], (method, route))
+            RESPONSE_BYTES.observe(sizes[1], (method, route))
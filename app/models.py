@@ -48,7 +48,7 @@ class User(BaseModel):
         )
 
     created_at: datetime = Field(
-        default=datetime.now(),
+        default_factory=datetime.now,
         title="Created At",
         description="The date and time when the user was created.",
         )
@@ -132,7 +132,7 @@ class Tweet(BaseModel):
         )
 
     created_at: datetime = Field(
-        default=datetime.now(),
+        default_factory=datetime.now,
         title="Created At",
         description="The date and time when the tweet was created.",
         )
@@ -157,3 +157,101 @@ class Tweet(BaseModel):
                 "created_by": "5e9f8f8f-e9b1-4b7b-b8b1-f9f9f9f9f9f9",
             }
         }
+
+
+
+class TweetResult(BaseModel):
+    # Result of one item of POST /tweets/batch
+    index: int = Field(
+        ...,
+        title="Index",
+        description="The position of the item in the batch.",
+        )
+
+    status: int = Field(
+        ...,
+        title="Status",
+        description="The HTTP status of the item: 201 when the tweet was created.",
+        )
+
+    tweet: Optional[Tweet] = Field(
+        default=None,
+        title="Tweet",
+        description="The tweet created.",
+        )
+
+    error: Optional[str] = Field(
+        default=None,
+        title="Error",
+        description="Why the tweet was not created.",
+        )
+
+
+
+
+# TRENDS
+class Trend(BaseModel):
+
+    name: str = Field(
+        ...,
+        title="Name",
+        description="The hashtag or the mentioned name, lower case, without # or @.",
+        )
+
+    count: int = Field(
+        ...,
+        title="Count",
+        description="How many tweets used it in the window (estimated, never lower than the real count).",
+        )
+
+
+
+class Trends(BaseModel):
+
+    window: str = Field(
+        ...,
+        title="Window",
+        description="The time window counted.",
+        )
+
+    hashtags: List[Trend] = Field(
+        ...,
+        title="Hashtags",
+        description="The most used hashtags, most used first.",
+        )
+
+    mentions: List[Trend] = Field(
+        ...,
+        title="Mentions",
+        description="The most mentioned names, most mentioned first.",
+        )
+
+
+
+
+# FOLLOW
+class Follow(BaseModel):
+
+    follower_id: UUID = Field(
+        ...,
+        title="Follower Id",
+        description="The user who follows.",
+        )
+
+    followed_id: UUID = Field(
+        ...,
+        title="Followed Id",
+        description="The user followed.",
+        )
+
+    created_at: datetime = Field(
+        ...,
+        title="Created At",
+        description="The date and time when the follow started.",
+        )
+
+    deleted_at: Optional[datetime] = Field(
+        default=None,
+        title="Deleted At",
+        description="The date and time of the unfollow.",
+        )
@@ -0,0 +1,184 @@
+"""
+Password hashing.
+
+    python passwords.py calibrate [target_ms]
+
+prints the rounds of PASSWORD_SCHEME that take about target_ms
+(PASSWORD_TARGET_MS by default) per hash on this machine.
+"""
+import asyncio
+import multiprocessing
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+from passlib.registry import get_crypt_handler
+
+from config import (
+    PASSWORD_WORKERS,
+    PASSWORD_MAX_PENDING,
+    PASSWORD_SCHEME,
+    PASSWORD_ROUNDS,
+    PASSWORD_TARGET_MS,
+)
+from metrics import PASSWORD_SECONDS
+from profiling import add_phase
+
+# schemes of the hashes already stored, still verified (and upgraded)
+LEGACY_SCHEMES = ["bcrypt"]
+
+
+def build_context(scheme: str = PASSWORD_SCHEME, rounds: Optional[int] = PASSWORD_ROUNDS) -> CryptContext:
+    """
+    CryptContext hashing with ``scheme`` and ``rounds`` (library default
+    when None). Hashes of other schemes or with other rounds (fewer or
+    more) are marked for update.
+    """
+    settings = {}
+    if rounds:
+        settings["{}__default_rounds".format(scheme)] = rounds
+        settings["{}__min_rounds".format(scheme)] = rounds
+        settings["{}__max_rounds".format(scheme)] = rounds
+    schemes = [scheme] + [s for s in LEGACY_SCHEMES if s != scheme]
+    return CryptContext(schemes=schemes, default=scheme, deprecated="auto", **settings)
+
+
+def calibrate(scheme: str = PASSWORD_SCHEME, target_ms: float = PASSWORD_TARGET_MS) -> int:
+    """
+    Return the highest rounds of ``scheme`` whose hash takes at most
+    ``target_ms`` on this machine (never less than the scheme minimum).
+    """
+    handler = get_crypt_handler(scheme)
+
+    def elapsed_ms(rounds: int) -> float:
+        hasher = handler.using(rounds=rounds)
+        best = None
+        for _ in range(2):
+            start = time.perf_counter()
+            hasher.hash("calibration-password")
+            spent = (time.perf_counter() - start) * 1000
+            best = spent if best is None else min(best, spent)
+        return best
+
+    if handler.rounds_cost == "log2":
+        rounds = handler.min_rounds
+        while rounds < handler.max_rounds and elapsed_ms(rounds + 1) <= target_ms:
+            rounds += 1
+        return rounds
+
+    rounds = handler.default_rounds
+    rounds = int(rounds * target_ms / elapsed_ms(rounds))
+    return max(handler.min_rounds, min(rounds, handler.max_rounds or rounds))
+
+
+# for password hash and verify (replaced by set_policy)
+pwd_context = build_context()
+
+
+def set_policy(scheme: str, rounds: Optional[int]) -> None:
+    global pwd_context
+    pwd_context = build_context(scheme, rounds)
+
+
+class HasherBusy(Exception):
+    """
+    Raised when too many hash / verify operations are already waiting.
+    """
+
+
+# run in the pool processes
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    return pwd_context.verify_and_update(password, hashed)
+
+
+class PasswordHasher:
+    """
+    Runs password hashing in a pool of ``workers`` processes.
+
+    bcrypt is slow on purpose and CPU bound: in the threadpool a few
+    logins are enough to starve the other requests. In processes they
+    use the other cores and the event loop stays free. When
+    ``max_pending`` operations are already queued or running, new ones
+    are refused with HasherBusy instead of piling up.
+
+    The pool is started on the first use, once the server threads run:
+    its processes are spawned, a fork could copy a lock held by another
+    thread and hang.
+    """
+
+    def __init__(self, workers: int = PASSWORD_WORKERS, max_pending: int = PASSWORD_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.scheme = PASSWORD_SCHEME
+        self.rounds = PASSWORD_ROUNDS
+        self.pending = 0  # only touched from the event loop
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def configure(self, scheme: str, rounds: Optional[int]) -> None:
+        """
+        Change the hashing policy, here and in the pool processes.
+        """
+        self.shutdown()
+        self.scheme, self.rounds = scheme, rounds
+        set_policy(scheme, rounds)
+
+    def _submit(self, fn, *args) -> "asyncio.Future":
+        if self.pending >= self.max_pending:
+            raise HasherBusy()
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=set_policy,
+                initargs=(self.scheme, self.rounds),
+            )
+        self.pending += 1
+        future = asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future) -> None:
+        self.pending -= 1
+
+    async def _timed(self, operation: str, fn, *args):
+        future = self._submit(fn, *args)
+        start = time.perf_counter()
+        try:
+            return await future
+        finally:
+            elapsed = time.perf_counter() - start
+            PASSWORD_SECONDS.observe(elapsed, (operation,))
+            add_phase("hash", elapsed)
+
+    async def hash(self, password: str) -> str:
+        return await self._timed("hash", _hash, password)
+
+    async def verify_and_update(self, password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        """
+        Verify ``password``, the second value is a new hash when
+        ``hashed`` doesn't follow the current policy any more.
+        """
+        return await self._timed("verify", _verify_and_update, password, hashed)
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+hasher = PasswordHasher()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3) or sys.argv[1] != "calibrate":
+        print(__doc__)
+        sys.exit(1)
+    target = float(sys.argv[2]) if len(sys.argv) == 3 else PASSWORD_TARGET_MS
+    print("PASSWORD_SCHEME={}".format(PASSWORD_SCHEME))
+    print("PASSWORD_ROUNDS={}".format(calibrate(PASSWORD_SCHEME, target)))
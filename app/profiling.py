@@ -0,0 +1,229 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from config import PROFILE_MAX_SECONDS, SLOW_REQUEST_MS, SLOW_REQUESTS_KEPT
+
+logger = logging.getLogger("uvicorn.error")
+
+MAX_STACKS = 20000  # distinct stacks kept by a profile, the others are counted as [truncated]
+MAX_DEPTH = 128
+
+# phases of the request being served: name -> seconds (None outside of a traced request)
+_phases: ContextVar[Optional[Dict[str, float]]] = ContextVar("phases", default=None)
+
+
+def add_phase(name: str, seconds: float) -> None:
+    """
+    Add ``seconds`` to the phase ``name`` of the current request. Phases
+    can overlap: a scan includes the parsing of the records it reads.
+    """
+    phases = _phases.get()
+    if phases is not None:
+        phases[name] = phases.get(name, 0.0) + seconds
+
+
+@contextmanager
+def phase(name: str):
+    """
+    Time a block as a phase of the current request:
+
+        with phase("storage"):
+            data = f.read()
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase(name, time.perf_counter() - start)
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return "{}:{}".format(os.path.basename(code.co_filename), code.co_name)
+
+
+class StackSampler:
+    """
+    Wall clock sampling profiler of the threads of this process.
+
+    A daemon thread takes the stacks of every other thread ``rate`` times
+    a second (``sys._current_frames``, no tracing hooks: the threads
+    being sampled don't slow down) and counts them. ``collapsed`` gives
+    the counts in the collapsed-stack format of flamegraph.pl and
+    speedscope, one ``thread;outer;...;inner count`` line per stack.
+
+    A profile stops by itself after ``seconds`` (0 for never), so one
+    started on a production worker can't be forgotten.
+    """
+
+    def __init__(self):
+        self._counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.rate = 0.0
+        self.started_at: Optional[float] = None
+        self.stopped_at: Optional[float] = None
+        self.samples = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, rate: float, seconds: float) -> bool:
+        """
+        Start a new profile, False if one is already running.
+        """
+        with self._lock:
+            if self.running:
+                return False
+            self._counts, self.samples = {}, 0
+            self.rate, self.started_at, self.stopped_at = rate, time.time(), None
+            self._stop = threading.Event()
+            self._thread = threading.Thread(
+                target=self._run, args=(1 / rate, seconds, self._stop), name="stack-sampler", daemon=True
+            )
+            self._thread.start()
+            return True
+
+    def stop(self) -> None:
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _run(self, interval: float, seconds: float, stop: threading.Event) -> None:
+        own = threading.get_ident()
+        deadline = time.monotonic() + seconds if seconds else None
+        while not stop.wait(interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_DEPTH:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread-{}".format(ident)))
+                key = ";".join(reversed(stack))
+                with self._lock:
+                    if key not in self._counts and len(self._counts) >= MAX_STACKS:
+                        key = "[truncated]"
+                    self._counts[key] = self._counts.get(key, 0) + 1
+            self.samples += 1
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+        self.stopped_at = time.time()
+
+    def collapsed(self) -> str:
+        with self._lock:
+            counts = sorted(self._counts.items())
+        return "".join("{} {}\n".format(stack, count) for stack, count in counts)
+
+    def status(self) -> Dict:
+        return {
+            "running": self.running,
+            "rate": self.rate,
+            "samples": self.samples,
+            "stacks": len(self._counts),
+            "started_at": self.started_at,
+            "stopped_at": self.stopped_at,
+            "pid": os.getpid(),
+        }
+
+
+sampler = StackSampler()
+
+
+class SlowRequests:
+    """
+    The last ``kept`` requests slower than ``threshold_ms``, with the time
+    spent in each phase. Each one is also logged.
+    """
+
+    def __init__(self, threshold_ms: float = SLOW_REQUEST_MS, kept: int = SLOW_REQUESTS_KEPT):
+        self.threshold = threshold_ms / 1000
+        self._recent = deque(maxlen=kept)
+
+    def record(self, method: str, path: str, status: int, seconds: float, phases: Dict[str, float]) -> None:
+        trace = {
+            "method": method,
+            "path": path,
+            "status": status,
+            "at": time.time(),
+            "ms": round(seconds * 1000, 3),
+            "phases_ms": {name: round(value * 1000, 3) for name, value in sorted(phases.items())},
+        }
+        self._recent.append(trace)
+        logger.warning("Slow request: %s %s %s in %.1fms (%s)", method, path, status, seconds * 1000,
+                       ", ".join("{} {:.1f}ms".format(name, ms) for name, ms in trace["phases_ms"].items()) or "no phase")
+
+    def recent(self) -> List[Dict]:
+        return list(self._recent)
+
+
+slow_requests = SlowRequests()
+
+
+def limit_seconds(seconds: float) -> float:
+    # profiles started through the API always end
+    return min(seconds, PROFILE_MAX_SECONDS) if seconds > 0 else PROFILE_MAX_SECONDS
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware collecting the phases of every request (see
+    ``add_phase``) and recording those slower than SLOW_REQUEST_MS in
+    ``slow_requests``. Off when SLOW_REQUEST_MS is 0.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or slow_requests.threshold <= 0:
+            await self.app(scope, receive, send)
+            return
+        phases: Dict[str, float] = {}
+        token = _phases.set(phases)
+        status = [500]
+
+        async def traced_send(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, traced_send)
+        finally:
+            elapsed = time.perf_counter() - start
+            _phases.reset(token)
+            if elapsed >= slow_requests.threshold:
+                slow_requests.record(scope["method"], scope["path"], status[0], elapsed, phases)
+
+
+def trace_model_building() -> None:
+    """
+    Time FastAPI's response model step (validation and jsonable_encoder)
+    as the ``model`` phase.
+    """
+    import fastapi.routing
+
+    serialize_response = fastapi.routing.serialize_response
+    if getattr(serialize_response, "traced", False):
+        return
+
+    async def traced_serialize_response(*args, **kwargs):
+        with phase("model"):
+            return await serialize_response(*args, **kwargs)
+
+    traced_serialize_response.traced = True
+    fastapi.routing.serialize_response = traced_serialize_response
@@ -0,0 +1,112 @@
+import os
+import threading
+from typing import Dict, Optional
+
+from config import STORAGE_BACKEND, DATA_DIR, SQLITE_PATH, WORKER_ROLE, TWEET_PARTITIONS, TWEET_PARTITION_BUCKETS
+
+from storage.cold import ColdTier
+from storage.partitioned import Layout, PartitionedCollection, manifest_layout, manifest_path, parse_scheme, read_manifest
+from storage.repository import UserRepository, TweetRepository, FollowRepository
+from storage.search import SearchIndex
+
+
+def create_backend(name: str):
+    """
+    Create the storage backend selected by ``name`` (json, memory, sqlite,
+    snapshot, the read only backend of the reader workers, or segment,
+    read only too, over converted segment files).
+    """
+    if name == "json":
+        from storage.jsonfile import JsonBackend
+        return JsonBackend(DATA_DIR)
+    if name == "memory":
+        from storage.memory import MemoryBackend
+        return MemoryBackend(DATA_DIR, publish=WORKER_ROLE == "writer")
+    if name == "sqlite":
+        from storage.sqlite import SqliteBackend
+        return SqliteBackend(SQLITE_PATH)
+    if name == "snapshot":
+        from storage.snapshot import SnapshotBackend
+        return SnapshotBackend(DATA_DIR)
+    if name == "segment":
+        from storage.snapshot import SnapshotBackend
+        return SnapshotBackend(DATA_DIR, extension="seg")
+    raise ValueError("Unknown storage backend: {}".format(name))
+
+
+def check_role(role: str = WORKER_ROLE, name: str = STORAGE_BACKEND) -> None:
+    """
+    Raise ValueError if the worker role is unknown, or if the multi-worker
+    mode runs with another backend than memory: only the memory backend
+    publishes the snapshots the reader workers serve.
+    """
+    if role not in ("single", "writer", "reader"):
+        raise ValueError("Unknown worker role: {}".format(role))
+    if role != "single" and name != "memory":
+        raise ValueError("WORKER_ROLE={} needs STORAGE_BACKEND=memory, not {}".format(role, name))
+
+
+def tweet_layout(scheme: str = TWEET_PARTITIONS, buckets: int = TWEET_PARTITION_BUCKETS) -> Layout:
+    return Layout(parse_scheme(scheme), buckets)
+
+
+def create_tweets(backend, layout: Layout):
+    """
+    The tweets collection, partitioned by ``layout`` if it has a scheme.
+    """
+    if not layout.scheme:
+        return backend.collection("tweets", indexes=("created_by",))
+    return PartitionedCollection(backend, manifest_path(DATA_DIR, "tweets"), "tweets", ("created_by",), layout)
+
+
+def check_tweets(backend, tweets) -> None:
+    """
+    Raise ValueError if the tweets on disk are not laid out as the
+    ``tweets`` collection expects (TWEET_PARTITIONS changed, tweets not
+    moved yet): ``python -m storage rebalance`` moves them.
+    """
+    if getattr(backend, "read_only", False):
+        return
+    manifest = read_manifest(manifest_path(DATA_DIR, "tweets"))
+    if not isinstance(tweets, PartitionedCollection):
+        if manifest is not None:
+            raise ValueError("tweets are partitioned by {}: run python -m storage rebalance".format(
+                manifest_layout(manifest)))
+    elif manifest is None:
+        if backend.has_records("tweets"):
+            raise ValueError("tweets are not partitioned: run python -m storage rebalance")
+    elif manifest_layout(manifest) != tweets.layout:
+        raise ValueError("tweets are partitioned by {}, not {}: run python -m storage rebalance".format(
+            manifest_layout(manifest), tweets.layout))
+
+
+def create_repositories(backend, layout: Optional[Layout] = None, check: bool = True):
+    tweets = create_tweets(backend, tweet_layout() if layout is None else layout)
+    if check:
+        check_tweets(backend, tweets)
+    return (
+        UserRepository(backend.collection("users", indexes=("email",)), ColdTier(DATA_DIR, "users")),
+        TweetRepository(tweets, SearchIndex(tweets, os.path.join(DATA_DIR, "tweets.search")), ColdTier(DATA_DIR, "tweets")),
+        FollowRepository(backend.collection("follows", indexes=("follower_id", "followed_id"))),
+    )
+
+
+_app: Dict[str, object] = {}
+_app_lock = threading.Lock()
+
+
+def __getattr__(name: str):
+    # ``backend``, ``users``, ``tweets`` and ``follows`` of the app, opened
+    # on first use: the storage commands (python -m storage) open their own
+    if name not in ("backend", "users", "tweets", "follows"):
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    with _app_lock:
+        if not _app:
+            check_role()
+            backend = create_backend("snapshot" if WORKER_ROLE == "reader" else STORAGE_BACKEND)
+            # converted segments are never partitioned
+            # (checked by the app on startup, the storage commands may be run to fix the layout)
+            repositories = create_repositories(backend, tweet_layout("") if STORAGE_BACKEND == "segment" else None,
+                                               check=False)
+            _app.update(zip(("backend", "users", "tweets", "follows"), (backend,) + repositories))
+    return _app[name]
@@ -0,0 +1,158 @@
+"""
+Storage maintenance commands.
+
+    python -m storage migrate <from> <to>
+    python -m storage compact
+    python -m storage tier
+    python -m storage rebalance [<scheme> [<buckets>]]
+    python -m storage segment convert|verify
+
+migrate copies every user, tweet and follow from one backend to another (e.g.
+json to sqlite), keeping the insertion order. compact folds the logs of
+the memory backend into users.json / tweets.json, run it before
+switching from the memory backend to the json one.
+
+tier moves the deleted users and tweets past TIER_TOMBSTONE_DAYS, and
+the tweets older than TIER_TWEET_MAX_AGE_DAYS, to the cold tier now
+(the app does it every TIER_INTERVAL_SECONDS). With the json and memory
+backends, run it with the app stopped.
+
+rebalance moves the tweets to the partitions of <scheme> (author, month,
+author,month or none, by default TWEET_PARTITIONS and
+TWEET_PARTITION_BUCKETS) from their current layout, single collection
+or partitions, with the app stopped. It can be run again if interrupted.
+
+segment convert writes users.seg / tweets.seg (the binary segment
+format of storage.segment) from the records of STORAGE_BACKEND (the json
+files with the segment backend), read through the backend: the log of
+the memory backend and every partition included. segment verify checks
+that every record reads back the same from the segments, in order and
+by id. With the json and memory backends, run them with the app stopped.
+"""
+import os
+import sys
+from itertools import islice
+
+from config import DATA_DIR, STORAGE_BACKEND, TWEET_PARTITIONS, TWEET_PARTITION_BUCKETS
+
+from storage import create_backend, create_repositories, create_tweets, tweet_layout
+from storage.partitioned import rebalance
+from storage.segment import Segment, write_segment
+from storage.tiering import tier
+
+NAMES = ("users", "tweets")
+MIGRATE_BATCH = 1000  # records read, checked and written at a time
+
+
+def segment_path(name: str) -> str:
+    return os.path.join(DATA_DIR, "{}.seg".format(name))
+
+
+def segment_sources():
+    # the segment backend reads the segments: convert from the json files
+    backend = create_backend("json" if STORAGE_BACKEND == "segment" else STORAGE_BACKEND)
+    collections = {"users": backend.collection("users", indexes=("email",)),
+                   "tweets": create_tweets(backend, tweet_layout())}
+    return backend, collections
+
+
+def migrate(source: str, target: str, batch: int = MIGRATE_BATCH) -> None:
+    source_backend, target_backend = create_backend(source), create_backend(target)
+    for src, dst in zip(create_repositories(source_backend), create_repositories(target_backend)):
+        count = 0
+        scan = src.collection.scan()
+        while True:
+            records = list(islice(scan, batch))
+            if not records:
+                break
+            copied = dst.collection.get_many(r["id"] for r in records)  # by an interrupted migrate
+            records = [r for r in records if r["id"] not in copied]
+            if records:
+                dst.collection.insert_many(records)
+                count += len(records)
+        print("{}: {} records copied".format(src.collection.name, count))
+    source_backend.close()
+    target_backend.close()
+
+
+def compact() -> None:
+    backend = create_backend("memory")
+    for repository in create_repositories(backend):
+        repository.collection.compact()
+        repository.collection.close()
+        print("{}: compacted".format(repository.collection.name))
+    backend.close()
+
+
+def tier_now() -> None:
+    backend = create_backend(STORAGE_BACKEND)
+    users, tweets, _ = create_repositories(backend)
+    moved = tier(users, tweets)
+    if not moved:
+        print("tiering already running in another process")
+    for name, count in moved.items():
+        print("{}: {} records moved to the cold tier ({} cold)".format(
+            name, count, len(users.cold if name == "users" else tweets.cold)))
+    backend.close()
+
+
+def rebalance_tweets(scheme: str, buckets: int) -> None:
+    backend = create_backend(STORAGE_BACKEND)
+    layout = tweet_layout("" if scheme == "none" else scheme, buckets)
+    counts = rebalance(backend, DATA_DIR, "tweets", ("created_by",), layout)
+    if not counts:
+        print("tweets: already partitioned by {}".format(layout))
+    for name, count in sorted(counts.items()):
+        print("{}: {} records".format(name, count))
+    backend.close()
+
+
+def convert() -> None:
+    backend, collections = segment_sources()
+    for name in NAMES:
+        target = segment_path(name)
+        count = write_segment(target, collections[name].scan())
+        print("{}: {} records written to {}".format(name, count, target))
+    backend.close()
+
+
+def verify() -> bool:
+    ok = True
+    backend, collections = segment_sources()
+    for name in NAMES:
+        segment = Segment(segment_path(name))
+        count, errors = 0, 0
+        stored = iter(segment)
+        for record in collections[name].scan():
+            count += 1
+            if next(stored, None) != record or segment.get(record["id"]) != record:
+                errors += 1
+                if errors <= 10:
+                    print("{}: record {} differs".format(name, record["id"]))
+        if count != len(segment):
+            errors += 1
+            print("{}: {} records in the storage, {} in the segment".format(name, count, len(segment)))
+        print("{}: {} records, {}".format(name, count, "ok" if not errors else "{} errors".format(errors)))
+        ok = ok and not errors
+        segment.close()
+    backend.close()
+    return ok
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "migrate":
+        migrate(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) == 2 and sys.argv[1] == "compact":
+        compact()
+    elif 2 <= len(sys.argv) <= 4 and sys.argv[1] == "rebalance":
+        rebalance_tweets(sys.argv[2] if len(sys.argv) > 2 else TWEET_PARTITIONS or "none",
+                         int(sys.argv[3]) if len(sys.argv) > 3 else TWEET_PARTITION_BUCKETS)
+    elif len(sys.argv) == 2 and sys.argv[1] == "tier":
+        tier_now()
+    elif len(sys.argv) == 3 and sys.argv[1:] == ["segment", "convert"]:
+        convert()
+    elif len(sys.argv) == 3 and sys.argv[1:] == ["segment", "verify"]:
+        sys.exit(0 if verify() else 1)
+    else:
+        print(__doc__)
+        sys.exit(1)
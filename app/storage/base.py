@@ -0,0 +1,171 @@
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+class DuplicateId(Exception):
+    """
+    Raised when a record is inserted with the id of an existing record.
+    """
+
+
+def check_new(records: Iterable[Dict], exists: Callable[[str], bool]) -> None:
+    """
+    Raise DuplicateId if the id of one of ``records`` is repeated or
+    already used (``exists``). Called in the critical section of the
+    insert.
+    """
+    seen = set()
+    for record in records:
+        id = record["id"]
+        if id in seen or exists(id):
+            raise DuplicateId(id)
+        seen.add(id)
+
+
+class ReadOnlyError(Exception):
+    """
+    Raised when a write reaches a read only collection (reader workers).
+    """
+
+
+class Collection:
+    """
+    Stores the records (dicts) of one entity, keyed by their ``id``.
+
+    Records are kept in the same shape they have in the JSON files: ids
+    and dates as strings. Backends must return copies, callers are free
+    to modify the dicts they get.
+    """
+
+    indexed = True  # get reads the record only, not the whole collection
+
+    def __init__(self, name: str, indexes: Tuple[str, ...] = ()):
+        self.name = name
+        self.indexes = indexes  # fields with a secondary (non unique) index
+
+    def get(self, id: str) -> Optional[Dict]:
+        """
+        Return the record with the given id or None.
+        """
+        for record in self.scan():
+            if record["id"] == id:
+                return record
+        return None
+
+    def find(self, field: str, value: str) -> List[Dict]:
+        """
+        Return the records where ``field`` is equal to ``value``.
+        """
+        return [r for r in self.scan() if r.get(field) == value]
+
+    def page(
+        self,
+        limit: int,
+        after: Optional[str] = None,
+        field: Optional[str] = None,
+        value: Optional[str] = None,
+        reverse: bool = False,
+    ) -> List[Dict]:
+        """
+        Return up to ``limit`` live (not deleted) records that come after
+        the record with id ``after`` (KeyError if it doesn't exist), in
+        insertion order or, with ``reverse``, newest first. ``field`` and
+        ``value`` restrict the page to the records where they match.
+        """
+        records = list(self.scan())
+        if reverse:
+            records.reverse()
+        start = 0
+        if after is not None:
+            ids = [r["id"] for r in records]
+            if after not in ids:
+                raise KeyError(after)
+            start = ids.index(after) + 1
+        page = []
+        for record in records[start:]:
+            if record["deleted_at"] is None and (field is None or record.get(field) == value):
+                page.append(record)
+                if len(page) == limit:
+                    break
+        return page
+
+    def scan(self) -> Iterator[Dict]:
+        """
+        Iterate over all the records in insertion order. Writes made
+        while iterating don't break the scan (they may or may not be
+        seen).
+        """
+        raise NotImplementedError
+
+    def get_many(self, ids: Iterable[str]) -> Dict[str, Dict]:
+        """
+        Return ``id -> record`` for the given ids, unknown ids are left
+        out. One pass over the collection.
+        """
+        wanted = set(ids)
+        found = {}
+        for record in self.scan():
+            if record["id"] in wanted:
+                found[record["id"]] = record
+        return found
+
+    def insert(self, record: Dict) -> Dict:
+        """
+        Add a new record to the collection, DuplicateId (nothing
+        written) if its id is already used.
+        """
+        raise NotImplementedError
+
+    def insert_many(self, records: List[Dict]) -> List[Dict]:
+        """
+        Add new records, in one write (one commit, one fsync) on the
+        backends that can. DuplicateId if one of the ids is already used
+        or repeated, nothing is written then.
+        """
+        return [self.insert(record) for record in records]
+
+    def update(
+        self,
+        id: str,
+        changes: Dict,
+        where: Optional[Callable[[Dict], bool]] = None,
+    ) -> Optional[Dict]:
+        """
+        Apply ``changes`` to the record with the given id.
+
+        ``where`` is checked against the current record in the same
+        critical section as the write, if it returns False nothing is
+        written. Returns the updated record or None.
+        """
+        raise NotImplementedError
+
+    def remove(self, ids: Iterable[str], where: Optional[Callable[[Dict], bool]] = None) -> List[str]:
+        """
+        Delete the records with the given ids for good (moved to the cold
+        tier), in one write. ``where`` is checked against each current
+        record in the same critical section, records it refuses are
+        kept. Returns the ids removed.
+        """
+        raise NotImplementedError
+
+    def version(self, id: Optional[str] = None) -> Tuple[str, float]:
+        """
+        Return ``(token, modified_at)`` of the collection, or of the
+        record ``id``: the token changes with every write that could
+        change it, ``modified_at`` is the time (epoch seconds) of that
+        write. Backends without per record versions return the ones of
+        the collection.
+        """
+        raise NotImplementedError
+
+    def changes(self, since: str) -> Optional[Tuple[Dict[str, Optional[Dict]], str]]:
+        """
+        The records written since the version token ``since``:
+        ``(id -> record, None if removed, current token)``, read without
+        a scan. None when the collection can't tell (token of another
+        run, changes no longer kept, backend without change tracking):
+        the caller reads the whole collection then.
+        """
+        return None
+
+    def close(self) -> None:
+        pass
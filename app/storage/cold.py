@@ -0,0 +1,266 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from config import COLD_MAX_FILES
+from metrics import STORAGE_WRITE_BYTES, storage_read
+
+from storage.segment import LENGTH, encode_record, segment_key
+
+MAGIC = b"TWCOLD1\n"
+HEADER = struct.Struct("<8sQQ")   # magic, records, index offset
+ENTRY = struct.Struct("<16sQH")   # index entry: key, block offset, position in the block
+BLOCK_RECORDS = 64                # records compressed together
+
+
+def write_cold(path: str, records: Iterable[Dict]) -> int:
+    """
+    Write ``records`` to a cold segment file at ``path`` (replaced
+    atomically, fsync-ed) and return how many were written.
+
+    Layout: like a segment (see storage.segment) but the records are
+    compressed by blocks of BLOCK_RECORDS: a fixed size header, the
+    blocks (each one a length followed by the zlib of the records' JSON,
+    one per line), then the index: one fixed size entry ``(key, block
+    offset, position)`` per record, sorted by key.
+    """
+    tmp = "{}.tmp".format(path)
+    entries: List[Tuple[bytes, int, int]] = []
+    with open(tmp, "wb") as f:
+        f.write(bytes(HEADER.size))
+        offset = HEADER.size
+        block: List[bytes] = []
+
+        def flush():
+            nonlocal offset
+            data = zlib.compress(b"\n".join(block))
+            f.write(LENGTH.pack(len(data)))
+            f.write(data)
+            offset += LENGTH.size + len(data)
+            block.clear()
+
+        for record in records:
+            entries.append((segment_key(record["id"]), offset, len(block)))
+            block.append(encode_record(record))
+            if len(block) == BLOCK_RECORDS:
+                flush()
+        if block:
+            flush()
+        entries.sort(key=lambda entry: entry[0])  # stable: same keys stay in file order
+        for entry in entries:
+            f.write(ENTRY.pack(*entry))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(entries), offset))
+        STORAGE_WRITE_BYTES.inc((os.path.basename(path).split(".")[0],), offset + len(entries) * ENTRY.size)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return len(entries)
+
+
+class ColdSegment:
+    """
+    Read only cold segment file, mapped in memory.
+
+    ``get`` is a binary search in the index followed by the decompression
+    of one block: a lookup costs O(log n) plus BLOCK_RECORDS records to
+    decode, whatever the size of the file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.name = os.path.basename(path).split(".")[0]
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.index = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError("{} is not a cold segment file".format(path))
+        if self.index + self.count * ENTRY.size != len(self._mm):
+            raise ValueError("{} is truncated".format(path))
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _entry(self, i: int) -> Tuple[bytes, int, int]:
+        return ENTRY.unpack_from(self._mm, self.index + i * ENTRY.size)
+
+    def _block(self, offset: int) -> List[bytes]:
+        (length,) = LENGTH.unpack_from(self._mm, offset)
+        start = offset + LENGTH.size
+        return zlib.decompress(self._mm[start:start + length]).split(b"\n")
+
+    def _decode(self, data: bytes, began: float) -> Dict:
+        record = json.loads(data)
+        storage_read(self.name, len(data), time.perf_counter() - began)
+        return record
+
+    def get(self, id: str) -> Optional[Dict]:
+        key = segment_key(id)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        found = None
+        # hashed keys can collide and a file can repeat an id: check the
+        # ids, the last one wins
+        while lo < self.count:
+            entry_key, offset, position = self._entry(lo)
+            if entry_key != key:
+                break
+            began = time.perf_counter()
+            record = self._decode(self._block(offset)[position], began)
+            if record["id"] == id:
+                found = record
+            lo += 1
+        return found
+
+    def __iter__(self) -> Iterator[Dict]:
+        offset = HEADER.size
+        while offset < self.index:
+            began = time.perf_counter()
+            (length,) = LENGTH.unpack_from(self._mm, offset)
+            for data in self._block(offset):
+                yield self._decode(data, began)
+                began = time.perf_counter()
+            offset += LENGTH.size + length
+
+    def close(self) -> None:
+        self._mm.close()
+
+
+class ColdTier:
+    """
+    The records of a collection moved out of it (see storage.tiering):
+    the cold segments listed, oldest first, in the manifest
+    ``<name>.cold`` (JSON). Each move adds a file; once there are
+    ``max_files`` they are merged into one before the next is added, so
+    a lookup reads a few files at most.
+
+    A lookup does a ``stat`` of the manifest and maps the files again
+    only when it changed (another process moved records). Records are
+    only added by one process at a time (the tiering lock).
+    """
+
+    def __init__(self, data_dir: str, name: str, max_files: int = COLD_MAX_FILES):
+        self.data_dir = data_dir
+        self.name = name
+        self.max_files = max_files
+        self.manifest_path = os.path.join(data_dir, "{}.cold".format(name))
+        self._stat: Optional[Tuple[int, int]] = None
+        self._segments: List[ColdSegment] = []
+        self._lock = threading.Lock()
+
+    def _manifest(self) -> Dict:
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"next": 1, "files": []}
+
+    def _write_manifest(self, manifest: Dict) -> None:
+        tmp = "{}.tmp".format(self.manifest_path)
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.manifest_path)
+
+    def _current(self) -> List[ColdSegment]:
+        try:
+            st = os.stat(self.manifest_path)
+        except FileNotFoundError:
+            return self._segments
+        if (st.st_ino, st.st_mtime_ns) != self._stat:
+            with self._lock:
+                if (st.st_ino, st.st_mtime_ns) != self._stat:
+                    self._reload()
+        return self._segments
+
+    def _reload(self) -> None:
+        st = os.stat(self.manifest_path)
+        manifest = self._manifest()
+        try:
+            segments = [ColdSegment(os.path.join(self.data_dir, file)) for file in manifest["files"]]
+        except FileNotFoundError:
+            return  # merged meanwhile, the next lookup reads the new manifest
+        # the old segments stay mapped for the lookups still using them
+        self._segments = segments
+        self._stat = (st.st_ino, st.st_mtime_ns)
+
+    def __len__(self) -> int:
+        return sum(len(segment) for segment in self._current())
+
+    def get(self, id: str) -> Optional[Dict]:
+        for segment in reversed(self._current()):  # newest first
+            record = segment.get(id)
+            if record is not None:
+                return record
+        return None
+
+    def __iter__(self) -> Iterator[Dict]:
+        for segment in self._current():
+            yield from segment
+
+    def add(self, records: List[Dict]) -> int:
+        """
+        Write ``records`` to a new cold segment (on disk when it returns),
+        after merging the segments if there are too many: the new one is
+        the last file until the next ``add``.
+        """
+        if len(self._manifest()["files"]) >= self.max_files:
+            self.merge()
+        manifest = self._manifest()
+        file = "{}.{:06d}.cold".format(self.name, manifest["next"])
+        count = write_cold(os.path.join(self.data_dir, file), records)
+        self._write_manifest({"next": manifest["next"] + 1, "files": manifest["files"] + [file]})
+        return count
+
+    def drop(self, ids: Iterable[str]) -> None:
+        """
+        Take ``ids`` out of the last segment added: records written to
+        the cold tier but then kept in the collection (see
+        storage.tiering.move). The segment is written again without them.
+        """
+        ids = set(ids)
+        manifest = self._manifest()
+        if not ids or not manifest["files"]:
+            return
+        path = os.path.join(self.data_dir, manifest["files"][-1])
+        segment = ColdSegment(path)
+        try:
+            records = [r for r in segment if r["id"] not in ids]
+        finally:
+            segment.close()
+        files = manifest["files"][:-1]
+        if records:
+            file = "{}.{:06d}.cold".format(self.name, manifest["next"])
+            write_cold(os.path.join(self.data_dir, file), records)
+            files.append(file)
+        self._write_manifest({"next": manifest["next"] + 1, "files": files})
+        os.remove(path)
+
+    def merge(self) -> None:
+        """
+        Rewrite every cold segment into one, in order (the newest copy of
+        a record stays the one found).
+        """
+        manifest = self._manifest()
+        if len(manifest["files"]) < 2:
+            return
+        paths = [os.path.join(self.data_dir, file) for file in manifest["files"]]
+        segments = [ColdSegment(path) for path in paths]
+        file = "{}.{:06d}.cold".format(self.name, manifest["next"])
+        write_cold(os.path.join(self.data_dir, file), (r for segment in segments for r in segment))
+        for segment in segments:
+            segment.close()
+        self._write_manifest({"next": manifest["next"] + 1, "files": [file]})
+        for path in paths:
+            os.remove(path)
@@ -0,0 +1,341 @@
+import weakref
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Set
+
+EPOCH = datetime(1970, 1, 1)
+NONE = -(2 ** 63)  # timestamp column value for None
+FIELDS = ("id", "content", "created_by", "created_at", "updated_at", "deleted_at")
+
+
+def _uuid_bytes(value) -> Optional[bytes]:
+    """
+    16 bytes of a canonical uuid string, None if it wouldn't round trip.
+    """
+    try:
+        key = bytes.fromhex(value.replace("-", ""))
+    except (TypeError, ValueError, AttributeError):
+        return None
+    return key if len(key) == 16 and _uuid_str(key) == value else None
+
+
+def _micros(value) -> Optional[int]:
+    """
+    str(datetime) of a naive datetime to epoch microseconds, None if it
+    wouldn't round trip (other formats, time zones).
+    """
+    if value is None:
+        return NONE
+    try:
+        dt = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if dt.tzinfo is not None or str(dt) != value:
+        return None
+    return (dt - EPOCH) // timedelta(microseconds=1)
+
+
+def _datetime_str(micros: int) -> Optional[str]:
+    return None if micros == NONE else str(EPOCH + timedelta(microseconds=micros))
+
+
+def _uuid_str(key: bytes) -> str:
+    # str(UUID(bytes=key)), 3x faster
+    h = key.hex()
+    return "{}-{}-{}-{}-{}".format(h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
+def _discard(rows: array, row: int) -> None:
+    i = bisect_left(rows, row)
+    if i < len(rows) and rows[i] == row:
+        del rows[i]
+
+
+class _Columns:
+    """
+    The per row columns that can change after insertion.
+    """
+
+    def __init__(self):
+        self.author = array("I")        # interned author number
+        self.created_at = array("q")    # epoch microseconds
+        self.updated_at = array("q")
+        self.deleted_at = array("q")
+        self.offset = array("Q")        # content position in the buffer
+        self.length = array("I")        # content size in bytes
+
+    def copy(self) -> "_Columns":
+        copy = _Columns.__new__(_Columns)
+        for name, column in vars(self).items():
+            setattr(copy, name, column[:])
+        return copy
+
+
+class ColumnarTweetIndex:
+    """
+    Compact replacement of RecordIndex for tweets (TWEET_STORE=columnar).
+
+    Instead of one dict per tweet:
+    - ids as 16 bytes in one bytearray, ``id bytes -> row`` in a dict,
+    - authors interned to small ints (array of uint32),
+    - created/updated/deleted_at as int64 epoch microseconds,
+    - contents in a single UTF-8 buffer with offsets and lengths,
+    - a deletion bitmap, and live rows (globally and per author) as
+      sorted uint32 arrays for keyset pages.
+
+    The row number is the insertion order (the seq of RecordIndex).
+    Records are dicts only at the boundary: ``get``, ``find``, ``page``
+    and iteration build them on the fly. A value that doesn't fit its
+    column exactly (a non canonical uuid, a date with a time zone, an
+    unknown field) is kept as is in an overflow dict, so any record
+    round trips.
+
+    Contents are append only: an update appends the new text, the old
+    bytes stay until the store is rebuilt (restart or compaction). So do
+    the rows of removed tweets (moved to the cold tier), skipped from
+    then on.
+    """
+
+    def __init__(self, indexes=("created_by",), records: Iterable[Dict] = ()):
+        self.indexes = indexes
+        self._rows: Dict[bytes, int] = {}
+        self._ids = bytearray()
+        self._authors: List[bytes] = []         # number -> 16 bytes id
+        self._author_ids: List[Optional[str]] = []  # number -> id string
+        self._author_numbers: Dict[bytes, int] = {}
+        self._columns = _Columns()
+        self._content = bytearray()
+        self._deleted = bytearray()             # 1 bit per row
+        self._overflow: Dict[int, Dict] = {}    # row -> values kept as is
+        self.live = array("I")
+        self._live_by_author: Dict[int, array] = {}
+        self._rows_by_author: Dict[int, array] = {}
+        self._removed = set()                   # rows of removed tweets
+        self._views = weakref.WeakSet()         # values() still in use, sharing the columns
+        for record in records:
+            self.put(record)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __getstate__(self) -> Dict:
+        # pickled for a warm start: the views in use stay in this process
+        state = dict(self.__dict__)
+        del state["_views"]
+        return state
+
+    def __setstate__(self, state: Dict) -> None:
+        self.__dict__.update(state)
+        self._views = weakref.WeakSet()
+
+    # keys
+
+    def _key(self, id) -> bytes:
+        key = _uuid_bytes(id)
+        return key if key is not None else b"s:" + str(id).encode("utf-8")
+
+    def _author(self, key: bytes) -> int:
+        number = self._author_numbers.get(key)
+        if number is None:
+            number = self._author_numbers[key] = len(self._authors)
+            self._authors.append(key)
+            self._author_ids.append(_uuid_str(key) if len(key) == 16 else None)
+        return number
+
+    def _is_deleted(self, row: int) -> bool:
+        return bool(self._deleted[row >> 3] & (1 << (row & 7)))
+
+    def _writable(self) -> None:
+        # copy on write: the views of values() still in use keep the
+        # columns they were given, the store goes on with a copy
+        if self._views:
+            self._columns = self._columns.copy()
+            self._overflow = dict(self._overflow)
+            self._removed = set(self._removed)
+            self._views = weakref.WeakSet()
+
+    # writes
+
+    def put(self, record: Dict) -> None:
+        self._writable()
+        overflow = {k: v for k, v in record.items() if k not in FIELDS}
+        key = self._key(record["id"])
+        if len(key) != 16:
+            overflow["id"] = record["id"]
+
+        author_key = _uuid_bytes(record.get("created_by"))
+        if author_key is None:
+            overflow["created_by"] = record.get("created_by")
+            author_key = self._key(record.get("created_by"))
+        author = self._author(author_key)
+
+        times = []
+        for field in ("created_at", "updated_at", "deleted_at"):
+            micros = _micros(record.get(field))
+            if micros is None:
+                overflow[field] = record.get(field)
+                micros = NONE
+            times.append(micros)
+
+        content = record.get("content")
+        if isinstance(content, str):
+            data = content.encode("utf-8")
+        else:
+            overflow["content"] = content
+            data = b""
+
+        c = self._columns
+        row = self._rows.get(key)
+        if row is None:
+            row = self._rows[key] = len(self._ids) // 16
+            self._ids += key if len(key) == 16 else bytes(16)
+            if row % 8 == 0:
+                self._deleted.append(0)
+            c.author.append(author)
+            c.created_at.append(times[0])
+            c.updated_at.append(times[1])
+            c.deleted_at.append(times[2])
+            c.offset.append(len(self._content))
+            c.length.append(len(data))
+            self._content += data
+            self._rows_by_author.setdefault(author, array("I")).append(row)
+            was_live, old_author = False, author
+        else:
+            was_live, old_author = not self._is_deleted(row), c.author[row]
+            if old_author != author:
+                _discard(self._rows_by_author[old_author], row)
+                insort(self._rows_by_author.setdefault(author, array("I")), row)
+            c.author[row] = author
+            c.created_at[row], c.updated_at[row], c.deleted_at[row] = times
+            old = self._content[c.offset[row]:c.offset[row] + c.length[row]]
+            if old != data:
+                c.offset[row] = len(self._content)
+                c.length[row] = len(data)
+                self._content += data
+
+        if overflow:
+            self._overflow[row] = overflow
+        else:
+            self._overflow.pop(row, None)
+
+        live = record.get("deleted_at") is None
+        if live:
+            self._deleted[row >> 3] &= ~(1 << (row & 7)) & 0xFF
+        else:
+            self._deleted[row >> 3] |= 1 << (row & 7)
+        if was_live:
+            _discard(self.live, row)
+            _discard(self._live_by_author[old_author], row)
+        if live:
+            insort(self.live, row)
+            insort(self._live_by_author.setdefault(author, array("I")), row)
+
+    def remove(self, id: str) -> None:
+        """
+        Drop a tweet for good (its row is not reused).
+        """
+        row = self._rows.pop(self._key(id), None)
+        if row is None:
+            return
+        self._writable()
+        author = self._columns.author[row]
+        _discard(self._rows_by_author[author], row)
+        if not self._is_deleted(row):
+            _discard(self.live, row)
+            _discard(self._live_by_author[author], row)
+        self._overflow.pop(row, None)
+        self._removed.add(row)
+
+    # reads
+
+    def _record(self, row: int, c: Optional[_Columns] = None, overflow: Optional[Dict[int, Dict]] = None) -> Dict:
+        c = c if c is not None else self._columns
+        overflow = overflow if overflow is not None else self._overflow
+        offset = c.offset[row]
+        record = {
+            "id": _uuid_str(self._ids[row * 16:row * 16 + 16]),
+            "content": self._content[offset:offset + c.length[row]].decode("utf-8"),
+            "created_by": self._author_ids[c.author[row]],
+            "created_at": _datetime_str(c.created_at[row]),
+            "updated_at": _datetime_str(c.updated_at[row]),
+            "deleted_at": _datetime_str(c.deleted_at[row]),
+        }
+        extra = overflow.get(row)
+        if extra:
+            record.update(extra)
+        return record
+
+    def get(self, id: str) -> Optional[Dict]:
+        row = self._rows.get(self._key(id))
+        return self._record(row) if row is not None else None
+
+    def _author_of(self, value) -> Optional[int]:
+        key = _uuid_bytes(value)
+        return self._author_numbers.get(key if key is not None else self._key(value))
+
+    def find(self, field: str, value: str) -> List[Dict]:
+        if field != "created_by":
+            raise KeyError(field)
+        author = self._author_of(value)
+        if author is None:
+            return []
+        return [self._record(row) for row in self._rows_by_author[author]]
+
+    def page(
+        self,
+        limit: int,
+        after: Optional[str] = None,
+        field: Optional[str] = None,
+        value: Optional[str] = None,
+        reverse: bool = False,
+    ) -> List[Dict]:
+        if field is None:
+            rows = self.live
+        elif field == "created_by":
+            author = self._author_of(value)
+            rows = self._live_by_author.get(author, array("I")) if author is not None else array("I")
+        else:
+            raise KeyError(field)
+        if after is None:
+            start = len(rows) if reverse else 0
+        else:
+            row = self._rows[self._key(after)]
+            start = bisect_left(rows, row) if reverse else bisect_right(rows, row)
+        if reverse:
+            chosen = rows[max(0, start - limit):start][::-1]
+        else:
+            chosen = rows[start:start + limit]
+        return [self._record(row) for row in chosen]
+
+    def values(self) -> "_FrozenTweets":
+        """
+        Consistent view of the current tweets, iterated one dict at a
+        time, call it with the collection lock held. Nothing is copied:
+        the view shares the mutable columns, and the first write while it
+        is in use copies them (ids and contents are append only).
+        """
+        view = _FrozenTweets(self, len(self._ids) // 16, self._columns, self._overflow, self._removed)
+        self._views.add(view)
+        return view
+
+
+class _FrozenTweets:
+
+    def __init__(self, store: ColumnarTweetIndex, count: int, columns: _Columns, overflow: Dict[int, Dict],
+                 removed: Set[int]):
+        self.store = store
+        self.count = count
+        self.columns = columns
+        self.overflow = overflow
+        self.removed = removed
+
+    def __len__(self) -> int:
+        return self.count - len(self.removed)
+
+    def __iter__(self) -> Iterator[Dict]:
+        store, columns, overflow, removed = self.store, self.columns, self.overflow, self.removed
+        for row in range(self.count):
+            if row in removed:
+                continue
+            yield store._record(row, columns, overflow)
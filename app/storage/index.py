@@ -0,0 +1,129 @@
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, Iterable, List, Optional
+
+
+def _live(record: Dict) -> bool:
+    return record.get("deleted_at") is None
+
+
+def _discard(seqs: List[int], seq: int) -> None:
+    i = bisect_left(seqs, seq)
+    if i < len(seqs) and seqs[i] == seq:
+        del seqs[i]
+
+
+class RecordIndex:
+    """
+    In-memory records of a collection with their indexes.
+
+    - ``id -> record`` and, for each indexed field, ``value -> [ids]``
+      (all the records, deleted or not).
+    - Every record gets a sequence number (its insertion order). The
+      sorted seqs of the live (not deleted) records, globally and per
+      value of each indexed field, let ``page`` start from a cursor with
+      a binary search: a page costs O(log n + limit).
+
+    Not thread safe, the collections using it hold their own lock.
+    """
+
+    def __init__(self, indexes=(), records: Iterable[Dict] = ()):
+        self.indexes = indexes
+        self.records: Dict[str, Dict] = {}
+        self.by_field: Dict[str, Dict[str, List[str]]] = {field: {} for field in indexes}
+        self.seqs: Dict[str, int] = {}
+        self.ids: List[Optional[str]] = []  # seq -> id (None once removed)
+        self.live: List[int] = []
+        self.live_by_field: Dict[str, Dict[str, List[int]]] = {field: {} for field in indexes}
+        for record in records:
+            self.put(record)
+
+    def put(self, record: Dict) -> None:
+        """
+        Insert or replace a record (records must not be modified once put).
+        """
+        id = record["id"]
+        old = self.records.get(id)
+        if old is None:
+            seq = self.seqs[id] = len(self.ids)
+            self.ids.append(id)
+        else:
+            seq = self.seqs[id]
+
+        for field, index in self.by_field.items():
+            if old is not None and old.get(field) != record.get(field):
+                ids = index.get(old.get(field), [])
+                if id in ids:
+                    ids.remove(id)
+            if old is None or old.get(field) != record.get(field):
+                index.setdefault(record.get(field), []).append(id)
+
+        was_live = old is not None and _live(old)
+        if was_live:
+            _discard(self.live, seq)
+            for field, index in self.live_by_field.items():
+                _discard(index.get(old.get(field), []), seq)
+        if _live(record):
+            insort(self.live, seq)
+            for field, index in self.live_by_field.items():
+                insort(index.setdefault(record.get(field), []), seq)
+
+        self.records[id] = record
+
+    def remove(self, id: str) -> None:
+        """
+        Drop a record for good (its seq is not reused).
+        """
+        record = self.records.pop(id, None)
+        if record is None:
+            return
+        seq = self.seqs.pop(id)
+        self.ids[seq] = None
+        for field, index in self.by_field.items():
+            ids = index.get(record.get(field), [])
+            if id in ids:
+                ids.remove(id)
+        if _live(record):
+            _discard(self.live, seq)
+            for field, index in self.live_by_field.items():
+                _discard(index.get(record.get(field), []), seq)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def get(self, id: str) -> Optional[Dict]:
+        return self.records.get(id)
+
+    def find(self, field: str, value: str) -> List[Dict]:
+        return [self.records[id] for id in self.by_field[field].get(value, ())]
+
+    def page(
+        self,
+        limit: int,
+        after: Optional[str] = None,
+        field: Optional[str] = None,
+        value: Optional[str] = None,
+        reverse: bool = False,
+    ) -> List[Dict]:
+        """
+        Up to ``limit`` live records following the record ``after`` (an
+        id, KeyError if unknown), in insertion order or newest first.
+        """
+        seqs = self.live if field is None else self.live_by_field[field].get(value, [])
+        if after is None:
+            start = len(seqs) if reverse else 0
+        elif reverse:
+            start = bisect_left(seqs, self.seqs[after])
+        else:
+            start = bisect_right(seqs, self.seqs[after])
+        if reverse:
+            chosen = seqs[max(0, start - limit):start][::-1]
+        else:
+            chosen = seqs[start:start + limit]
+        return [self.records[self.ids[seq]] for seq in chosen]
+
+    def values(self) -> List[Dict]:
+        """
+        Consistent list of the current records (records are never
+        modified in place, a copy of the list is enough).
+        """
+        return list(self.records.values())
@@ -0,0 +1,216 @@
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from metrics import STORAGE_WRITE_BYTES, storage_read
+from profiling import phase
+
+from storage.base import Collection, check_new
+
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_json_array(path: str) -> Iterator[Dict]:
+    """
+    Parse the JSON array in ``path`` one record at a time, reading the
+    file by chunks, so it needs memory for one chunk, not for the whole
+    file. Nothing if the file doesn't exist.
+    """
+    decoder = json.JSONDecoder()
+    name = os.path.basename(path).split(".")[0]
+    try:
+        f = open(path, "r", encoding="utf-8")
+    except FileNotFoundError:
+        return
+    # bytes read, records and time decoding them, reported once per chunk
+    size, parsed, seconds = 0, 0, 0.0
+    try:
+        with f:
+            buffer, pos, started = "", 0, False
+            while True:
+                with phase("storage"):
+                    chunk = f.read(CHUNK_SIZE)
+                storage_read(name, size, seconds, parsed)
+                size, parsed, seconds = len(chunk), 0, 0.0
+                buffer, pos = buffer[pos:] + chunk, 0
+                while True:
+                    while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                        pos += 1
+                    if pos == len(buffer):
+                        break
+                    if not started:
+                        if buffer[pos] != "[":
+                            raise ValueError("{} is not a JSON array".format(path))
+                        started, pos = True, pos + 1
+                        continue
+                    if buffer[pos] == "]":
+                        return
+                    start = time.perf_counter()
+                    try:
+                        record, pos = decoder.raw_decode(buffer, pos)
+                    except ValueError:
+                        if not chunk:
+                            raise
+                        break  # the record continues in the next chunk
+                    seconds += time.perf_counter() - start
+                    parsed += 1
+                    yield record
+                if not chunk:
+                    return
+    finally:
+        storage_read(name, size, seconds, parsed)
+
+
+def write_json_array(f, records: Iterable[Dict]) -> None:
+    """
+    Write ``records`` to the text file ``f`` as a JSON array, one record
+    at a time (same bytes as ``json.dumps(list(records))``).
+    """
+    f.write("[")
+    for i, record in enumerate(records):
+        f.write(", " if i else "")
+        f.write(json.dumps(record))
+    f.write("]")
+
+
+def write_file(path: str, data: str, sync: bool = True) -> None:
+    """
+    Replace the file at ``path`` with ``data`` atomically: written to a
+    temporary file, fsync-ed (``sync``), then renamed over it.
+    """
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(data)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _read_generation(path: str) -> int:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return int(f.read() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+class JsonCollection(Collection):
+    """
+    The original storage: a single JSON array per entity.
+
+    Every operation reads and parses the whole file, every write
+    replaces it (see write_file). Kept so we can switch backends
+    without downtime.
+
+    ``<name>.json.version`` counts the writes: with the mtime and size
+    of the file it makes the version token, two writes of the same size
+    within the resolution of the mtime still get different tokens.
+    """
+
+    indexed = False
+
+    def __init__(self, path: str, name: str, indexes=()):
+        super().__init__(name, indexes)
+        self.path = path
+        self.version_path = "{}.version".format(path)
+        self._lock = threading.Lock()
+
+    def _read(self) -> List[Dict]:
+        try:
+            with phase("storage"), open(self.path, "r", encoding="utf-8") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        start = time.perf_counter()
+        records = json.loads(data or "[]")
+        storage_read(self.name, len(data), time.perf_counter() - start, len(records))
+        return records
+
+    def _write(self, records: List[Dict]) -> None:
+        # a new file replacing the old one: scans (not locked) read one or
+        # the other whole, a crash leaves the old one
+        data = json.dumps(records)
+        with phase("storage"):
+            write_file(self.path, data)
+            # after the data: a reader never sees the new generation with the
+            # old content. Not fsync-ed, lost in a crash the mtime still moved
+            write_file(self.version_path, str(_read_generation(self.version_path) + 1), sync=False)
+        STORAGE_WRITE_BYTES.inc((self.name,), len(data))
+
+    def scan(self) -> Iterator[Dict]:
+        return iter_json_array(self.path)
+
+    def version(self, id: Optional[str] = None) -> Tuple[str, float]:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return "0", 0.0
+        generation = _read_generation(self.version_path)
+        return "{:x}-{:x}-{:x}".format(generation, st.st_mtime_ns, st.st_size), st.st_mtime
+
+    def insert(self, record: Dict) -> Dict:
+        with self._lock:
+            records = self._read()
+            check_new([record], {r["id"] for r in records}.__contains__)
+            records.append(dict(record))
+            self._write(records)
+        return dict(record)
+
+    def insert_many(self, records: List[Dict]) -> List[Dict]:
+        with self._lock:
+            stored = self._read()
+            check_new(records, {r["id"] for r in stored}.__contains__)
+            stored.extend(dict(r) for r in records)
+            self._write(stored)
+        return [dict(r) for r in records]
+
+    def update(
+        self,
+        id: str,
+        changes: Dict,
+        where: Optional[Callable[[Dict], bool]] = None,
+    ) -> Optional[Dict]:
+        with self._lock:
+            records = self._read()
+            for record in records:
+                if record["id"] == id:
+                    if where is not None and not where(record):
+                        return None
+                    record.update(changes)
+                    self._write(records)
+                    return dict(record)
+        return None
+
+    def remove(self, ids: Iterable[str], where: Optional[Callable[[Dict], bool]] = None) -> List[str]:
+        ids = set(ids)
+        with self._lock:
+            records, kept, removed = self._read(), [], []
+            for record in records:
+                if record["id"] in ids and (where is None or where(record)):
+                    removed.append(record["id"])
+                else:
+                    kept.append(record)
+            if removed:
+                self._write(kept)
+        return removed
+
+
+class JsonBackend:
+    """
+    Backend storing every collection in ``<data_dir>/<name>.json``.
+    """
+
+    def __init__(self, data_dir: str):
+        self.data_dir = data_dir
+
+    def collection(self, name: str, indexes=()) -> Collection:
+        return JsonCollection(os.path.join(self.data_dir, "{}.json".format(name)), name, indexes)
+
+    def has_records(self, name: str) -> bool:
+        return next(iter_json_array(os.path.join(self.data_dir, "{}.json".format(name))), None) is not None
+
+    def close(self) -> None:
+        pass
@@ -0,0 +1,542 @@
+import gc
+import json
+import logging
+import mmap
+import os
+import pickle
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from config import LOG_COMPACT_BYTES, TWEET_STORE, WARM_START, WARM_START_SAVE_SECONDS
+
+from metrics import STORAGE_READ_BYTES, STORAGE_WRITE_BYTES, storage_read
+
+from storage.base import Collection, check_new
+from storage.columnar import ColumnarTweetIndex
+from storage.index import RecordIndex
+from storage.jsonfile import iter_json_array, write_json_array
+from storage.partitioned import tweet_collection
+from storage.snapshot import SnapshotPublisher, snapshot_path
+from storage.writer import GroupCommitWriter
+
+logger = logging.getLogger("uvicorn.error")
+
+WARM_FORMAT = 2  # of the <name>.warm files
+CHANGES_KEPT = 100000  # last written ids kept for changes()
+
+
+class MemoryCollection(Collection):
+    """
+    Keeps all the records of an entity in memory (the writer role of the
+    multi-worker mode).
+
+    Records live in a RecordIndex (or the ``store`` given, e.g. the
+    columnar store of the tweets): O(1) lookups by id, hash indexes on
+    the fields in ``indexes`` and keyset pages.
+
+    Writes are appended to ``<name>.log`` (one JSON mutation per line)
+    by the backend's group commit writer. A write is checked against the
+    state including the writes still waiting for their commit (so they
+    keep their order), but only reaches the records read by the others
+    once its log line is fsync-ed, in log order: nobody sees a record
+    that is not durable, and a failed commit leaves nothing to undo (the
+    writer truncates the log back). Once the
+    log is bigger than ``LOG_COMPACT_BYTES`` it is folded into
+    the ``<name>.json`` snapshot by a background thread, so the snapshot
+    keeps the format of the JSON backend. On startup the state is the
+    snapshot plus the replay of the logs.
+
+    With ``warm_start``, ``checkpoint`` saves the records and their
+    indexes as they are in memory (pickled) to ``<name>.warm``, with the
+    size of the log they cover and the identity of the JSON snapshot the
+    log applies to. A start loads that file instead (no JSON parsing, no
+    index building) and only replays the log past that size; a file that
+    doesn't match the snapshot, the log or the settings is ignored. Only
+    the app writes it: it is as trusted as the rest of the data directory.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        name: str,
+        indexes=(),
+        writer: Optional[GroupCommitWriter] = None,
+        compact_bytes: int = LOG_COMPACT_BYTES,
+        store: Callable = RecordIndex,
+        warm_start: bool = WARM_START,
+    ):
+        super().__init__(name, indexes)
+        self.path = path
+        self.writer = writer or GroupCommitWriter()
+        self.log_path = "{}.log".format(os.path.splitext(path)[0])
+        self.compacting_path = "{}.compacting".format(self.log_path)
+        self.warm_path = "{}.warm".format(os.path.splitext(path)[0])
+        self.warm_start = warm_start
+        self.compact_bytes = compact_bytes
+        self._lock = threading.RLock()
+        self._index = store(indexes)
+        self._compaction: Optional[threading.Thread] = None
+        self.listeners: List[Callable[[], None]] = []  # called after each committed write
+        # versions: a counter bumped by every write, prefixed by an epoch
+        # so tokens of two runs never collide
+        self._epoch = "{:x}".format(time.time_ns())
+        self._version = 0
+        self._modified = time.time()
+        self._record_versions: Dict[str, Tuple[int, float]] = {}
+        # (version, id) of the last writes, complete from _changes_from
+        self._changes: Deque[Tuple[int, str]] = deque(maxlen=CHANGES_KEPT)
+        self._changes_from = 0
+        # writes queued, not committed yet: (commit, entries, log bytes,
+        # log generation, seq) in log order, and the records they leave
+        # (None if removed) for the checks of the next writes
+        self._pending: Deque[Tuple[Future, List[Dict], int, int, int]] = deque()
+        self._written: Dict[str, Tuple[int, Optional[Dict]]] = {}  # id -> (seq, record)
+        self._seq = 0
+        self._generation = 0  # of the log, bumped by each rotation
+        self._load()
+        self._loaded_at = time.time()
+        self._log_bytes = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0  # queued
+        self._applied_bytes = self._log_bytes  # of the log lines applied to the records
+
+    def _load(self) -> None:
+        start = time.perf_counter()
+        offset = self._load_warm() if self.warm_start else None
+        if offset is not None:
+            replayed = self._replay(self.log_path, offset)
+            logger.info("%s: warm start from %s, %s records and %s log entries in %.1fms", self.name,
+                        os.path.basename(self.warm_path), len(self._index), replayed, (time.perf_counter() - start) * 1000)
+            return
+        for record in iter_json_array(self.path):
+            self._index.put(record)
+        # a compaction interrupted by a crash leaves its log behind,
+        # replaying it again is harmless: every entry is idempotent
+        replayed = sum(self._replay(log_path) for log_path in (self.compacting_path, self.log_path))
+        if os.path.exists(self.compacting_path):
+            self._write_snapshot(self.records())
+        logger.info("%s: cold start from %s, %s records and %s log entries in %.1fms", self.name,
+                    os.path.basename(self.path), len(self._index), replayed, (time.perf_counter() - start) * 1000)
+
+    def _replay(self, log_path: str, offset: int = 0) -> int:
+        """
+        Apply the entries of the log from ``offset``, return how many.
+
+        A crash during an append leaves a torn last line (not committed,
+        nobody was told it was): the log is truncated after the last
+        complete entry, otherwise the next append would be written on
+        the end of that line and lost with it on the next start. A
+        damaged entry followed by others is not a torn write: ValueError.
+        """
+        try:
+            f = open(log_path, "rb")
+        except FileNotFoundError:
+            return 0
+        replayed = 0
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            f.seek(offset)
+            end = offset  # of the last complete entry
+            for line in f:
+                start = time.perf_counter()
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("no end of line")
+                    entry = json.loads(line)
+                except ValueError:
+                    if end + len(line) < size:
+                        raise ValueError("{}: damaged entry at byte {}".format(log_path, end))
+                    break
+                storage_read(self.name, len(line), time.perf_counter() - start)
+                self._apply(entry)
+                replayed += 1
+                end += len(line)
+        if end < size:
+            logger.warning("%s: torn write at the end of %s, %s bytes dropped", self.name, log_path, size - end)
+            with open(log_path, "r+b") as f:
+                f.truncate(end)
+                os.fsync(f.fileno())
+        return replayed
+
+    def _source(self) -> Optional[Tuple[int, int, int]]:
+        # identity of the JSON snapshot the log applies to
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def _warm_header(self, offset: int) -> Tuple:
+        return WARM_FORMAT, type(self._index).__name__, tuple(self.indexes), self._source(), offset
+
+    def _load_warm(self) -> Optional[int]:
+        """
+        Load ``<name>.warm`` if it still applies, return the log size it
+        covers (None if it was not used).
+        """
+        if os.path.exists(self.compacting_path):
+            return None  # the snapshot is behind its logs
+        try:
+            f = open(self.warm_path, "rb")
+        except FileNotFoundError:
+            return None
+        log_size = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+        with f:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    header = pickle.load(mm)
+                    offset = header[-1]
+                    # a log shorter than the offset lost writes the file has
+                    if header != self._warm_header(offset) or offset > log_size:
+                        return None
+                    # millions of new objects: the cycle collector would
+                    # run many times over them for nothing
+                    enabled = gc.isenabled()
+                    gc.disable()
+                    try:
+                        index = pickle.load(mm)
+                    finally:
+                        if enabled:
+                            gc.enable()
+                    STORAGE_READ_BYTES.inc((self.name,), len(mm))
+            except Exception:  # damaged: only costs a cold start
+                logger.warning("%s: %s can't be loaded, cold start", self.name, self.warm_path, exc_info=True)
+                return None
+        self._index = index
+        return offset
+
+    def checkpoint(self) -> None:
+        """
+        Save the records and indexes to ``<name>.warm`` (atomically) for
+        the next start. Writes wait meanwhile; skipped while a compaction
+        runs, the snapshot is about to change.
+        """
+        if not self.warm_start:
+            return
+        with self._lock:
+            if self._compaction is not None and self._compaction.is_alive():
+                return
+            self._drain()
+            tmp = "{}.{}.tmp".format(self.warm_path, os.getpid())
+            with open(tmp, "wb") as f:
+                # the lines past the offset (pending writes) are replayed
+                pickle.dump(self._warm_header(self._applied_bytes), f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(self._index, f, pickle.HIGHEST_PROTOCOL)
+                STORAGE_WRITE_BYTES.inc((self.name,), f.tell())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.warm_path)
+
+    def _apply(self, entry: Dict) -> None:
+        if entry["op"] == "create":
+            self._index.put(entry["record"])
+        elif entry["op"] == "remove":
+            for id in entry["ids"]:
+                self._index.remove(id)
+        else:
+            record = self._index.get(entry["id"])
+            if record is not None:
+                self._index.put(dict(record, **entry["changes"]))
+
+    def _applied(self, entries: List[Dict]) -> None:
+        # a committed write reaches the records, versions and changes
+        for entry in entries:
+            self._apply(entry)
+            if entry["op"] == "remove":
+                self._version += 1
+                self._modified = time.time()
+                for id in entry["ids"]:
+                    self._record_versions.pop(id, None)
+                    self._changed(id)
+            else:
+                self._bump(entry["record"]["id"] if entry["op"] == "create" else entry["id"])
+
+    def _current(self, id: str) -> Optional[Dict]:
+        # called with the lock held: the record as the writes queued leave it
+        written = self._written.get(id)
+        return written[1] if written is not None else self._index.get(id)
+
+    def _append(self, entries: List[Dict], records: Dict[str, Optional[Dict]]) -> Future:
+        """
+        Queue ``entries`` (one log append, one fsync) leaving ``records``
+        (id -> record, None if removed). Called with the lock held, so
+        the log order is the order of the checks and of the apply.
+        """
+        line = "".join(json.dumps(entry) + "\n" for entry in entries)
+        future = self.writer.append(self.log_path, line)
+        self._seq += 1
+        self._pending.append((future, entries, len(line), self._generation, self._seq))
+        for id, record in records.items():
+            self._written[id] = (self._seq, record)
+        self._log_bytes += len(line)
+        STORAGE_WRITE_BYTES.inc((self.name,), len(line))
+        if self._log_bytes >= self.compact_bytes:
+            self.compact(wait=False)
+        return future
+
+    def _drain(self) -> None:
+        # called with the lock held: apply the writes committed, in log
+        # order (commits resolve in that order); failed ones are dropped
+        while self._pending and self._pending[0][0].done():
+            future, entries, size, generation, seq = self._pending.popleft()
+            failed = future.exception() is not None
+            if generation == self._generation:
+                if failed:
+                    self._log_bytes -= size  # truncated by the writer
+                else:
+                    self._applied_bytes += size
+            if not failed:
+                self._applied(entries)
+            for entry in entries:
+                for id in entry["ids"] if entry["op"] == "remove" else [entry.get("id") or entry["record"]["id"]]:
+                    if self._written.get(id, (None,))[0] == seq:
+                        del self._written[id]
+
+    def _commit(self, future: Future) -> None:
+        """
+        Wait for the commit of a write, then apply it (with the writes
+        committed before). Raises if the commit failed.
+        """
+        try:
+            future.result()
+        finally:
+            with self._lock:
+                self._drain()
+        for listener in self.listeners:
+            listener()
+
+    def compact(self, wait: bool = True) -> None:
+        """
+        Fold the log into the JSON snapshot.
+
+        The writer rotates the current log after the lines already queued
+        (cheap), the snapshot is written by a background thread while
+        requests keep going.
+        """
+        with self._lock:
+            if self._compaction is not None and self._compaction.is_alive():
+                compaction = self._compaction
+            else:
+                rotated = self.writer.rotate(self.log_path, self.compacting_path)
+                self._generation += 1
+                self._log_bytes = self._applied_bytes = 0
+                compaction = threading.Thread(
+                    target=self._compact, args=(rotated,), name="compact-{}".format(self.name), daemon=True
+                )
+                self._compaction = compaction
+                compaction.start()
+        if wait:
+            compaction.join()
+
+    def records(self) -> Iterable[Dict]:
+        """
+        Consistent view of the current records (not to be modified).
+        """
+        with self._lock:
+            return self._index.values()
+
+    def _compact(self, rotated: Future) -> None:
+        rotated.result()
+        # every line of the rotated log is committed: once applied, the
+        # records contain them (and maybe a few of the new log, replaying
+        # them again is harmless)
+        with self._lock:
+            self._drain()
+            records = self._index.values()
+        self._write_snapshot(records)
+
+    def _write_snapshot(self, records: Iterable[Dict]) -> None:
+        tmp = "{}.tmp".format(self.path)
+        with open(tmp, "w", encoding="utf-8") as f:
+            write_json_array(f, records)
+            STORAGE_WRITE_BYTES.inc((self.name,), f.tell())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        os.remove(self.compacting_path)
+
+    def get(self, id: str) -> Optional[Dict]:
+        record = self._index.get(id)
+        return dict(record) if record is not None else None
+
+    def get_many(self, ids: Iterable[str]) -> Dict[str, Dict]:
+        found = {}
+        with self._lock:
+            for id in ids:
+                record = self._index.get(id)
+                if record is not None:
+                    found[id] = dict(record)
+        return found
+
+    def find(self, field: str, value: str) -> List[Dict]:
+        if field not in self.indexes:
+            return super().find(field, value)
+        with self._lock:
+            records = self._index.find(field, value)
+        return [dict(r) for r in records]
+
+    def page(self, limit, after=None, field=None, value=None, reverse=False) -> List[Dict]:
+        if field is not None and field not in self.indexes:
+            return super().page(limit, after, field, value, reverse)
+        with self._lock:
+            records = self._index.page(limit, after, field, value, reverse)
+        return [dict(r) for r in records]
+
+    def scan(self) -> Iterator[Dict]:
+        return (dict(r) for r in self.records())
+
+    def version(self, id: Optional[str] = None) -> Tuple[str, float]:
+        if id is None:
+            version, modified = self._version, self._modified
+        else:
+            version, modified = self._record_versions.get(id, (0, self._loaded_at))
+        return "{}.{:x}".format(self._epoch, version), modified
+
+    def _bump(self, id: str) -> None:
+        self._version += 1
+        self._modified = time.time()
+        self._record_versions[id] = (self._version, self._modified)
+        self._changed(id)
+
+    def _changed(self, id: str) -> None:
+        if len(self._changes) == self._changes.maxlen:
+            # the oldest entry goes: versions before it can't be answered
+            self._changes_from = self._changes[0][0]
+        self._changes.append((self._version, id))
+
+    def _changed_since(self, since: str) -> Optional[List[str]]:
+        # called with the lock held
+        epoch, _, version = since.partition(".")
+        try:
+            version = int(version, 16)
+        except ValueError:
+            return None
+        if epoch != self._epoch or not self._changes_from <= version <= self._version:
+            return None
+        ids: Dict[str, None] = {}
+        for written, id in reversed(self._changes):
+            if written <= version:
+                break
+            ids[id] = None
+        return list(ids)
+
+    def changes(self, since: str) -> Optional[Tuple[Dict[str, Optional[Dict]], str]]:
+        with self._lock:
+            ids = self._changed_since(since)
+            if ids is None:
+                return None
+            records = {id: self._index.get(id) for id in ids}
+            token = self.version()[0]
+        return {id: dict(r) if r is not None else None for id, r in records.items()}, token
+
+    def published(self, since: Optional[str]) -> Tuple[Iterable[Dict], str, Optional[List[str]]]:
+        """
+        What a snapshot publishes, consistent: the records, the version
+        and the ids written since the version ``since`` (None if unknown).
+        """
+        with self._lock:
+            return self._index.values(), self.version()[0], self._changed_since(since) if since else None
+
+    def insert(self, record: Dict) -> Dict:
+        with self._lock:
+            check_new([record], lambda id: self._current(id) is not None)
+            committed = self._append([{"op": "create", "record": dict(record)}], {record["id"]: dict(record)})
+        self._commit(committed)
+        return dict(record)
+
+    def insert_many(self, records: List[Dict]) -> List[Dict]:
+        if not records:
+            return []
+        with self._lock:
+            check_new(records, lambda id: self._current(id) is not None)
+            # one log append (and one fsync) for the whole batch
+            committed = self._append([{"op": "create", "record": dict(r)} for r in records],
+                                     {r["id"]: dict(r) for r in records})
+        self._commit(committed)
+        return [dict(r) for r in records]
+
+    def update(
+        self,
+        id: str,
+        changes: Dict,
+        where: Optional[Callable[[Dict], bool]] = None,
+    ) -> Optional[Dict]:
+        with self._lock:
+            record = self._current(id)
+            if record is None or (where is not None and not where(record)):
+                return None
+            record = dict(record, **changes)
+            op = "delete" if "deleted_at" in changes else "update"
+            committed = self._append([{"op": op, "id": id, "changes": changes}], {id: record})
+        self._commit(committed)
+        return dict(record)
+
+    def remove(self, ids: Iterable[str], where: Optional[Callable[[Dict], bool]] = None) -> List[str]:
+        removed = []
+        with self._lock:
+            for id in dict.fromkeys(ids):
+                record = self._current(id)
+                if record is None or (where is not None and not where(record)):
+                    continue
+                removed.append(id)
+            if not removed:
+                return []
+            committed = self._append([{"op": "remove", "ids": removed}], dict.fromkeys(removed))
+        self._commit(committed)
+        return removed
+
+    def close(self) -> None:
+        if self._compaction is not None:
+            self._compaction.join()
+
+
+class MemoryBackend:
+    """
+    Backend keeping every collection in memory, backed by ``<name>.json``
+    and ``<name>.log``.
+    """
+
+    def __init__(self, data_dir: str, publish: bool = False, checkpoint_seconds: float = WARM_START_SAVE_SECONDS):
+        self.data_dir = data_dir
+        self.publish = publish  # publish snapshots for reader workers
+        self.writer = GroupCommitWriter()
+        self.collections: List[MemoryCollection] = []
+        self._closed = threading.Event()
+        if checkpoint_seconds > 0:
+            threading.Thread(
+                target=self._checkpoints, args=(checkpoint_seconds,), name="warm-start-checkpoints", daemon=True
+            ).start()
+
+    def collection(self, name: str, indexes=()) -> Collection:
+        store = ColumnarTweetIndex if tweet_collection(name) and TWEET_STORE == "columnar" else RecordIndex
+        collection = MemoryCollection(
+            os.path.join(self.data_dir, "{}.json".format(name)), name, indexes, self.writer, store=store
+        )
+        if self.publish:
+            publisher = SnapshotPublisher(snapshot_path(self.data_dir, name), collection.published)
+            collection.listeners.append(publisher.changed)
+        self.collections.append(collection)
+        return collection
+
+    def has_records(self, name: str) -> bool:
+        log_path = os.path.join(self.data_dir, "{}.log".format(name))
+        return (next(iter_json_array(os.path.join(self.data_dir, "{}.json".format(name))), None) is not None
+                or os.path.exists(log_path) and os.path.getsize(log_path) > 0)
+
+    def _checkpoints(self, interval: float) -> None:
+        while not self._closed.wait(interval):
+            for collection in self.collections:
+                collection.checkpoint()
+
+    def close(self) -> None:
+        """
+        Commit the queued writes, then save every collection for a warm
+        start.
+        """
+        self._closed.set()
+        for collection in self.collections:
+            collection.close()
+        self.writer.close()
+        for collection in self.collections:
+            collection.checkpoint()
@@ -0,0 +1,503 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import ExitStack
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from storage.base import Collection, DuplicateId, ReadOnlyError, check_new
+
+SCHEMES = ("author", "month")
+ID_LOCKS = 64  # stripes of the locks taken by id while inserting
+TOKENS_KEPT = 64  # versions whose partition versions are kept for changes()
+RECHECK_MS = 1000  # partitions checked for the ids written by other processes
+MONTH = re.compile(r"(\d{4})-(\d{2})")
+
+
+def tweet_collection(name: str) -> bool:
+    """
+    Whether ``name`` is the tweets collection or one of its partitions.
+    """
+    return name == "tweets" or name.startswith("tweets_")
+
+
+def manifest_path(data_dir: str, name: str) -> str:
+    return os.path.join(data_dir, "{}.partitions".format(name))
+
+
+def parse_scheme(text: str) -> Tuple[str, ...]:
+    """
+    ``"author,month"`` to ``("author", "month")``, () for no partitions.
+    """
+    fields = {part.strip() for part in text.split(",") if part.strip()}
+    unknown = fields - set(SCHEMES)
+    if unknown:
+        raise ValueError("Unknown partition scheme: {}".format(", ".join(sorted(unknown))))
+    return tuple(field for field in SCHEMES if field in fields)
+
+
+class Layout:
+    """
+    How the records are split: by a hash of ``created_by`` into
+    ``buckets`` (``author``), by the month of ``created_at`` (``month``)
+    or both. Each partition has a key (``m2021_03_a5of8``), the records
+    of a partition are stored in the collection ``<name>_<key>``. Keys
+    sort month first: the partitions of a month are next to each other.
+    """
+
+    def __init__(self, scheme: Tuple[str, ...], buckets: int = 1):
+        self.scheme = scheme
+        self.buckets = buckets if "author" in scheme else 1
+        self._width = len(str(self.buckets - 1))
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Layout) and (self.scheme, self.buckets) == (other.scheme, other.buckets)
+
+    def __str__(self) -> str:
+        if not self.scheme:
+            return "none"
+        return ",".join(self.scheme) + (" ({} buckets)".format(self.buckets) if "author" in self.scheme else "")
+
+    def bucket(self, author) -> str:
+        # crc32, not hash(): the same in every process and every run
+        number = zlib.crc32(str(author).encode("utf-8")) % self.buckets
+        return "a{:0{}d}of{}".format(number, self._width, self.buckets)
+
+    def key(self, record: Dict) -> str:
+        parts = []
+        if "month" in self.scheme:
+            match = MONTH.match(record.get("created_at") or "")
+            parts.append("m{}_{}".format(*match.groups()) if match else "m0000_00")
+        if "author" in self.scheme:
+            parts.append(self.bucket(record.get("created_by")))
+        return "_".join(parts)
+
+    def author_keys(self, keys: Iterable[str], author) -> List[str]:
+        """
+        The keys of ``keys`` that can hold tweets of ``author``.
+        """
+        if "author" not in self.scheme:
+            return list(keys)
+        bucket = self.bucket(author)
+        return [key for key in keys if key.endswith(bucket)]
+
+
+def read_manifest(path: str) -> Optional[Dict]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(path: str, manifest: Dict) -> None:
+    tmp = "{}.tmp".format(path)
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def manifest_layout(manifest: Dict) -> Layout:
+    return Layout(tuple(manifest["scheme"]), manifest["buckets"])
+
+
+class PartitionedCollection(Collection):
+    """
+    A collection split in partitions (see Layout), each one a collection
+    of the backend: a file of the json and memory backends, a table of
+    sqlite. A write goes to the partition of its record only (its file,
+    its lock); reads by author open the partitions of the author's bucket
+    only. Records are in partition order (month by month), then in
+    insertion order: pages start from the partition of their cursor.
+
+    The manifest ``<name>.partitions`` (JSON) maps the partition keys to
+    their collection. A partition is added to it (under a file lock) on
+    the first write of a new month; the other processes notice it with a
+    ``stat``. The partition of a record never changes; moving records to
+    another layout is the job of ``rebalance`` (app stopped). The
+    manifest is written with the first partition.
+
+    Finding the partition of an id: the partition of every id is kept
+    in memory (read on first use), so a write or a lookup by id opens
+    one partition only. Our own writes keep it current. The writes of
+    other processes (or a file edited on disk) are read from the
+    partitions whose version moved (their changes, or all their ids),
+    checked at most every ``recheck_ms``, and right away when an id is
+    not found. An insert checks that its ids are used by no partition
+    under the locks of the ids' stripes, so two inserts of one id in two
+    partitions of this process can't both pass.
+    """
+
+    def __init__(self, backend, path: str, name: str, indexes, layout: Layout, recheck_ms: float = RECHECK_MS):
+        super().__init__(name, indexes)
+        self.backend = backend
+        self.path = path
+        self.layout = layout
+        self.read_only = getattr(backend, "read_only", False)
+        self._partitions: Dict[str, Collection] = {}
+        self._keys: List[str] = []
+        self._stat: Optional[Tuple[int, int]] = None
+        self._lock = threading.RLock()
+        self.recheck = recheck_ms / 1000
+        self._where: Optional[Dict[str, str]] = None  # id -> key
+        self._synced: Dict[str, str] = {}  # key -> version of the partition in _where
+        self._checked = 0.0
+        self._id_locks = [threading.Lock() for _ in range(ID_LOCKS)]
+        self._tokens: "OrderedDict[str, Dict[str, str]]" = OrderedDict()  # version -> key -> partition version
+        self._current()
+
+    # partitions
+
+    def _open(self, manifest: Dict) -> None:
+        for key, collection in manifest["partitions"].items():
+            if key not in self._partitions:
+                self._partitions[key] = self.backend.collection(collection, self.indexes)
+        self._keys = sorted(self._partitions)
+
+    def _current(self) -> List[str]:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return self._keys
+        if (st.st_ino, st.st_mtime_ns) != self._stat:
+            with self._lock:
+                if (st.st_ino, st.st_mtime_ns) != self._stat:
+                    manifest = read_manifest(self.path)
+                    if manifest is not None:
+                        self._open(manifest)
+                    self._stat = (st.st_ino, st.st_mtime_ns)
+        return self._keys
+
+    def _partition(self, key: str) -> Collection:
+        partition = self._partitions.get(key)
+        if partition is not None:
+            return partition
+        if self.read_only:
+            raise ReadOnlyError(self.name)
+        with self._lock, open("{}.lock".format(self.path), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # other processes adding partitions too
+            manifest = read_manifest(self.path) or {
+                "scheme": list(self.layout.scheme), "buckets": self.layout.buckets, "partitions": {}}
+            if key not in manifest["partitions"]:
+                manifest["partitions"][key] = "{}_{}".format(self.name, key)
+                write_manifest(self.path, manifest)
+            self._open(manifest)
+        return self._partitions[key]
+
+    def partitions(self) -> List[Tuple[str, Collection]]:
+        """
+        ``(key, collection)`` of every partition, in order.
+        """
+        return [(key, self._partitions[key]) for key in self._current()]
+
+    def _candidates(self, field: Optional[str], value) -> List[str]:
+        keys = self._current()
+        if field == "created_by":
+            return self.layout.author_keys(keys, value)
+        return keys
+
+    # locating ids
+
+    def _sync(self, key: str) -> None:
+        # the ids of a partition written since _where was current for it
+        partition = self._partitions[key]
+        version = partition.version()[0]
+        since = self._synced.get(key)
+        if since == version:
+            return
+        changed = partition.changes(since) if since is not None else None
+        if changed is not None:
+            for id, record in changed[0].items():
+                if record is not None:
+                    self._where[id] = key
+                elif self._where.get(id) == key:
+                    del self._where[id]
+            self._synced[key] = changed[1]
+            return
+        ids = {r["id"] for r in partition.scan()}
+        if since is not None:  # read again whole: forget the ids gone
+            for id in [id for id, k in self._where.items() if k == key and id not in ids]:
+                del self._where[id]
+        self._where.update(dict.fromkeys(ids, key))
+        self._synced[key] = version
+
+    def _ids(self, force: bool = False) -> Dict[str, str]:
+        """
+        The partition of every id, checked against the partitions at most
+        every ``recheck`` seconds (``force``: now).
+        """
+        where = self._where
+        if where is not None and not force and time.monotonic() - self._checked < self.recheck:
+            return where
+        keys = self._current()
+        with self._lock:
+            if self._where is None:
+                self._where = {}
+            for key in keys:
+                self._sync(key)
+            self._checked = time.monotonic()
+            return self._where
+
+    def _locate(self, id: str) -> Optional[str]:
+        """
+        The key of the partition holding ``id``.
+        """
+        key = self._ids().get(id)
+        if key is None:  # written by another process since the last check?
+            key = self._ids(force=True).get(id)
+        return key
+
+    def _group(self, ids: Iterable[str]) -> Dict[str, List[str]]:
+        ids = list(dict.fromkeys(ids))
+        where = self._ids()
+        if any(id not in where for id in ids):  # checked again once for all
+            where = self._ids(force=True)
+        groups: Dict[str, List[str]] = {}
+        for id in ids:
+            key = where.get(id)
+            if key is not None:
+                groups.setdefault(key, []).append(id)
+        return groups
+
+    def _inserting(self, records: List[Dict]) -> ExitStack:
+        # the locks of the ids' stripes, always taken in the same order
+        stack = ExitStack()
+        for stripe in sorted({zlib.crc32(r["id"].encode("utf-8")) % ID_LOCKS for r in records}):
+            stack.enter_context(self._id_locks[stripe])
+        return stack
+
+    def _check_new(self, records: List[Dict]) -> None:
+        # DuplicateId if an id is repeated or used by any partition,
+        # before anything is written
+        check_new(records, lambda id: False)
+        where = self._ids()
+        for record in records:
+            if record["id"] in where:
+                raise DuplicateId(record["id"])
+
+    def _wrote(self, key: str, ids: Iterable[str], before: str, removed: bool = False) -> None:
+        # keep _where current after our own write (see ActiveUserSet.apply
+        # for ``before``)
+        with self._lock:
+            if self._where is None:
+                return
+            for id in ids:
+                if not removed:
+                    self._where[id] = key
+                elif self._where.get(id) == key:
+                    del self._where[id]
+            if self._synced.get(key) == before:
+                self._synced[key] = self._partitions[key].version()[0]
+
+    # reads
+
+    def get(self, id: str) -> Optional[Dict]:
+        key = self._locate(id)
+        return self._partitions[key].get(id) if key is not None else None
+
+    def get_many(self, ids: Iterable[str]) -> Dict[str, Dict]:
+        found: Dict[str, Dict] = {}
+        for key, group in self._group(ids).items():
+            found.update(self._partitions[key].get_many(group))
+        return found
+
+    def find(self, field: str, value: str) -> List[Dict]:
+        records = []
+        for key in self._candidates(field, value):
+            records.extend(self._partitions[key].find(field, value))
+        return records
+
+    def page(self, limit, after=None, field=None, value=None, reverse=False) -> List[Dict]:
+        keys = self._candidates(field, value)
+        if reverse:
+            keys = keys[::-1]
+        records: List[Dict] = []
+        if after is not None:
+            key = self._locate(after)
+            if key is None or key not in keys:
+                raise KeyError(after)
+            start = keys.index(key)
+            records = self._partitions[key].page(limit, after, field, value, reverse)
+            keys = keys[start + 1:]
+        for key in keys:
+            if len(records) >= limit:
+                break
+            records.extend(self._partitions[key].page(limit - len(records), None, field, value, reverse))
+        return records
+
+    def scan(self) -> Iterator[Dict]:
+        for key in list(self._current()):
+            yield from self._partitions[key].scan()
+
+    def version(self, id: Optional[str] = None) -> Tuple[str, float]:
+        if id is not None:
+            key = self._locate(id)
+            if key is not None:
+                token, modified = self._partitions[key].version(id)
+                return "{}.{}".format(key, token), modified
+        versions = [(key, self._partitions[key].version()) for key in self._current()]
+        digest = hashlib.blake2b(digest_size=8)
+        for key, (token, _) in versions:
+            digest.update("{}={};".format(key, token).encode("utf-8"))
+        token = digest.hexdigest()
+        with self._lock:
+            self._tokens[token] = {key: partition_token for key, (partition_token, _) in versions}
+            self._tokens.move_to_end(token)
+            if len(self._tokens) > TOKENS_KEPT:
+                self._tokens.popitem(last=False)
+        return token, max((modified for _, (_, modified) in versions), default=0.0)
+
+    def changes(self, since: str) -> Optional[Tuple[Dict[str, Optional[Dict]], str]]:
+        # the changes of each partition since its version at ``since``
+        # (a recent version of this process), a new partition is read whole
+        with self._lock:
+            before = self._tokens.get(since)
+        if before is None:
+            return None
+        token = self.version()[0]
+        with self._lock:
+            now = self._tokens.get(token)
+        if now is None:
+            return None
+        records: Dict[str, Optional[Dict]] = {}
+        for key, current in now.items():
+            old = before.get(key)
+            if old == current:
+                continue
+            if old is None:
+                records.update((r["id"], r) for r in self._partitions[key].scan())
+                continue
+            changed = self._partitions[key].changes(old)
+            if changed is None:
+                return None
+            records.update(changed[0])
+        return records, token
+
+    # writes
+
+    def insert(self, record: Dict) -> Dict:
+        key = self.layout.key(record)
+        partition = self._partition(key)
+        with self._inserting([record]):
+            self._check_new([record])
+            before = partition.version()[0]
+            record = partition.insert(record)
+            self._wrote(key, [record["id"]], before)
+        return record
+
+    def insert_many(self, records: List[Dict]) -> List[Dict]:
+        groups: Dict[str, List[Dict]] = {}
+        for record in records:
+            groups.setdefault(self.layout.key(record), []).append(record)
+        partitions = {key: self._partition(key) for key in groups}
+        with self._inserting(records):
+            self._check_new(records)
+            for key, group in groups.items():
+                before = partitions[key].version()[0]
+                partitions[key].insert_many(group)
+                self._wrote(key, [r["id"] for r in group], before)
+        return [dict(r) for r in records]
+
+    def update(
+        self,
+        id: str,
+        changes: Dict,
+        where: Optional[Callable[[Dict], bool]] = None,
+    ) -> Optional[Dict]:
+        if self.read_only:
+            raise ReadOnlyError(self.name)
+        key = self._locate(id)
+        if key is None:
+            return None
+        if "created_by" in changes or "created_at" in changes:
+            current = self._partitions[key].get(id)
+            if current is not None and self.layout.key(dict(current, **changes)) != key:
+                raise ValueError("{}: the partition of {} can't change".format(self.name, id))
+        return self._partitions[key].update(id, changes, where)
+
+    def remove(self, ids: Iterable[str], where: Optional[Callable[[Dict], bool]] = None) -> List[str]:
+        if self.read_only:
+            raise ReadOnlyError(self.name)
+        removed = []
+        for key, group in self._group(ids).items():
+            partition = self._partitions[key]
+            before = partition.version()[0]
+            done = partition.remove(group, where)
+            self._wrote(key, done, before, removed=True)
+            removed.extend(done)
+        return removed
+
+    def compact(self, wait: bool = True) -> None:
+        for _, partition in self.partitions():
+            partition.compact(wait)
+
+    def close(self) -> None:
+        for _, partition in self.partitions():
+            partition.close()
+
+
+def rebalance(backend, data_dir: str, name: str, indexes, layout: Layout, batch: int = 1000) -> Dict[str, int]:
+    """
+    Move every record of ``name`` to the partitions of ``layout`` (no
+    partitions: the single collection ``name``), from the current
+    layout, and return the records per new partition. Run with the app
+    stopped.
+
+    The records are copied first (a new manifest is built next to the
+    current one), then the new manifest replaces the current one, then
+    the old partitions are emptied. Interrupted, it can be run again:
+    records already copied are skipped.
+    """
+    path = manifest_path(data_dir, name)
+    manifest = read_manifest(path)
+    current = manifest_layout(manifest) if manifest is not None else Layout(())
+    if current == layout:
+        return {}
+    if manifest is not None:
+        sources = [backend.collection(collection, indexes) for _, collection in sorted(manifest["partitions"].items())]
+    else:
+        sources = [backend.collection(name, indexes)]
+
+    pending = "{}.new".format(path)
+    if layout.scheme:
+        if os.path.exists(pending) and manifest_layout(read_manifest(pending)) != layout:
+            os.remove(pending)  # left by an interrupted rebalance to another layout
+        target = PartitionedCollection(backend, pending, name, indexes, layout)
+    else:
+        target = backend.collection(name, indexes)
+    copied = {r["id"] for r in target.scan()}
+    for source in sources:
+        records = []
+        for record in source.scan():
+            if record["id"] not in copied:
+                records.append(record)
+            if len(records) == batch:
+                target.insert_many(records)
+                records = []
+        if records:
+            target.insert_many(records)
+
+    if layout.scheme:
+        if not os.path.exists(pending):  # nothing to move
+            write_manifest(pending, {"scheme": list(layout.scheme), "buckets": layout.buckets, "partitions": {}})
+        os.replace(pending, path)
+        if os.path.exists("{}.lock".format(pending)):
+            os.remove("{}.lock".format(pending))
+        counts = {collection: 0 for collection in read_manifest(path)["partitions"].values()}
+        for key, partition in target.partitions():
+            counts["{}_{}".format(name, key)] = sum(1 for _ in partition.scan())
+    else:
+        os.remove(path)
+        counts = {name: sum(1 for _ in target.scan())}
+    for source in sources:
+        ids = [r["id"] for r in source.scan()]
+        for start in range(0, len(ids), batch):
+            source.remove(ids[start:start + batch])
+    return counts
@@ -0,0 +1,431 @@
+import base64
+import binascii
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from config import ACTIVE_USERS_RECHECK_MS
+from profiling import phase
+
+from storage.base import Collection, DuplicateId
+from storage.cold import ColdTier
+from storage.search import SearchIndex
+
+
+class InvalidCursor(ValueError):
+    """
+    Raised when a page cursor can't be decoded or points nowhere.
+    """
+
+
+def encode_cursor(id: str) -> str:
+    return base64.urlsafe_b64encode(id.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> str:
+    try:
+        return base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+    except (binascii.Error, UnicodeDecodeError):
+        raise InvalidCursor(cursor)
+
+
+def _active(record: Dict) -> bool:
+    return record["deleted_at"] is None
+
+
+def _cold_ids(cold: Optional[ColdTier], ids: Iterable[str]) -> Set[str]:
+    # the ids of records moved to the cold tier: still used
+    if cold is None:
+        return set()
+    with phase("cold"):
+        return {id for id in ids if cold.get(id) is not None}
+
+
+def _check_not_cold(cold: Optional[ColdTier], records: List[Dict]) -> None:
+    # the collection only knows the hot ids
+    for id in _cold_ids(cold, [r["id"] for r in records]):
+        raise DuplicateId(id)
+
+
+def _thaw(collection: Collection, cold: Optional[ColdTier], id: str, where: Callable[[Dict], bool]) -> bool:
+    # put a record moved to the cold tier back in the collection, when
+    # ``where`` accepts it, so that it can be written again. Its cold
+    # copy stays: the hot one wins, and the newest copy wins once it is
+    # moved again
+    if cold is None or collection.get(id) is not None:
+        return False
+    with phase("cold"):
+        record = cold.get(id)
+    if record is None or not where(record):
+        return False
+    try:
+        collection.insert(record)
+    except DuplicateId:
+        pass  # put back by a concurrent write
+    return True
+
+
+def _page(collection: Collection, limit: int, cursor: Optional[str], **kwargs) -> Tuple[List[Dict], Optional[str]]:
+    """
+    A page of live records and the cursor of the next one (None on the
+    last page). One extra record is fetched to know if there is more.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    try:
+        with phase("scan"):
+            records = collection.page(limit + 1, after, **kwargs)
+    except KeyError:
+        raise InvalidCursor(cursor)
+    if len(records) > limit:
+        return records[:limit], encode_cursor(records[limit - 1]["id"])
+    return records, None
+
+
+class ActiveUserSet:
+    """
+    Ids of the active users, kept in memory: checking the author of a
+    tweet is a set lookup, not a storage read.
+
+    The writes of this process update the set right away (see
+    ``apply``). Changes made elsewhere (another process, the file edited
+    on disk) are noticed through the version of the collection, checked
+    at most every ``recheck_ms``: when it moved, the set is loaded again.
+    """
+
+    def __init__(self, collection: Collection, recheck_ms: float = ACTIVE_USERS_RECHECK_MS):
+        self.collection = collection
+        self.recheck = recheck_ms / 1000
+        self._ids: Optional[Set[str]] = None
+        self._version: Optional[str] = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def _current(self) -> Set[str]:
+        ids = self._ids
+        if ids is not None and time.monotonic() - self._checked < self.recheck:
+            return ids
+        with self._lock:
+            version = self.collection.version()[0]
+            if self._ids is None or version != self._version:
+                self._ids = {u["id"] for u in self.collection.scan() if _active(u)}
+                self._version = version
+            self._checked = time.monotonic()
+            return self._ids
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._current()
+
+    def apply(self, user_id: str, active: bool, before: str) -> None:
+        """
+        Record a write of this process. ``before`` is the version of the
+        collection just before the write: if the set was current then,
+        it is still current now, no need to load it again.
+        """
+        with self._lock:
+            if self._ids is None:
+                return
+            if active:
+                self._ids.add(user_id)
+            else:
+                self._ids.discard(user_id)
+            if before == self._version:
+                self._version = self.collection.version()[0]
+
+
+class UserRepository:
+    """
+    Access to the users, whatever the backend is. Deleted users are
+    eventually moved to ``cold`` (see storage.tiering), never read back;
+    a write to a user found there puts it back first.
+    """
+
+    def __init__(self, collection: Collection, cold: Optional[ColdTier] = None):
+        self.collection = collection
+        self.cold = cold
+        self.active_ids = ActiveUserSet(collection)
+
+    def exists(self, user_id: str) -> bool:
+        return self.collection.get(user_id) is not None
+
+    def is_active(self, user_id: str) -> bool:
+        """
+        Whether ``user_id`` is an active (not deleted) user, from memory.
+        """
+        return user_id in self.active_ids
+
+    def active(self, user_ids: Iterable[str]) -> Set[str]:
+        """
+        The ids of ``user_ids`` that are active users, from memory.
+        """
+        return {id for id in user_ids if id in self.active_ids}
+
+    def get(self, user_id: str) -> Optional[Dict]:
+        """
+        Return the active user with the given id or None.
+        """
+        user = self.collection.get(user_id)
+        if user is not None and _active(user):
+            return user
+        return None
+
+    def get_by_email(self, email: str) -> Optional[Dict]:
+        """
+        Return the active user with the given email or None.
+        """
+        for user in self.collection.find("email", email):
+            if _active(user):
+                return user
+        return None
+
+    def list(self) -> List[Dict]:
+        with phase("scan"):
+            return list(self.iter_active())
+
+    def iter_active(self) -> Iterator[Dict]:
+        return (u for u in self.collection.scan() if _active(u))
+
+    def page(self, limit: int, cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        return _page(self.collection, limit, cursor)
+
+    def create(self, user: Dict) -> Dict:
+        """
+        DuplicateId if the id is used, by a hot or a cold user.
+        """
+        _check_not_cold(self.cold, [user])
+        before = self.collection.version()[0]
+        user = self.collection.insert(user)
+        self.active_ids.apply(user["id"], _active(user), before)
+        return user
+
+    def update(self, user_id: str, changes: Dict) -> Optional[Dict]:
+        before = self.collection.version()[0]
+        user = self.collection.update(user_id, changes, where=_active)
+        if user is None and _thaw(self.collection, self.cold, user_id, _active):
+            user = self.collection.update(user_id, changes, where=_active)
+        if user is not None:
+            self.active_ids.apply(user_id, _active(user), before)
+        return user
+
+    def delete(self, user_id: str, deleted_at: str) -> Optional[Dict]:
+        return self.update(user_id, {"deleted_at": deleted_at})
+
+
+class TweetRepository:
+    """
+    Access to the tweets, whatever the backend is. Deleted and old
+    tweets are moved to ``cold`` (see storage.tiering): ``get`` still
+    finds them there, nothing else does. Updating or deleting a tweet
+    found there puts it back first.
+    """
+
+    def __init__(self, collection: Collection, search_index: Optional[SearchIndex] = None,
+                 cold: Optional[ColdTier] = None):
+        self.collection = collection
+        self.cold = cold
+        self.search_index = search_index
+        # called after each write of this process with the tweets written,
+        # the version of the collection before the write and whether the
+        # tweets are new
+        self.listeners: List[Callable[[List[Dict], str, bool], None]] = []
+        if search_index is not None:
+            self.listeners.append(lambda tweets, before, created: search_index.apply(tweets, before))
+
+    def get(self, tweet_id: str) -> Optional[Dict]:
+        tweet = self.collection.get(tweet_id)
+        if tweet is None and self.cold is not None:
+            with phase("cold"):
+                tweet = self.cold.get(tweet_id)
+        return tweet
+
+    def get_many(self, tweet_ids: Iterable[str]) -> Dict[str, Dict]:
+        return self.collection.get_many(tweet_ids)
+
+    def used(self, tweet_ids: Iterable[str]) -> Set[str]:
+        """
+        The ids of ``tweet_ids`` already used, by a hot or a cold tweet.
+        """
+        tweet_ids = list(tweet_ids)
+        used = set(self.collection.get_many(tweet_ids))
+        return used | _cold_ids(self.cold, [id for id in tweet_ids if id not in used])
+
+    def list(self) -> List[Dict]:
+        with phase("scan"):
+            return list(self.iter_active())
+
+    def iter_active(self) -> Iterator[Dict]:
+        return (t for t in self.collection.scan() if _active(t))
+
+    def page(self, limit: int, cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        return _page(self.collection, limit, cursor)
+
+    def by_author(self, user_id: str, limit: int, cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """
+        Active tweets of a user, newest first.
+        """
+        return _page(self.collection, limit, cursor, field="created_by", value=user_id, reverse=True)
+
+    def search(self, query: str, limit: int, order: str = "relevance") -> List[Dict]:
+        """
+        Active tweets containing every word of ``query``, best first
+        (``relevance``) or newest first (``recent``).
+        """
+        ids = self.search_index.search(query, limit, order)
+        found = self.collection.get_many(ids)
+        return [found[id] for id in ids if id in found and _active(found[id])]
+
+    def _written(self, tweets: List[Dict], before: str, created: bool) -> None:
+        for listener in self.listeners:
+            listener(tweets, before, created)
+
+    def create(self, tweet: Dict) -> Dict:
+        """
+        DuplicateId if the id is used, by a hot or a cold tweet.
+        """
+        _check_not_cold(self.cold, [tweet])
+        before = self.collection.version()[0]
+        tweet = self.collection.insert(tweet)
+        self._written([tweet], before, True)
+        return tweet
+
+    def create_many(self, tweets: List[Dict]) -> List[Dict]:
+        _check_not_cold(self.cold, tweets)
+        before = self.collection.version()[0]
+        tweets = self.collection.insert_many(tweets)
+        self._written(tweets, before, True)
+        return tweets
+
+    def update(self, tweet_id: str, user_id: str, changes: Dict) -> Optional[Dict]:
+        """
+        Update an active tweet, only if it was created by ``user_id``.
+        """
+        before = self.collection.version()[0]
+        where = lambda t: _active(t) and t["created_by"] == user_id
+        tweet = self.collection.update(tweet_id, changes, where=where)
+        if tweet is None and _thaw(self.collection, self.cold, tweet_id, where):
+            tweet = self.collection.update(tweet_id, changes, where=where)
+        if tweet is not None:
+            self._written([tweet], before, False)
+        return tweet
+
+    def delete(self, tweet_id: str, user_id: str, deleted_at: str) -> Optional[Dict]:
+        return self.update(tweet_id, user_id, {"deleted_at": deleted_at})
+
+
+def follow_id(follower_id: str, followed_id: str) -> str:
+    return "{}:{}".format(follower_id, followed_id)
+
+
+class FollowGraph:
+    """
+    Who follows whom, as adjacency sets in memory (both directions).
+
+    Loaded from the follows collection and loaded again when its version
+    moves, except for the writes of this process, applied in place.
+    """
+
+    def __init__(self, collection: Collection):
+        self.collection = collection
+        self._following: Dict[str, Set[str]] = {}
+        self._followers: Dict[str, Set[str]] = {}
+        self._version: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def _current(self) -> None:
+        version = self.collection.version()[0]
+        if version == self._version:
+            return
+        with self._lock:
+            if version == self._version:
+                return
+            following: Dict[str, Set[str]] = {}
+            followers: Dict[str, Set[str]] = {}
+            for follow in self.collection.scan():
+                if _active(follow):
+                    following.setdefault(follow["follower_id"], set()).add(follow["followed_id"])
+                    followers.setdefault(follow["followed_id"], set()).add(follow["follower_id"])
+            self._following, self._followers, self._version = following, followers, version
+
+    def following(self, user_id: str) -> Set[str]:
+        self._current()
+        return set(self._following.get(user_id, ()))
+
+    def followers(self, user_id: str) -> Set[str]:
+        self._current()
+        return set(self._followers.get(user_id, ()))
+
+    def follower_count(self, user_id: str) -> int:
+        self._current()
+        return len(self._followers.get(user_id, ()))
+
+    def apply(self, follower_id: str, followed_id: str, active: bool, before: str) -> None:
+        """
+        Record a follow (``active``) or unfollow of this process, see
+        ActiveUserSet.apply for ``before``.
+        """
+        with self._lock:
+            if self._version is None:
+                return
+            if active:
+                self._following.setdefault(follower_id, set()).add(followed_id)
+                self._followers.setdefault(followed_id, set()).add(follower_id)
+            else:
+                self._following.get(follower_id, set()).discard(followed_id)
+                self._followers.get(followed_id, set()).discard(follower_id)
+            if before == self._version:
+                self._version = self.collection.version()[0]
+
+
+class FollowRepository:
+    """
+    Follows between users: one record per (follower, followed) pair, an
+    unfollow sets its ``deleted_at``, following again clears it.
+    """
+
+    def __init__(self, collection: Collection):
+        self.collection = collection
+        self.graph = FollowGraph(collection)
+        # called after each follow / unfollow of this process with
+        # (follower_id, followed_id, active, version before the write)
+        self.listeners: List[Callable[[str, str, bool, str], None]] = []
+
+    def _written(self, follower_id: str, followed_id: str, active: bool, before: str) -> None:
+        self.graph.apply(follower_id, followed_id, active, before)
+        for listener in self.listeners:
+            listener(follower_id, followed_id, active, before)
+
+    def follow(self, follower_id: str, followed_id: str, created_at: str) -> Tuple[Dict, bool]:
+        """
+        Start following, return the follow and whether it is new. Of two
+        concurrent follows of the same pair only one is new: the record
+        is inserted (the id is the pair) or reactivated (``where``) in
+        the critical section of the write.
+        """
+        id = follow_id(follower_id, followed_id)
+        before = self.collection.version()[0]
+        if self.collection.get(id) is None:
+            try:
+                follow = self.collection.insert({
+                    "id": id,
+                    "follower_id": follower_id,
+                    "followed_id": followed_id,
+                    "created_at": created_at,
+                    "deleted_at": None,
+                })
+            except DuplicateId:
+                pass  # inserted meanwhile
+            else:
+                self._written(follower_id, followed_id, True, before)
+                return follow, True
+        follow = self.collection.update(id, {"created_at": created_at, "deleted_at": None},
+                                        where=lambda f: not _active(f))
+        if follow is None:
+            return self.collection.get(id), False
+        self._written(follower_id, followed_id, True, before)
+        return follow, True
+
+    def unfollow(self, follower_id: str, followed_id: str, deleted_at: str) -> Optional[Dict]:
+        before = self.collection.version()[0]
+        follow = self.collection.update(follow_id(follower_id, followed_id), {"deleted_at": deleted_at}, where=_active)
+        if follow is not None:
+            self._written(follower_id, followed_id, False, before)
+        return follow
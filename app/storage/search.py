@@ -0,0 +1,318 @@
+import heapq
+import json
+import math
+import os
+import re
+import threading
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from storage.base import Collection
+
+TOKEN = re.compile(r"\w+")
+BM25_K1 = 1.2
+BM25_B = 0.75
+FORMAT = 1  # of the persisted index
+COMPACT_MIN_DEAD = 10000  # dead documents dropped once they outnumber the live ones
+STATE = ("_ids", "_created", "_stamps", "_lengths", "_postings", "_doc_of", "_total_length")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Case folded words of ``text`` (#hashtags and @mentions give their word).
+    """
+    return TOKEN.findall(text.casefold())
+
+
+def _stamp(tweet: Dict) -> str:
+    # changes every time the content can change (update_a_tweet sets updated_at)
+    return tweet["updated_at"] or tweet["created_at"]
+
+
+def _contains(docs: array, doc: int) -> bool:
+    i = bisect_left(docs, doc)
+    return i < len(docs) and docs[i] == doc
+
+
+class SearchIndex:
+    """
+    Inverted index of the content of the active tweets.
+
+    Every indexed tweet is a document with an increasing number; each
+    term points to the sorted numbers of the documents it appears in,
+    with its frequency there. A query (all its terms must match) walks
+    the shortest posting list and looks the documents up in the others
+    with a binary search: it costs the size of the posting lists, not
+    the number of tweets. Results are ranked with BM25 or by recency.
+
+    An update gives the tweet a new document, the old one (like the one
+    of a deleted tweet) is only marked dead and skipped by queries; dead
+    documents are dropped when the index is saved or once they
+    outnumber the live ones.
+
+    The index is loaded on the first search from ``path`` (saved on
+    shutdown) and brought up to date with the collection: only tweets
+    created, changed or deleted since the save are indexed again. The
+    writes of this process are applied right away (``apply``), changes
+    made elsewhere are noticed through the version of the collection and
+    read with ``Collection.changes``: the tweets written since (on the
+    reader workers, the ids the writer published with each snapshot).
+    Only when the collection can't tell is it read whole, into a copy of
+    the index, while searches and writes keep using the current one;
+    the copy then replaces it.
+    """
+
+    def __init__(self, collection: Collection, path: str):
+        self.collection = collection
+        self.path = path
+        self._lock = threading.RLock()        # the index: queries, writes of this process
+        self._catching_up = threading.Lock()  # one catch up at a time
+        self._loaded = False
+        self._version: Optional[str] = None
+        self._pending: Optional[List[Dict]] = None  # written by this process while the collection is read whole
+        self._clear()
+
+    def _clear(self) -> None:
+        self._ids: List[Optional[str]] = []      # doc -> tweet id, None once dead
+        self._created: List[str] = []            # doc -> created_at (recency)
+        self._stamps: List[str] = []             # doc -> stamp of the indexed version
+        self._lengths = array("I")               # doc -> number of terms
+        self._postings: Dict[str, Tuple[array, array]] = {}  # term -> (docs, frequencies)
+        self._doc_of: Dict[str, int] = {}        # tweet id -> live doc
+        self._total_length = 0
+
+    # maintenance
+
+    def _add(self, tweet: Dict) -> None:
+        doc = len(self._ids)
+        terms = tokenize(tweet["content"])
+        counts: Dict[str, int] = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        for term, count in counts.items():
+            docs, frequencies = self._postings.setdefault(term, (array("I"), array("H")))
+            docs.append(doc)
+            frequencies.append(min(count, 0xFFFF))
+        self._ids.append(tweet["id"])
+        self._created.append(tweet["created_at"])
+        self._stamps.append(_stamp(tweet))
+        self._lengths.append(len(terms))
+        self._doc_of[tweet["id"]] = doc
+        self._total_length += len(terms)
+
+    def _remove(self, tweet_id: str) -> None:
+        doc = self._doc_of.pop(tweet_id, None)
+        if doc is not None:
+            self._ids[doc] = None
+            self._total_length -= self._lengths[doc]
+
+    def _index(self, tweet: Dict) -> None:
+        doc = self._doc_of.get(tweet["id"])
+        if tweet["deleted_at"] is not None:
+            self._remove(tweet["id"])
+        elif doc is None or self._stamps[doc] != _stamp(tweet):
+            self._remove(tweet["id"])
+            self._add(tweet)
+
+    def _copy(self) -> "SearchIndex":
+        # called with the lock held
+        copy = SearchIndex(self.collection, self.path)
+        copy._ids, copy._created, copy._stamps = list(self._ids), list(self._created), list(self._stamps)
+        copy._lengths = self._lengths[:]
+        copy._postings = {term: (docs[:], frequencies[:]) for term, (docs, frequencies) in self._postings.items()}
+        copy._doc_of = dict(self._doc_of)
+        copy._total_length = self._total_length
+        return copy
+
+    def _current(self) -> None:
+        """
+        Bring the index up to date with the collection if its version
+        moved. While another search does it, a loaded index answers as
+        it is; the first search waits for the load.
+        """
+        if self._loaded and self.collection.version()[0] == self._version:
+            return
+        if not self._catching_up.acquire(blocking=not self._loaded):
+            return
+        try:
+            if not self._loaded or self.collection.version()[0] != self._version:
+                self._catch_up()
+        finally:
+            self._catching_up.release()
+
+    def _catch_up(self) -> None:
+        # the tweets written since the version indexed, if the collection
+        # can tell, else the whole collection
+        since = self._version
+        changed = self.collection.changes(since) if self._loaded and since is not None else None
+        if changed is None:
+            self._rebuild()
+            return
+        tweets, version = changed
+        with self._lock:
+            if self._version != since:
+                return  # a write of this process came meanwhile: it may be newer, the next search catches up
+            for tweet_id, tweet in tweets.items():
+                if tweet is None:
+                    self._remove(tweet_id)
+                else:
+                    self._index(tweet)
+            self._version = version
+            self._compact_if_needed()
+
+    def _rebuild(self) -> None:
+        """
+        Read the whole collection into a copy of the index (the saved
+        index on the first load), outside the lock: only the tweets that
+        changed are tokenized. The writes of this process made meanwhile
+        are applied to the copy too, then it replaces the index.
+        """
+        with self._lock:
+            fresh = self._copy() if self._loaded else None
+            self._pending = []
+        try:
+            if fresh is None:
+                fresh = SearchIndex(self.collection, self.path)
+                fresh._load()
+            version = self.collection.version()[0]
+            seen = set()
+            for tweet in self.collection.scan():
+                seen.add(tweet["id"])
+                fresh._index(tweet)
+            for tweet_id in [id for id in fresh._doc_of if id not in seen]:
+                fresh._remove(tweet_id)
+            with self._lock:
+                for tweet in self._pending:
+                    fresh._index(tweet)
+                for name in STATE:
+                    setattr(self, name, getattr(fresh, name))
+                self._version = version
+                self._loaded = True
+                self._compact_if_needed()
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def apply(self, tweets: Iterable[Dict], before: str) -> None:
+        """
+        Index the tweets just written by this process. ``before`` is the
+        version of the collection before the write: if the index was
+        current then, it is still current now.
+        """
+        tweets = list(tweets)
+        with self._lock:
+            if self._pending is not None:
+                self._pending.extend(tweets)
+            if not self._loaded:
+                return  # the first search catches up with the collection
+            for tweet in tweets:
+                self._index(tweet)
+            if before == self._version:
+                self._version = self.collection.version()[0]
+            self._compact_if_needed()
+
+    # queries
+
+    def search(self, query: str, limit: int, order: str = "relevance") -> List[str]:
+        """
+        Ids of the (at most ``limit``) active tweets containing every term
+        of ``query``, best first: by BM25 (``relevance``) or newest first
+        (``recent``).
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        self._current()
+        with self._lock:
+            postings = [self._postings.get(term) for term in terms]
+            if not postings or any(p is None for p in postings):
+                return []
+            postings.sort(key=lambda p: len(p[0]))
+            shortest, others = postings[0], postings[1:]
+            matches = [
+                (doc, i) for i, doc in enumerate(shortest[0])
+                if self._ids[doc] is not None and all(_contains(p[0], doc) for p in others)
+            ]
+            if order == "recent":
+                best = heapq.nlargest(limit, matches, key=lambda m: (self._created[m[0]], m[0]))
+                return [self._ids[doc] for doc, _ in best]
+            scores = self._bm25(postings, matches)
+            best = heapq.nlargest(limit, range(len(matches)), key=lambda k: (scores[k], matches[k][0]))
+            return [self._ids[matches[k][0]] for k in best]
+
+    def _bm25(self, postings, matches) -> List[float]:
+        # dead documents stay in the posting lists until the next save,
+        # their frequencies slightly overestimate the document frequency
+        count = len(self._doc_of)
+        average = self._total_length / count if count else 1.0
+        scores = [0.0] * len(matches)
+        for n, (docs, frequencies) in enumerate(postings):
+            df = min(len(docs), count)
+            idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+            for k, (doc, i) in enumerate(matches):
+                if n:
+                    i = bisect_left(docs, doc)
+                tf = frequencies[i]
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[doc] / average)
+                scores[k] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return scores
+
+    # persistence
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        if saved.get("format") == FORMAT:
+            self._restore(saved["docs"], saved["postings"])
+
+    def _restore(self, docs: List[List], postings: Dict[str, List[List[int]]]) -> None:
+        self._clear()
+        for tweet_id, created_at, stamp, length in docs:
+            self._doc_of[tweet_id] = len(self._ids)
+            self._ids.append(tweet_id)
+            self._created.append(created_at)
+            self._stamps.append(stamp)
+            self._lengths.append(length)
+            self._total_length += length
+        for term, (term_docs, frequencies) in postings.items():
+            self._postings[term] = (array("I", term_docs), array("H", frequencies))
+
+    def _compact(self) -> Tuple[List[List], Dict[str, List[List[int]]]]:
+        """
+        Drop the dead documents and renumber the others, return the index
+        in its saved form.
+        """
+        renumber = {}
+        docs = []
+        for doc, tweet_id in enumerate(self._ids):
+            if tweet_id is not None:
+                renumber[doc] = len(docs)
+                docs.append([tweet_id, self._created[doc], self._stamps[doc], self._lengths[doc]])
+        postings = {}
+        for term, (term_docs, frequencies) in self._postings.items():
+            kept = [(renumber[d], f) for d, f in zip(term_docs, frequencies) if d in renumber]
+            if kept:
+                postings[term] = [[d for d, _ in kept], [f for _, f in kept]]
+        self._restore(docs, postings)
+        return docs, postings
+
+    def _compact_if_needed(self) -> None:
+        dead = len(self._ids) - len(self._doc_of)
+        if dead > COMPACT_MIN_DEAD and dead > len(self._doc_of):
+            self._compact()
+
+    def save(self) -> None:
+        """
+        Write the live part of the index to ``path`` (atomically). Nothing
+        to do if the index was never loaded.
+        """
+        with self._lock:
+            if not self._loaded:
+                return
+            docs, postings = self._compact()
+            tmp = "{}.{}.tmp".format(self.path, os.getpid())
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"format": FORMAT, "docs": docs, "postings": postings}, f)
+            os.replace(tmp, self.path)
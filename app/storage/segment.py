@@ -0,0 +1,152 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from metrics import STORAGE_WRITE_BYTES, storage_read
+
+MAGIC = b"TWSEG01\n"
+HEADER = struct.Struct("<8sQQQ")  # magic, generation, records, index offset
+LENGTH = struct.Struct("<I")      # before each record
+ENTRY = struct.Struct("<16sQ")    # index entry: key, record offset
+
+
+def segment_key(id: str) -> bytes:
+    """
+    16 bytes index key of an id: the bytes of a canonical uuid (so keys
+    sort like the ids), a hash of anything else.
+    """
+    try:
+        key = bytes.fromhex(id.replace("-", ""))
+    except ValueError:
+        key = b""
+    if len(key) == 16 and key.hex() == id.replace("-", "") and len(id) == 36:
+        return key
+    return hashlib.blake2b(id.encode("utf-8"), digest_size=16).digest()
+
+
+def encode_record(record: Dict) -> bytes:
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def write_segment(path: str, records: Iterable[Dict], generation: int = 0, sync: bool = True) -> int:
+    """
+    Write ``records`` to a segment file at ``path`` (replaced atomically)
+    and return how many were written.
+
+    Layout: a fixed size header, the records in order (each one a length
+    followed by its JSON), then the index: one fixed size entry
+    ``(key, offset)`` per record, sorted by key. Records are written one
+    at a time, only the index entries are kept in memory.
+    """
+    tmp = "{}.tmp".format(path)
+    entries: List[Tuple[bytes, int]] = []
+    with open(tmp, "wb") as f:
+        f.write(bytes(HEADER.size))
+        offset = HEADER.size
+        for record in records:
+            data = encode_record(record)
+            entries.append((segment_key(record["id"]), offset))
+            f.write(LENGTH.pack(len(data)))
+            f.write(data)
+            offset += LENGTH.size + len(data)
+        entries.sort(key=lambda entry: entry[0])  # stable: same keys stay in file order
+        for key, position in entries:
+            f.write(ENTRY.pack(key, position))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, generation, len(entries), offset))
+        STORAGE_WRITE_BYTES.inc((os.path.basename(path).split(".")[0],), offset + len(entries) * ENTRY.size)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return len(entries)
+
+
+def read_header(path: str) -> Optional[Tuple[int, int, int]]:
+    """
+    ``(generation, records, index offset)`` of the segment at ``path``,
+    None if there is no segment there.
+    """
+    try:
+        with open(path, "rb") as f:
+            magic, generation, count, index = HEADER.unpack(f.read(HEADER.size))
+    except (FileNotFoundError, struct.error):
+        return None
+    return (generation, count, index) if magic == MAGIC else None
+
+
+class Segment:
+    """
+    Read only segment file, mapped in memory.
+
+    Opening it only reads the header. ``get`` is a binary search in the
+    index followed by the decoding of that one record: the rest of the
+    file is never read (the OS pages in what is touched). Iterating
+    decodes the records one at a time, in file order.
+
+    The mapping is kept as long as the object lives, so a reader keeps a
+    consistent view even if the file is replaced meanwhile.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.name = os.path.basename(path).split(".")[0]
+        with open(path, "rb") as f:
+            self.stat = os.fstat(f.fileno())
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.generation, self.count, self.index = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError("{} is not a segment file".format(path))
+        if self.index + self.count * ENTRY.size != len(self._mm):
+            raise ValueError("{} is truncated".format(path))
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _entry(self, i: int) -> Tuple[bytes, int]:
+        return ENTRY.unpack_from(self._mm, self.index + i * ENTRY.size)
+
+    def _record(self, offset: int) -> Dict:
+        (length,) = LENGTH.unpack_from(self._mm, offset)
+        start = offset + LENGTH.size
+        began = time.perf_counter()
+        record = json.loads(self._mm[start:start + length])
+        storage_read(self.name, length, time.perf_counter() - began)
+        return record
+
+    def get(self, id: str) -> Optional[Dict]:
+        key = segment_key(id)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        found = None
+        # hashed keys can collide and a file can repeat an id: check the
+        # ids, the last one wins (as when the records are put in an index)
+        while lo < self.count:
+            entry_key, offset = self._entry(lo)
+            if entry_key != key:
+                break
+            record = self._record(offset)
+            if record["id"] == id:
+                found = record
+            lo += 1
+        return found
+
+    def __iter__(self) -> Iterator[Dict]:
+        offset = HEADER.size
+        for _ in range(self.count):
+            (length,) = LENGTH.unpack_from(self._mm, offset)
+            start = offset + LENGTH.size
+            yield self._record(offset)
+            offset = start + length
+
+    def close(self) -> None:
+        self._mm.close()
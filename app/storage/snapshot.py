@@ -0,0 +1,266 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from config import SNAPSHOT_PUBLISH_MS, TWEET_STORE
+
+from storage.base import Collection, ReadOnlyError
+from storage.columnar import ColumnarTweetIndex
+from storage.index import RecordIndex
+from storage.partitioned import tweet_collection
+from storage.segment import Segment, read_header, write_segment
+
+
+logger = logging.getLogger("uvicorn.error")
+
+CHANGES_GENERATIONS = 64  # generations whose written ids are published
+CHANGES_MAX_IDS = 100000   # ids published at most
+TOKEN = re.compile(r"g([0-9a-f]+)\.")
+RETRY_SECONDS = 1.0  # after a failed publish
+
+
+def snapshot_path(data_dir: str, name: str) -> str:
+    return os.path.join(data_dir, "{}.snapshot".format(name))
+
+
+def changes_path(path: str) -> str:
+    return "{}.changes".format(path)
+
+
+def read_generation(path: str) -> int:
+    """
+    Return the generation of the snapshot at ``path``, 0 if there is none.
+    """
+    header = read_header(path)
+    return header[0] if header is not None else 0
+
+
+class SnapshotPublisher:
+    """
+    Publishes the state of a collection for the reader workers.
+
+    Runs in the writer process. After a change it waits
+    ``SNAPSHOT_PUBLISH_MS`` (so a burst of writes gives one snapshot),
+    then writes ``<name>.snapshot``: a segment file (see
+    storage.segment) with an increasing generation. The file is replaced
+    atomically, readers still using the old one are not affected.
+
+    ``state(since)`` returns the records, their version and the ids
+    written since the version ``since`` (None if unknown), see
+    MemoryCollection.published. The ids written for each of the last
+    CHANGES_GENERATIONS generations go to ``<name>.snapshot.changes``
+    (JSON), written before the snapshot: a reader catches up with them
+    instead of reading the whole snapshot (see SnapshotCollection.changes).
+
+    A failed publish (disk full, ...) is logged and tried again
+    RETRY_SECONDS later; the readers keep the previous generation
+    meanwhile.
+
+    Each publish writes every record, and the readers build their
+    listing indexes again for each generation: O(records) per burst of
+    writes, see benchmarks/bench_snapshot.py.
+    """
+
+    def __init__(self, path: str, state: Callable[[Optional[str]], Tuple[Iterable[Dict], str, Optional[List[str]]]],
+                 interval_ms: float = SNAPSHOT_PUBLISH_MS):
+        self.path = path
+        self.state = state
+        self.interval = interval_ms / 1000
+        self.generation = read_generation(path)
+        self._token: Optional[str] = None
+        self._written: List[Tuple[int, List[str]]] = []  # (generation, ids written since the one before)
+        self._changed = threading.Event()
+        self.publish()
+        self._thread = threading.Thread(target=self._run, name="publish-{}".format(os.path.basename(path)), daemon=True)
+        self._thread.start()
+
+    def changed(self) -> None:
+        self._changed.set()
+
+    def publish(self) -> None:
+        records, token, ids = self.state(self._token)
+        generation = self.generation + 1
+        if ids is None:
+            written = []  # readers of the older generations read everything
+        else:
+            written = self._written + [(generation, ids)]
+            while len(written) > CHANGES_GENERATIONS or sum(len(i) for _, i in written) > CHANGES_MAX_IDS:
+                del written[0]
+        tmp = "{}.tmp".format(changes_path(self.path))
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"changes": written}, f)
+        os.replace(tmp, changes_path(self.path))
+        # no fsync: a snapshot is published again on the writer's startup
+        write_segment(self.path, records, generation, sync=False)
+        # only now: a failed publish is tried again from the same state
+        self.generation, self._written, self._token = generation, written, token
+
+    def _run(self) -> None:
+        while True:
+            self._changed.wait()
+            time.sleep(self.interval)
+            self._changed.clear()
+            try:
+                self.publish()
+            except Exception:
+                logger.exception("Publishing %s failed, retrying in %ss", self.path, RETRY_SECONDS)
+                time.sleep(RETRY_SECONDS)
+                self._changed.set()
+
+
+class SnapshotCollection(Collection):
+    """
+    Read only view of a collection published by the writer process.
+
+    Every access does a ``stat`` of the snapshot file; only when the
+    file was replaced is the new segment mapped. A lookup by id reads
+    that one record from the segment. The indexes needed by ``find``
+    and ``page`` are built from the segment on first use, once per
+    generation (not once per request). Writes raise ReadOnlyError.
+    """
+
+    def __init__(self, path: str, name: str, indexes=(), store: Callable = RecordIndex):
+        super().__init__(name, indexes)
+        self.path = path
+        self.store = store
+        self.generation = 0
+        self._stat: Optional[Tuple[int, int]] = None
+        self._modified = 0.0
+        self._lock = threading.Lock()
+        self._segment: Optional[Segment] = None
+        self._index: Optional[Tuple[Optional[Segment], object]] = None  # (segment, its index)
+
+    def _current(self) -> Optional[Segment]:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return self._segment
+        if (st.st_ino, st.st_mtime_ns) != self._stat:
+            with self._lock:
+                if (st.st_ino, st.st_mtime_ns) != self._stat:
+                    self._reload()
+        return self._segment
+
+    def _reload(self) -> None:
+        segment = Segment(self.path)
+        st = segment.stat
+        # the old segment stays mapped for the requests still using it
+        self._segment = segment
+        self.generation = segment.generation
+        self._stat = (st.st_ino, st.st_mtime_ns)
+        self._modified = st.st_mtime
+
+    def _records(self):
+        # the index is tied to the segment it was built from, so one
+        # built from an older generation is never used for a newer one
+        segment = self._current()
+        index = self._index
+        if index is None or index[0] is not segment:
+            with self._lock:
+                index = self._index
+                if index is None or index[0] is not segment:
+                    index = self._index = (segment, self.store(self.indexes, segment if segment is not None else ()))
+        return index[1]
+
+    def get(self, id: str) -> Optional[Dict]:
+        segment = self._current()
+        return segment.get(id) if segment is not None else None
+
+    def get_many(self, ids: Iterable[str]) -> Dict[str, Dict]:
+        segment = self._current()
+        if segment is None:
+            return {}
+        found = {}
+        for id in ids:
+            record = segment.get(id)
+            if record is not None:
+                found[id] = record
+        return found
+
+    def find(self, field: str, value: str) -> List[Dict]:
+        if field not in self.indexes:
+            return super().find(field, value)
+        return [dict(r) for r in self._records().find(field, value)]
+
+    def page(self, limit, after=None, field=None, value=None, reverse=False) -> List[Dict]:
+        if field is not None and field not in self.indexes:
+            return super().page(limit, after, field, value, reverse)
+        return [dict(r) for r in self._records().page(limit, after, field, value, reverse)]
+
+    def scan(self):
+        segment = self._current()
+        return iter(segment) if segment is not None else iter(())
+
+    def version(self, id: Optional[str] = None) -> Tuple[str, float]:
+        segment = self._current()
+        return self._token(segment), self._modified
+
+    @staticmethod
+    def _token(segment: Optional[Segment]) -> str:
+        # converted segments all have generation 0, the mtime tells them apart
+        if segment is None:
+            return "g0.0"
+        return "g{:x}.{:x}".format(segment.generation, segment.stat.st_mtime_ns)
+
+    def changes(self, since: str) -> Optional[Tuple[Dict[str, Optional[Dict]], str]]:
+        """
+        The records of the ids the writer published as written in each
+        generation after the one of ``since``, read from the current
+        segment. None if one of those generations is not in the changes
+        file (too old, or the writer restarted since).
+        """
+        segment = self._current()
+        token = self._token(segment)
+        if since == token:
+            return {}, token
+        match = TOKEN.match(since)
+        if segment is None or match is None or not 0 < int(match.group(1), 16) < segment.generation:
+            return None
+        try:
+            with open(changes_path(self.path), "r", encoding="utf-8") as f:
+                published = {generation: ids for generation, ids in json.load(f)["changes"]}
+        except (FileNotFoundError, ValueError):
+            return None
+        generations = range(int(match.group(1), 16) + 1, segment.generation + 1)
+        if any(generation not in published for generation in generations):
+            return None
+        ids = dict.fromkeys(id for generation in generations for id in published[generation])
+        return {id: segment.get(id) for id in ids}, token
+
+    def insert(self, record: Dict) -> Dict:
+        raise ReadOnlyError(self.name)
+
+    def insert_many(self, records: List[Dict]) -> List[Dict]:
+        raise ReadOnlyError(self.name)
+
+    def update(self, id, changes, where=None):
+        raise ReadOnlyError(self.name)
+
+    def remove(self, ids, where=None):
+        raise ReadOnlyError(self.name)
+
+
+class SnapshotBackend:
+    """
+    Backend of the reader workers: collections published by the writer.
+    With ``extension="seg"`` it serves the segments written by ``python
+    -m storage segment convert`` instead (read only ``segment`` backend).
+    """
+
+    read_only = True
+
+    def __init__(self, data_dir: str, extension: str = "snapshot"):
+        self.data_dir = data_dir
+        self.extension = extension
+
+    def collection(self, name: str, indexes=()) -> Collection:
+        store = ColumnarTweetIndex if tweet_collection(name) and TWEET_STORE == "columnar" else RecordIndex
+        path = os.path.join(self.data_dir, "{}.{}".format(name, self.extension))
+        return SnapshotCollection(path, name, indexes, store)
+
+    def close(self) -> None:
+        pass
@@ -0,0 +1,306 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from metrics import STORAGE_WRITE_BYTES, storage_read
+from profiling import phase
+
+from storage.base import Collection, DuplicateId, check_new
+
+SCAN_BATCH = 1000
+LOOKUP_BATCH = 500  # ids per IN (...) query, under SQLite's variable limit
+REMOVED_KEPT = 100000  # ids of removed rows kept for ``changes``
+
+
+class SqliteCollection(Collection):
+    """
+    Stores an entity in a SQLite table.
+
+    The record is kept as JSON in ``data``, the id, every indexed field
+    and ``deleted_at`` also get their own column so lookups and pages of
+    live records use B-tree indexes. ``written`` is the version of the
+    table at the last write of the row (indexed too): the rows written
+    since a version are found without a scan (see ``changes``), the ids
+    of the removed rows are kept in ``<name>_removed`` for that.
+    """
+
+    def __init__(self, backend: "SqliteBackend", name: str, indexes=()):
+        super().__init__(name, indexes)
+        self.backend = backend
+        self.columns = tuple(indexes) + ("deleted_at",)
+        columns = "".join(", {} TEXT".format(field) for field in self.columns)
+        with backend.lock:
+            db = backend.connection()
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS {} ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "id TEXT NOT NULL UNIQUE, "
+                "data TEXT NOT NULL, "
+                "written INTEGER{})".format(name, columns)
+            )
+            existing = {row[1] for row in db.execute("PRAGMA table_info({})".format(name))}
+            for field in self.columns:
+                if field not in existing:  # table created by an older version
+                    db.execute("ALTER TABLE {} ADD COLUMN {} TEXT".format(name, field))
+                    db.execute("UPDATE {0} SET {1} = json_extract(data, '$.{1}')".format(name, field))
+            if "written" not in existing:
+                db.execute("ALTER TABLE {} ADD COLUMN written INTEGER".format(name))
+            db.execute("CREATE INDEX IF NOT EXISTS ix_{0}_written ON {0} (written)".format(name))
+            for field in indexes:
+                db.execute("CREATE INDEX IF NOT EXISTS ix_{0}_{1} ON {0} ({1}, seq)".format(name, field))
+                # keyset pages of live records
+                db.execute(
+                    "CREATE INDEX IF NOT EXISTS ix_{0}_{1}_live ON {0} ({1}, seq) "
+                    "WHERE deleted_at IS NULL".format(name, field)
+                )
+            db.execute("CREATE INDEX IF NOT EXISTS ix_{0}_live ON {0} (seq) WHERE deleted_at IS NULL".format(name))
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS {0}_removed (id TEXT PRIMARY KEY, written INTEGER NOT NULL)".format(name)
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS ix_{0}_removed_written ON {0}_removed (written)".format(name))
+            # one version per table, bumped in the transaction of each
+            # write, and the version up to which removed ids were dropped
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS versions ("
+                "name TEXT PRIMARY KEY, version INTEGER NOT NULL, modified REAL NOT NULL, "
+                "removed INTEGER NOT NULL DEFAULT 0)"
+            )
+            if "removed" not in {row[1] for row in db.execute("PRAGMA table_info(versions)")}:
+                db.execute("ALTER TABLE versions ADD COLUMN removed INTEGER NOT NULL DEFAULT 0")
+            db.execute("INSERT OR IGNORE INTO versions (name, version, modified) VALUES (?, 0, ?)", (name, time.time()))
+
+    def _rows(self, sql: str, params=()) -> List[Dict]:
+        with phase("storage"):
+            rows = self.backend.connection().execute(sql, params).fetchall()
+        return self._decode(rows, 0)
+
+    def _decode(self, rows, column: int) -> List[Dict]:
+        start = time.perf_counter()
+        records = [json.loads(row[column]) for row in rows]
+        storage_read(self.name, sum(len(row[column]) for row in rows), time.perf_counter() - start, len(rows))
+        return records
+
+    def _encode(self, record: Dict) -> str:
+        data = json.dumps(record)
+        STORAGE_WRITE_BYTES.inc((self.name,), len(data))
+        return data
+
+    def get(self, id: str) -> Optional[Dict]:
+        rows = self._rows("SELECT data FROM {} WHERE id = ?".format(self.name), (id,))
+        return rows[0] if rows else None
+
+    def get_many(self, ids: Iterable[str]) -> Dict[str, Dict]:
+        ids = list(dict.fromkeys(ids))
+        found = {}
+        for start in range(0, len(ids), LOOKUP_BATCH):
+            chunk = ids[start:start + LOOKUP_BATCH]
+            sql = "SELECT data FROM {} WHERE id IN ({})".format(self.name, ", ".join("?" * len(chunk)))
+            for record in self._rows(sql, chunk):
+                found[record["id"]] = record
+        return found
+
+    def find(self, field: str, value: str) -> List[Dict]:
+        if field not in self.indexes:
+            return super().find(field, value)
+        return self._rows("SELECT data FROM {} WHERE {} = ? ORDER BY seq".format(self.name, field), (value,))
+
+    def page(self, limit, after=None, field=None, value=None, reverse=False) -> List[Dict]:
+        if field is not None and field not in self.indexes:
+            return super().page(limit, after, field, value, reverse)
+        where, params = ["deleted_at IS NULL"], []
+        if field is not None:
+            where.append("{} = ?".format(field))
+            params.append(value)
+        if after is not None:
+            row = self.backend.connection().execute(
+                "SELECT seq FROM {} WHERE id = ?".format(self.name), (after,)
+            ).fetchone()
+            if row is None:
+                raise KeyError(after)
+            where.append("seq < ?" if reverse else "seq > ?")
+            params.append(row[0])
+        return self._rows(
+            "SELECT data FROM {} WHERE {} ORDER BY seq {} LIMIT ?".format(
+                self.name, " AND ".join(where), "DESC" if reverse else "ASC"
+            ),
+            params + [limit],
+        )
+
+    def scan(self) -> Iterator[Dict]:
+        # batches by keyset, each one on the connection of the current
+        # thread: a streamed response may resume on another thread
+        last = 0
+        while True:
+            with phase("storage"):
+                rows = self.backend.connection().execute(
+                    "SELECT seq, data FROM {} WHERE seq > ? ORDER BY seq LIMIT ?".format(self.name), (last, SCAN_BATCH)
+                ).fetchall()
+            yield from self._decode(rows, 1)
+            if len(rows) < SCAN_BATCH:
+                return
+            last = rows[-1][0]
+
+    def insert(self, record: Dict) -> Dict:
+        fields = ("id", "data", "written") + self.columns
+        values = [record["id"], self._encode(record)] + [record.get(f) for f in self.columns]
+        with phase("storage"), self.backend.lock:
+            db = self.backend.connection()
+            try:
+                with db:
+                    db.execute("BEGIN IMMEDIATE")
+                    version = self._bump(db)
+                    db.execute(
+                        "INSERT INTO {} ({}) VALUES ({})".format(self.name, ", ".join(fields), ", ".join("?" * len(fields))),
+                        values[:2] + [version] + values[2:],
+                    )
+            except sqlite3.IntegrityError:  # UNIQUE id, rolled back
+                raise DuplicateId(record["id"])
+        return dict(record)
+
+    def insert_many(self, records: List[Dict]) -> List[Dict]:
+        fields = ("id", "data", "written") + self.columns
+        check_new(records, lambda id: False)  # repeated ids, used ones fail the UNIQUE constraint
+        with phase("storage"), self.backend.lock:
+            db = self.backend.connection()
+            try:
+                with db:
+                    db.execute("BEGIN IMMEDIATE")
+                    version = self._bump(db)
+                    db.executemany(
+                        "INSERT INTO {} ({}) VALUES ({})".format(self.name, ", ".join(fields), ", ".join("?" * len(fields))),
+                        ([r["id"], self._encode(r), version] + [r.get(f) for f in self.columns] for r in records),
+                    )
+            except sqlite3.IntegrityError as e:
+                raise DuplicateId(str(e))
+        return [dict(r) for r in records]
+
+    def _bump(self, db: sqlite3.Connection) -> int:
+        # the new version of the table (in the transaction of the write)
+        db.execute("UPDATE versions SET version = version + 1, modified = ? WHERE name = ?", (time.time(), self.name))
+        return db.execute("SELECT version FROM versions WHERE name = ?", (self.name,)).fetchone()[0]
+
+    def version(self, id: Optional[str] = None) -> Tuple[str, float]:
+        version, modified = self.backend.connection().execute(
+            "SELECT version, modified FROM versions WHERE name = ?", (self.name,)
+        ).fetchone()
+        return "{:x}".format(version), modified
+
+    def changes(self, since: str) -> Optional[Tuple[Dict[str, Optional[Dict]], str]]:
+        # None if ids removed since were dropped already
+        try:
+            since = int(since, 16)
+        except ValueError:
+            return None
+        db = self.backend.connection()
+        with phase("storage"):
+            db.execute("BEGIN")  # the rows and the version read from the same state
+            try:
+                version, removed = db.execute(
+                    "SELECT version, removed FROM versions WHERE name = ?", (self.name,)
+                ).fetchone()
+                if not removed <= since <= version:
+                    return None
+                rows = db.execute(
+                    "SELECT data FROM {} WHERE written > ? ORDER BY seq".format(self.name), (since,)
+                ).fetchall()
+                gone = db.execute("SELECT id FROM {}_removed WHERE written > ?".format(self.name), (since,)).fetchall()
+            finally:
+                db.execute("COMMIT")
+        changed: Dict[str, Optional[Dict]] = {id: None for id, in gone}
+        changed.update((record["id"], record) for record in self._decode(rows, 0))
+        return changed, "{:x}".format(version)
+
+    def update(
+        self,
+        id: str,
+        changes: Dict,
+        where: Optional[Callable[[Dict], bool]] = None,
+    ) -> Optional[Dict]:
+        with phase("storage"), self.backend.lock:
+            db = self.backend.connection()
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                record = self.get(id)
+                if record is None or (where is not None and not where(record)):
+                    return None
+                record.update(changes)
+                version = self._bump(db)
+                assignments = ", ".join("{} = ?".format(f) for f in ("data", "written") + self.columns)
+                db.execute(
+                    "UPDATE {} SET {} WHERE id = ?".format(self.name, assignments),
+                    [self._encode(record), version] + [record.get(f) for f in self.columns] + [id],
+                )
+        return record
+
+    def remove(self, ids: Iterable[str], where: Optional[Callable[[Dict], bool]] = None) -> List[str]:
+        ids = list(dict.fromkeys(ids))
+        removed = []
+        with phase("storage"), self.backend.lock:
+            db = self.backend.connection()
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                for start in range(0, len(ids), LOOKUP_BATCH):
+                    found = self.get_many(ids[start:start + LOOKUP_BATCH])
+                    chunk = [id for id, record in found.items() if where is None or where(record)]
+                    if chunk:
+                        db.execute("DELETE FROM {} WHERE id IN ({})".format(self.name, ", ".join("?" * len(chunk))), chunk)
+                        removed.extend(chunk)
+                if removed:
+                    self._forget(db, removed, self._bump(db))
+        return removed
+
+    def _forget(self, db: sqlite3.Connection, ids: List[str], version: int) -> None:
+        # keep the removed ids for ``changes``, the newest REMOVED_KEPT
+        db.executemany(
+            "INSERT OR REPLACE INTO {}_removed (id, written) VALUES (?, ?)".format(self.name),
+            ((id, version) for id in ids),
+        )
+        extra = db.execute("SELECT count(*) FROM {}_removed".format(self.name)).fetchone()[0] - REMOVED_KEPT
+        if extra > 0:
+            dropped = db.execute(
+                "SELECT max(written) FROM (SELECT written FROM {}_removed ORDER BY written LIMIT ?)".format(self.name),
+                (extra,),
+            ).fetchone()[0]
+            db.execute("DELETE FROM {}_removed WHERE written <= ?".format(self.name), (dropped,))
+            db.execute("UPDATE versions SET removed = ? WHERE name = ?", (dropped, self.name))
+
+
+class SqliteBackend:
+    """
+    Backend storing every collection as a table of one SQLite database.
+
+    The database runs in WAL mode so readers (one connection per thread)
+    don't block the writer. Writes in this process are serialized with
+    a lock, SQLite's own locking covers other processes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self._local = threading.local()
+
+    def connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def collection(self, name: str, indexes=()) -> Collection:
+        return SqliteCollection(self, name, indexes)
+
+    def has_records(self, name: str) -> bool:
+        try:
+            return self.connection().execute("SELECT 1 FROM {} LIMIT 1".format(name)).fetchone() is not None
+        except sqlite3.OperationalError:  # no such table
+            return False
+
+    def close(self) -> None:
+        db = getattr(self._local, "db", None)
+        if db is not None:
+            db.close()
+            self._local.db = None
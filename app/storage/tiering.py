@@ -0,0 +1,126 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Callable, Dict, Optional
+
+from config import DATA_DIR, TIER_BATCH, TIER_TOMBSTONE_DAYS, TIER_TWEET_MAX_AGE_DAYS
+from metrics import TIERED_RECORDS
+
+from storage.base import Collection
+from storage.cold import ColdTier
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def _before(days: float) -> str:
+    # dates are stored as str(datetime), they compare as strings
+    return str(datetime.now() - timedelta(days=days))
+
+
+def tombstone_before(days: float) -> Callable[[Dict], bool]:
+    """
+    Records deleted more than ``days`` ago.
+    """
+    cutoff = _before(days)
+    return lambda record: record.get("deleted_at") is not None and record["deleted_at"] < cutoff
+
+
+def tweet_rule(tombstone_days: float = TIER_TOMBSTONE_DAYS,
+               max_age_days: float = TIER_TWEET_MAX_AGE_DAYS) -> Callable[[Dict], bool]:
+    """
+    Tombstones past the retention, and the tweets created more than
+    ``max_age_days`` ago if it is set.
+    """
+    tombstone = tombstone_before(tombstone_days)
+    if not max_age_days:
+        return tombstone
+    cutoff = _before(max_age_days)
+    return lambda tweet: tombstone(tweet) or (tweet.get("created_at") or cutoff) < cutoff
+
+
+def move(collection: Collection, cold: ColdTier, rule: Callable[[Dict], bool], batch: int = TIER_BATCH) -> int:
+    """
+    Move the records of ``collection`` matching ``rule`` to ``cold``,
+    ``batch`` at a time, and return how many were moved. The batches are
+    taken from one scan, each one where the previous ended.
+
+    Each batch is written to the cold tier (fsync-ed) before it is
+    removed from the collection, so a crash in between leaves a copy in
+    both (the hot one wins) rather than in neither. A record changed
+    after it was read is kept hot and taken out of the cold tier again,
+    the next run moves it if it still matches.
+    """
+    moved = 0
+    scan = collection.scan()  # not disturbed by the removals, see Collection.scan
+    try:
+        matching = (r for r in scan if rule(r))
+        while True:
+            records = {r["id"]: r for r in islice(matching, batch)}
+            if not records:
+                return moved
+            cold.add(list(records.values()))
+            removed = collection.remove(list(records), where=lambda r: records.get(r["id"]) == r)
+            cold.drop(set(records).difference(removed))
+            moved += len(removed)
+            TIERED_RECORDS.inc((collection.name,), len(removed))
+            if len(records) < batch:
+                return moved
+    finally:
+        scan.close()
+
+
+def tier(users, tweets) -> Dict[str, int]:
+    """
+    One tiering pass: users deleted past the retention, tweets deleted
+    past the retention or too old. Returns the records moved by
+    collection name. Skipped (empty) while another process runs one.
+    """
+    with open(os.path.join(DATA_DIR, "tiering.lock"), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return {}
+        start = time.perf_counter()
+        moved = {
+            users.collection.name: move(users.collection, users.cold, tombstone_before(TIER_TOMBSTONE_DAYS)),
+            tweets.collection.name: move(tweets.collection, tweets.cold, tweet_rule()),
+        }
+    if any(moved.values()):
+        logger.info("Tiering: %s moved to the cold tier in %.0fms",
+                    ", ".join("{} {}".format(count, name) for name, count in moved.items()),
+                    (time.perf_counter() - start) * 1000)
+    return moved
+
+
+class TieringJob:
+    """
+    Background thread running ``tier`` every ``interval`` seconds (the
+    first time one interval after the start).
+    """
+
+    def __init__(self, users, tweets, interval: float):
+        self.users = users
+        self.tweets = tweets
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name="tiering", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                tier(self.users, self.tweets)
+            except Exception:
+                logger.exception("Tiering failed")
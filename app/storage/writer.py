@@ -0,0 +1,137 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+from config import WRITE_BATCH_SIZE, WRITE_MAX_LINGER_MS
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class GroupCommitWriter:
+    """
+    Single thread owning the log files of the memory backend.
+
+    Collections queue lines with ``append`` and get a Future back. The
+    writer takes up to ``batch_size`` queued items (waiting at most
+    ``max_linger_ms`` for the batch to fill), writes them, then does one
+    flush and fsync per touched file before resolving the futures, so a
+    caller only returns once its mutation is durable. When a batch fails
+    its futures get the exception and the touched files are truncated
+    back to their size before it: no partial line is left behind for the
+    next batch to be appended to.
+    """
+
+    def __init__(self, batch_size: int = WRITE_BATCH_SIZE, max_linger_ms: float = WRITE_MAX_LINGER_MS):
+        self.batch_size = batch_size
+        self.max_linger = max_linger_ms / 1000
+        self._queue: "queue.Queue[Tuple[str, str, Optional[str], Future]]" = queue.Queue()
+        self._files: Dict[str, object] = {}
+        self._thread = threading.Thread(target=self._run, name="group-commit-writer", daemon=True)
+        self._thread.start()
+
+    def append(self, path: str, line: str) -> Future:
+        """
+        Queue ``line`` to be appended to the file at ``path``.
+        """
+        return self._put("append", path, line)
+
+    def rotate(self, path: str, target: str) -> Future:
+        """
+        Rename the file at ``path`` to ``target`` once every line queued
+        before is committed, later lines go to a new file.
+        """
+        return self._put("rotate", path, target)
+
+    def close(self) -> None:
+        self._put("stop", "", None).result()
+        self._thread.join()
+
+    def _put(self, op: str, path: str, arg: Optional[str]) -> Future:
+        future = Future()
+        self._queue.put((op, path, arg, future))
+        return future
+
+    def _file(self, path: str):
+        f = self._files.get(path)
+        if f is None:
+            f = self._files[path] = open(path, "a", encoding="utf-8")
+        return f
+
+    def _next_batch(self) -> List[Tuple[str, str, Optional[str], Future]]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_linger
+        while len(batch) < self.batch_size and batch[-1][0] == "append":
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _commit(self, touched: Dict[str, int], done: List[Future]) -> None:
+        for path in touched:
+            f = self._files[path]
+            f.flush()
+            os.fsync(f.fileno())
+        for future in done:
+            future.set_result(None)
+        touched.clear()
+        done.clear()
+
+    def _truncate(self, touched: Dict[str, int]) -> None:
+        # drop what the failed batch wrote, buffered or on disk
+        for path, size in touched.items():
+            f = self._files.pop(path, None)
+            try:
+                if f is not None:
+                    f.close()
+            except OSError:
+                pass
+            try:
+                with open(path, "r+b") as f:
+                    f.truncate(size)
+                    os.fsync(f.fileno())
+            except OSError:
+                logger.exception("Can't truncate %s back to %s bytes", path, size)
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            touched: Dict[str, int] = {}  # path -> size before the batch
+            done: List[Future] = []
+            try:
+                for op, path, arg, future in batch:
+                    if op == "append":
+                        f = self._file(path)
+                        if path not in touched:
+                            f.flush()
+                            touched[path] = f.tell()
+                        f.write(arg)
+                        done.append(future)
+                        continue
+                    # rotate and stop are barriers: commit what came before
+                    self._commit(touched, done)
+                    if op == "rotate":
+                        f = self._files.pop(path, None)
+                        if f is not None:
+                            f.close()
+                        if os.path.exists(path):
+                            os.replace(path, arg)
+                        else:
+                            open(arg, "a").close()
+                        future.set_result(None)
+                    else:
+                        for f in self._files.values():
+                            f.close()
+                        future.set_result(None)
+                        return
+                self._commit(touched, done)
+            except Exception as e:
+                self._truncate(touched)
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
@@ -0,0 +1,196 @@
+import heapq
+import threading
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from config import FANOUT_MAX_FOLLOWERS, TIMELINE_SIZE, TIMELINE_USERS
+
+from storage import tweets as tweet_repository, follows as follow_repository
+from storage.repository import TweetRepository, FollowRepository, InvalidCursor, encode_cursor, decode_cursor
+
+Entry = Tuple[str, str]  # (created_at, tweet id), sorts like the timeline
+
+
+def _entry(tweet: Dict) -> Entry:
+    return tweet["created_at"], tweet["id"]
+
+
+def _newest(entries: List[Entry], before: Optional[Entry], count: int) -> Iterator[Entry]:
+    # the ``count`` newest entries of an ascending list older than ``before``
+    end = bisect_left(entries, before) if before is not None else len(entries)
+    return reversed(entries[max(0, end - count):end])
+
+
+class Timelines:
+    """
+    Home timelines: the tweets of the users someone follows (and their
+    own), newest first.
+
+    Hybrid fan-out. A new tweet is pushed into the cached timelines of the
+    followers of its author (fan-out on write), unless the author has more
+    than FANOUT_MAX_FOLLOWERS followers: the tweets of those accounts are
+    kept once, per author, and merged into the timelines of their
+    followers when read. A page then costs its size (times the followed
+    big accounts), whatever the number of tweets or follows.
+
+    Timelines hold the ids of the newest TIMELINE_SIZE tweets, for the
+    last TIMELINE_USERS users read (LRU); a timeline not cached is built
+    from the newest tweets of each followed account. Tweets are fetched
+    when a page is read, so deleted ones are left out and updated ones
+    are current.
+
+    The writes of this process are applied right away; when a collection
+    was changed elsewhere (its version moved) the cache is dropped.
+    """
+
+    def __init__(self, tweets: TweetRepository, follows: FollowRepository,
+                 size: int = TIMELINE_SIZE, users: int = TIMELINE_USERS,
+                 fanout_max_followers: int = FANOUT_MAX_FOLLOWERS):
+        self.tweets = tweets
+        self.follows = follows
+        self.size = size
+        self.users = users
+        self.fanout_max_followers = fanout_max_followers
+        # user -> (home timeline, big accounts followed)
+        self._homes: "OrderedDict[str, Tuple[List[Entry], List[str]]]" = OrderedDict()
+        self._authored: "OrderedDict[str, List[Entry]]" = OrderedDict()  # big account -> its tweets
+        self._versions: Optional[Tuple[str, str]] = None
+        self._lock = threading.RLock()
+        tweets.listeners.append(self._tweets_written)
+        follows.listeners.append(self._follows_written)
+
+    # maintenance
+
+    def _current(self) -> None:
+        # called with the lock held
+        versions = (self.tweets.collection.version()[0], self.follows.collection.version()[0])
+        if versions != self._versions:
+            self._homes.clear()
+            self._authored.clear()
+            self._versions = versions
+
+    def _follow_up(self, position: int, collection, before: str) -> None:
+        # keep the cache if it was current before a write of this process
+        if self._versions is not None and self._versions[position] == before:
+            versions = list(self._versions)
+            versions[position] = collection.version()[0]
+            self._versions = tuple(versions)
+
+    def _is_big(self, user_id: str) -> bool:
+        return self.follows.graph.follower_count(user_id) > self.fanout_max_followers
+
+    def _push(self, entries: List[Entry], entry: Entry) -> None:
+        insort(entries, entry)
+        if len(entries) > self.size:
+            del entries[0]
+
+    def _tweets_written(self, tweets: List[Dict], before: str, created: bool) -> None:
+        with self._lock:
+            if created:
+                for tweet in tweets:
+                    self._fan_out(tweet)
+            self._follow_up(0, self.tweets.collection, before)
+
+    def _fan_out(self, tweet: Dict) -> None:
+        author = tweet["created_by"]
+        entry = _entry(tweet)
+        if self._is_big(author):
+            # merged when read, no fan-out
+            authored = self._authored.get(author)
+            if authored is not None:
+                self._push(authored, entry)
+            return
+        targets = self.follows.graph.followers(author)
+        targets.add(author)
+        for user_id in targets:
+            cached = self._homes.get(user_id)
+            if cached is not None:  # a timeline not cached is built when read
+                self._push(cached[0], entry)
+
+    def _follows_written(self, follower_id: str, followed_id: str, active: bool, before: str) -> None:
+        with self._lock:
+            count = self.follows.graph.follower_count(followed_id)
+            if count == self.fanout_max_followers + (1 if active else 0):
+                # the account just crossed the fan-out limit: the timelines
+                # of its followers are now built the other way, and its
+                # tweets kept while it was small missed the ones since
+                self._homes.clear()
+                self._authored.pop(followed_id, None)
+            else:
+                self._homes.pop(follower_id, None)
+            self._follow_up(1, self.follows.collection, before)
+
+    # reads
+
+    def _newest_of(self, user_id: str) -> List[Entry]:
+        tweets, _ = self.tweets.by_author(user_id, self.size)
+        return sorted(_entry(t) for t in tweets)
+
+    def _home(self, user_id: str) -> Tuple[List[Entry], List[List[Entry]]]:
+        """
+        The cached timeline of ``user_id`` and the tweets of the big
+        accounts it follows, built if needed. Called with the lock held.
+        """
+        cached = self._homes.get(user_id)
+        if cached is None:
+            sources = self.follows.graph.following(user_id)
+            sources.add(user_id)
+            big = [s for s in sources if self._is_big(s)]
+            streams = [self._newest_of(s) for s in sources if s not in big]
+            home = list(islice(heapq.merge(*streams), max(0, sum(map(len, streams)) - self.size), None))
+            cached = self._homes[user_id] = (home, big)
+            if len(self._homes) > self.users:
+                self._homes.popitem(last=False)
+        else:
+            self._homes.move_to_end(user_id)
+        home, big = cached
+        authored = []
+        for author in big:
+            entries = self._authored.get(author)
+            if entries is None:
+                entries = self._authored[author] = self._newest_of(author)
+                if len(self._authored) > self.users:
+                    self._authored.popitem(last=False)
+            else:
+                self._authored.move_to_end(author)
+            authored.append(entries)
+        return home, authored
+
+    def page(self, user_id: str, limit: int, cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """
+        A page of the home timeline of ``user_id`` (active tweets, newest
+        first) and the cursor of the next one (None on the last page).
+        """
+        before = None
+        if cursor:
+            created_at, _, tweet_id = decode_cursor(cursor).rpartition("|")
+            if not created_at or not tweet_id:
+                raise InvalidCursor(cursor)
+            before = (created_at, tweet_id)
+        count = limit + 1
+        while True:
+            with self._lock:
+                self._current()
+                home, authored = self._home(user_id)
+                streams = [_newest(entries, before, count) for entries in [home] + authored]
+            entries = []
+            for entry in heapq.merge(*streams, reverse=True):
+                if not entries or entries[-1] != entry:  # a big account may have fanned out before
+                    entries.append(entry)
+                    if len(entries) == count:
+                        break
+            found = self.tweets.get_many([id for _, id in entries])
+            live = [(e, found[e[1]]) for e in entries if e[1] in found and found[e[1]]["deleted_at"] is None]
+            # deleted tweets don't count: read further until the page is full
+            if len(live) > limit or len(entries) < count:
+                break
+            count *= 2
+        if len(live) > limit:
+            last = live[limit - 1][0]
+            return [t for _, t in live[:limit]], encode_cursor("{}|{}".format(*last))
+        return [t for _, t in live], None
+
+
+timelines = Timelines(tweet_repository, follow_repository)
@@ -0,0 +1,222 @@
+import heapq
+import re
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional, Set, Tuple
+
+HASHTAG = re.compile(r"(?<![\w#])#(\w+)")
+MENTION = re.compile(r"(?<![\w@])@(\w+)")
+
+SKETCH_WIDTH = 2048   # counters per row of a count-min sketch
+SKETCH_DEPTH = 4      # rows (hash functions)
+CANDIDATES = 200      # heavy hitter candidates kept per window
+
+# window -> (bucket size in seconds, buckets in the window)
+WINDOWS = {
+    "5m": (60, 5),
+    "15m": (60, 15),
+    "1h": (60, 60),
+    "6h": (3600, 6),
+    "24h": (3600, 24),
+}
+
+
+def extract(content: str) -> Tuple[Set[str], Set[str]]:
+    """
+    The (case folded) hashtags and mentions of a tweet, without # / @.
+    """
+    folded = content.casefold()
+    return set(HASHTAG.findall(folded)), set(MENTION.findall(folded))
+
+
+def _cells(key: str) -> List[int]:
+    # one counter per row, from two hashes (Kirsch-Mitzenmacher)
+    h1, h2 = hash(key), hash((key, "cms")) | 1
+    return [row * SKETCH_WIDTH + (h1 + row * h2) % SKETCH_WIDTH for row in range(SKETCH_DEPTH)]
+
+
+class CountMinSketch:
+    """
+    Approximate counts in fixed memory: a key only ever overestimates.
+    """
+
+    def __init__(self):
+        self.counters = array("I", bytes(4 * SKETCH_WIDTH * SKETCH_DEPTH))
+
+    def add(self, cells: List[int], count: int = 1) -> None:
+        for cell in cells:
+            self.counters[cell] += count
+
+    def estimate(self, cells: List[int]) -> int:
+        return min(self.counters[cell] for cell in cells)
+
+    def subtract(self, other: "CountMinSketch") -> None:
+        counters = self.counters
+        for i, count in enumerate(other.counters):
+            if count:
+                counters[i] -= count
+
+    def clear(self) -> None:
+        self.counters = array("I", bytes(4 * SKETCH_WIDTH * SKETCH_DEPTH))
+
+
+class _Window:
+    """
+    Count-min sketch of the last ``size`` buckets of a ring, with the
+    candidates for its top k (key -> estimated count).
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.sketch = CountMinSketch()
+        self.candidates: Dict[str, int] = {}
+        self._floor = 0  # smallest candidate count once full
+
+    def add(self, key: str, cells: List[int]) -> None:
+        self.sketch.add(cells)
+        count = self.sketch.estimate(cells)
+        candidates = self.candidates
+        if key in candidates or len(candidates) < CANDIDATES:
+            candidates[key] = count
+        elif count > self._floor:
+            # the floor only lags behind the real minimum (counts grow)
+            smallest = min(candidates, key=candidates.get)
+            if count > candidates[smallest]:
+                del candidates[smallest]
+                candidates[key] = count
+            self._floor = min(candidates.values())
+
+    def refresh(self) -> None:
+        # after buckets left the window
+        candidates = {}
+        for key in self.candidates:
+            count = self.sketch.estimate(_cells(key))
+            if count:
+                candidates[key] = count
+        self.candidates = candidates
+        self._floor = min(candidates.values()) if len(candidates) >= CANDIDATES else 0
+
+    def top(self, k: int) -> List[Tuple[str, int]]:
+        return heapq.nlargest(k, self.candidates.items(), key=lambda item: item[1])
+
+    def clear(self) -> None:
+        self.sketch.clear()
+        self.candidates = {}
+        self._floor = 0
+
+
+class _Ring:
+    """
+    Buckets of ``seconds`` (a sketch each) for the last ``size`` of them,
+    and the windows made of the newest buckets.
+    """
+
+    def __init__(self, seconds: int, size: int):
+        self.seconds = seconds
+        self.buckets = [CountMinSketch() for _ in range(size)]
+        self.current: Optional[int] = None  # number of the newest bucket
+        self.windows: List[_Window] = []
+
+    def advance(self, now: float) -> None:
+        number = int(now // self.seconds)
+        if self.current is None:
+            self.current = number
+            return
+        if number - self.current >= len(self.buckets):
+            # idle for longer than the ring: everything expired
+            for bucket in self.buckets:
+                bucket.clear()
+            for window in self.windows:
+                window.clear()
+            self.current = number
+            return
+        if number <= self.current:
+            return
+        while self.current < number:
+            self.current += 1
+            for window in self.windows:
+                window.sketch.subtract(self.buckets[(self.current - window.size) % len(self.buckets)])
+            self.buckets[self.current % len(self.buckets)].clear()
+        for window in self.windows:
+            window.refresh()
+
+    def add(self, key: str, cells: List[int]) -> None:
+        self.buckets[self.current % len(self.buckets)].add(cells)
+        for window in self.windows:
+            window.add(key, cells)
+
+
+class HeavyHitters:
+    """
+    Most frequent keys over the sliding windows of WINDOWS.
+
+    Counts live in count-min sketches: one per bucket (a minute, or an
+    hour for the long windows) and one per window, the sum of its
+    buckets, updated when a key is added and when a bucket leaves the
+    window. Each window keeps CANDIDATES keys with their estimates, a
+    query sorts only those. Memory is fixed whatever the volume of
+    tweets; the counts are estimates (never below the real ones).
+    """
+
+    def __init__(self):
+        self.rings: Dict[int, _Ring] = {}
+        self.windows: Dict[str, _Window] = {}
+        for name, (seconds, size) in WINDOWS.items():
+            ring = self.rings.get(seconds)
+            if ring is None:
+                ring = self.rings[seconds] = _Ring(seconds, max(s for b, s in WINDOWS.values() if b == seconds))
+            window = self.windows[name] = _Window(size)
+            ring.windows.append(window)
+
+    def add(self, key: str, now: float) -> None:
+        cells = _cells(key)
+        for ring in self.rings.values():
+            ring.advance(now)
+            ring.add(key, cells)
+
+    def top(self, window: str, k: int, now: float) -> List[Tuple[str, int]]:
+        for ring in self.rings.values():
+            ring.advance(now)
+        return self.windows[window].top(k)
+
+
+class Trends:
+    """
+    Trending hashtags and most mentioned users, fed by the tweets
+    written by this process.
+    """
+
+    def __init__(self):
+        self.hashtags = HeavyHitters()
+        self.mentions = HeavyHitters()
+        self._lock = threading.Lock()
+
+    def record(self, content: str, previous: Optional[str] = None) -> None:
+        """
+        Count the hashtags and mentions of a new tweet, or of an updated
+        one: only those not already in its ``previous`` content.
+        """
+        hashtags, mentions = extract(content)
+        if previous is not None and (hashtags or mentions):
+            old_hashtags, old_mentions = extract(previous)
+            hashtags, mentions = hashtags - old_hashtags, mentions - old_mentions
+        if not hashtags and not mentions:
+            return
+        now = time.time()
+        with self._lock:
+            for hashtag in hashtags:
+                self.hashtags.add(hashtag, now)
+            for mention in mentions:
+                self.mentions.add(mention, now)
+
+    def top(self, window: str, k: int) -> Dict[str, List[Tuple[str, int]]]:
+        now = time.time()
+        with self._lock:
+            return {
+                "hashtags": self.hashtags.top(window, k, now),
+                "mentions": self.mentions.top(window, k, now),
+            }
+
+
+trends = Trends()
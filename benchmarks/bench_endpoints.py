@@ -0,0 +1,410 @@
+"""
+Load test of the endpoints against generated datasets of growing size.
+
+    python benchmarks/bench_endpoints.py [--sizes 1000,10000] [--backends json,memory]
+        [--clients asgi,uvicorn] [--requests N] [--concurrency N] [--output FILE]
+    python benchmarks/bench_endpoints.py --compare BASELINE.json RESULTS.json
+
+For every dataset size (as many users as tweets, see generate.py), storage
+backend and client it starts the app on a fresh copy of the data and
+drives each endpoint in turn: reads first, then singup / login, creates,
+updates and deletes. The ``asgi`` client calls the app in process
+(TestClient, no network), ``uvicorn`` sends HTTP/1.1 keep-alive requests
+to a local uvicorn (``--concurrency`` connections). Each run is a
+separate process, since the app picks its storage at import time.
+
+It prints and writes to ``--output`` (JSON, by default
+benchmarks/results/endpoints-<commit>.json) the throughput and the
+p50 / p95 / p99 latency per endpoint, dataset size, backend and client,
+plus the time the app took to start: ``startup_ms`` from the JSON files,
+and with the uvicorn client ``restart_ms``, once stopped gracefully
+(from the warm start files with the memory backend). ``--compare``
+prints the change between two such files.
+
+Full listings and the bcrypt endpoints (singup, login) are sent
+``--requests`` / 10 times. Use a low PASSWORD_ROUNDS (e.g. 4) to measure
+the app rather than bcrypt. Nothing is written to app/.
+"""
+import argparse
+import http.client
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+import generate
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, "..", "app")
+
+# (method, path, body, content type)
+Request = Tuple[str, str, Optional[bytes], Optional[str]]
+
+
+def percentile(ordered: List[float], p: float) -> float:
+    # nearest rank
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+
+
+def json_body(content) -> Tuple[bytes, str]:
+    return json.dumps(content).encode("utf-8"), "application/json"
+
+
+def sample_ids(size: int, seed: int, count: int) -> Tuple[List[str], List[Dict]]:
+    """
+    ``count`` users and ``count`` active tweets of the dataset, picked at
+    random (the generator is deterministic, nothing is read).
+    """
+    rng = random.Random(seed)
+    users = [generate.user_id(seed, i) for i in rng.sample(range(size), min(count, size))]
+    wanted = set(rng.sample(range(size), min(2 * count, size)))
+    tweets = [
+        {"id": t["id"], "created_by": t["created_by"]}
+        for i, t in enumerate(generate.tweets(size, size, seed))
+        if i in wanted and t["deleted_at"] is None
+    ][:count]
+    return users, tweets
+
+
+def plan(size: int, seed: int, requests: int) -> List[Tuple[str, int, Callable[[int], Request]]]:
+    """
+    The endpoints to drive, in order: (name, number of requests, request
+    number -> request).
+    """
+    few = max(3, requests // 10)
+    users, tweets = sample_ids(size, seed, 2 * requests)
+    half = len(users) // 2
+    readers, writers = users[:half], users[half:]
+    targets = tweets[:len(tweets) // 2]   # updated
+    doomed = tweets[len(tweets) // 2:]     # deleted
+    run = random.Random(seed).randrange(1 << 30)
+
+    def get(path):
+        return lambda i: ("GET", path(i), None, None)
+
+    def post_json(path, content):
+        return lambda i: ("POST", path(i), *json_body(content(i)))
+
+    def put_json(path, content):
+        return lambda i: ("PUT", path(i), *json_body(content(i)))
+
+    def delete_json(path, content):
+        return lambda i: ("DELETE", path(i), *json_body(content(i)))
+
+    def login(i):
+        body = "email={}&password={}".format(generate.user_email(i * 7919 % size), generate.PASSWORD)
+        return "POST", "/login", body.encode("ascii"), "application/x-www-form-urlencoded"
+
+    return [
+        ("GET /users", few, get(lambda i: "/users")),
+        ("GET /users?limit=100", requests, get(lambda i: "/users?limit=100")),
+        ("GET /users/{id}", requests, get(lambda i: "/users/{}".format(readers[i % len(readers)]))),
+        ("GET /tweets", few, get(lambda i: "/tweets")),
+        ("GET /tweets?limit=100", requests, get(lambda i: "/tweets?limit=100")),
+        ("GET /tweets/{id}", requests, get(lambda i: "/tweets/{}".format(tweets[i % len(tweets)]["id"]))),
+        ("POST /singup", few, post_json(lambda i: "/singup", lambda i: {
+            "email": "bench{}-{}@example.com".format(run, i), "password": generate.PASSWORD,
+            "first_name": "Bench", "last_name": "User", "born_date": "1990-01-01",
+        })),
+        ("POST /login", few, login),
+        ("POST /tweets", requests, post_json(lambda i: "/tweets", lambda i: {
+            "content": "Benchmark tweet {} #bench".format(i), "created_by": writers[i % len(writers)],
+        })),
+        ("PUT /users/{id}/update", requests, put_json(
+            lambda i: "/users/{}/update".format(writers[i % len(writers)]),
+            lambda i: {"email": "updated{}-{}@example.com".format(run, i), "first_name": "Updated",
+                       "last_name": "User", "born_date": "1990-01-01"},
+        )),
+        ("PUT /tweets/{id}/update", requests, put_json(
+            lambda i: "/tweets/{}/update".format(targets[i % len(targets)]["id"]),
+            lambda i: {"content": "Updated tweet {}".format(i), "created_by": targets[i % len(targets)]["created_by"]},
+        )),
+        ("DELETE /tweets/{id}/delete", min(requests, len(doomed)), delete_json(
+            lambda i: "/tweets/{}/delete".format(doomed[i]["id"]), lambda i: doomed[i]["created_by"],
+        )),
+        ("DELETE /users/{id}/delete", min(requests, len(writers)), lambda i: (
+            "DELETE", "/users/{}/delete".format(writers[i]), None, None,
+        )),
+    ]
+
+
+def summarize(name: str, latencies: List[float], errors: int, elapsed: float) -> Dict:
+    ordered = sorted(latencies)
+    return {
+        "endpoint": name,
+        "requests": len(ordered),
+        "errors": errors,
+        "throughput_rps": round(len(ordered) / elapsed, 1) if elapsed else 0.0,
+        "mean_ms": round(sum(ordered) / len(ordered), 3) if ordered else 0.0,
+        "p50_ms": round(percentile(ordered, 50), 3),
+        "p95_ms": round(percentile(ordered, 95), 3),
+        "p99_ms": round(percentile(ordered, 99), 3),
+        "max_ms": round(ordered[-1], 3) if ordered else 0.0,
+    }
+
+
+def drive(send: Callable[[Request], int], steps, concurrency: int = 1) -> List[Dict]:
+    """
+    Send every request of ``steps`` with ``send`` (returns the status),
+    from ``concurrency`` threads, and summarize each endpoint.
+    """
+    results = []
+    for name, count, build in steps:
+        counter = itertools.count()
+        latencies: List[float] = []
+        errors = [0]
+
+        def work():
+            while True:
+                i = next(counter)
+                if i >= count:
+                    return
+                request = build(i)
+                start = time.perf_counter()
+                status = send(request)
+                latencies.append((time.perf_counter() - start) * 1000)
+                if status >= 300:
+                    errors[0] += 1
+
+        start = time.perf_counter()
+        if concurrency == 1:
+            work()
+        else:
+            threads = [threading.Thread(target=work) for _ in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        results.append(summarize(name, latencies, errors[0], time.perf_counter() - start))
+    return results
+
+
+def prepare(pristine: str, backend: str) -> Tuple[str, Dict[str, str]]:
+    """
+    A fresh copy of the dataset for one run, and the environment of the app.
+    """
+    data_dir = tempfile.mkdtemp(prefix="bench-endpoints-")
+    for name in ("users.json", "tweets.json"):
+        shutil.copy(os.path.join(pristine, name), data_dir)
+    env = dict(os.environ, DATA_DIR=data_dir, STORAGE_BACKEND=backend, PYTHONPATH=APP_DIR,
+               SQLITE_PATH=os.path.join(data_dir, "twitter.db"), WORKER_ROLE="single",
+               APP_NAME=os.environ.get("APP_NAME") or "bench",
+               # every login comes from this machine: measure the endpoint, not the rate limit
+               LOGIN_CLIENT_RATE=os.environ.get("LOGIN_CLIENT_RATE") or "0")
+    if backend == "sqlite":
+        subprocess.run([sys.executable, "-m", "storage", "migrate", "json", "sqlite"],
+                       cwd=data_dir, env=env, check=True, stdout=subprocess.DEVNULL)
+    return data_dir, env
+
+
+def run_asgi(size: int, seed: int, requests: int) -> Dict:
+    # in the child process, with the environment set by prepare()
+    sys.path.insert(0, APP_DIR)
+    os.chdir(os.environ["DATA_DIR"])
+    start = time.perf_counter()
+    from fastapi.testclient import TestClient
+    import main
+    client = TestClient(main.app)
+    client.get("/tweets/00000000-0000-0000-0000-000000000000")
+    startup_ms = (time.perf_counter() - start) * 1000
+
+    def send(request: Request) -> int:
+        method, path, body, content_type = request
+        headers = {"content-type": content_type} if content_type else {}
+        return client.request(method, path, data=body, headers=headers).status_code
+
+    results = drive(send, plan(size, seed, requests))
+    return {"startup_ms": round(startup_ms, 1), "endpoints": results}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_uvicorn(env: Dict[str, str], port: int) -> Tuple[subprocess.Popen, float]:
+    """
+    Start the app and wait for its first answer, return the server and
+    the milliseconds that took.
+    """
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", APP_DIR, "--port", str(port),
+         "--no-access-log", "--log-level", "warning"],
+        cwd=env["DATA_DIR"], env=env,
+    )
+    while True:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+            connection.request("GET", "/tweets/00000000-0000-0000-0000-000000000000")
+            connection.getresponse().read()
+            connection.close()
+            return server, (time.perf_counter() - start) * 1000
+        except ConnectionError:
+            if server.poll() is not None:
+                raise RuntimeError("uvicorn exited with {}".format(server.returncode))
+            time.sleep(0.05)
+
+
+def run_uvicorn(env: Dict[str, str], size: int, seed: int, requests: int, concurrency: int) -> Dict:
+    port = free_port()
+    server, startup_ms = start_uvicorn(env, port)
+    try:
+        local = threading.local()
+
+        def send(request: Request) -> int:
+            method, path, body, content_type = request
+            connection = getattr(local, "connection", None)
+            if connection is None:
+                connection = local.connection = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+            headers = {"content-type": content_type} if content_type else {}
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+
+        results = drive(send, plan(size, seed, requests), concurrency)
+    finally:
+        server.terminate()
+        server.wait()
+    # a graceful stop saved the warm start files (memory backend): the
+    # second start loads them instead of the JSON files
+    server, restart_ms = start_uvicorn(env, port)
+    server.terminate()
+    server.wait()
+    return {"startup_ms": round(startup_ms, 1), "restart_ms": round(restart_ms, 1), "endpoints": results}
+
+
+def commit() -> Tuple[Optional[str], bool]:
+    try:
+        sha = subprocess.run(["git", "rev-parse", "HEAD"], cwd=BENCH_DIR, capture_output=True,
+                             text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=BENCH_DIR,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return sha, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, False
+
+
+def compare(baseline_path: str, results_path: str) -> None:
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(results_path, encoding="utf-8") as f:
+        results = json.load(f)
+
+    def key(run, endpoint):
+        return run["size"], run["backend"], run["client"], endpoint["endpoint"]
+
+    old = {key(run, e): e for run in baseline["runs"] for e in run["endpoints"]}
+    print("{} ({}) -> {} ({})".format(baseline_path, (baseline["commit"] or "?")[:10],
+                                      results_path, (results["commit"] or "?")[:10]))
+    print("{:>8} {:<8} {:<8} {:<28}{:>10}{:>10}{:>9}{:>10}{:>10}{:>9}".format(
+        "size", "backend", "client", "endpoint", "old p50", "new p50", "change", "old rps", "new rps", "change"))
+    for run in results["runs"]:
+        for e in run["endpoints"]:
+            before = old.get(key(run, e))
+            if before is None:
+                continue
+            print("{:>8} {:<8} {:<8} {:<28}{:>10.2f}{:>10.2f}{:>+8.0f}%{:>10.1f}{:>10.1f}{:>+8.0f}%".format(
+                run["size"], run["backend"], run["client"], e["endpoint"],
+                before["p50_ms"], e["p50_ms"], (e["p50_ms"] / before["p50_ms"] - 1) * 100 if before["p50_ms"] else 0,
+                before["throughput_rps"], e["throughput_rps"],
+                (e["throughput_rps"] / before["throughput_rps"] - 1) * 100 if before["throughput_rps"] else 0,
+            ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000", help="users and tweets of each dataset")
+    parser.add_argument("--backends", default="json,memory", help="json, memory, sqlite")
+    parser.add_argument("--clients", default="asgi,uvicorn", help="asgi, uvicorn")
+    parser.add_argument("--requests", type=int, default=200, help="per endpoint")
+    parser.add_argument("--concurrency", type=int, default=1, help="connections (uvicorn client)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="results file")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "RESULTS"))
+    parser.add_argument("--asgi-child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.asgi_child is not None:
+        print(json.dumps(run_asgi(args.asgi_child, args.seed, args.requests)))
+        return
+
+    sha, dirty = commit()
+    output = args.output or os.path.join(BENCH_DIR, "results", "endpoints-{}{}.json".format(
+        (sha or "unknown")[:10], "-dirty" if dirty else ""))
+    report = {
+        "commit": sha,
+        "dirty": dirty,
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "settings": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+            "password_scheme": os.environ.get("PASSWORD_SCHEME") or "bcrypt",
+            "password_rounds": os.environ.get("PASSWORD_ROUNDS") or None,
+            "fast_responses": os.environ.get("FAST_RESPONSES") == "1",
+        },
+        "runs": [],
+    }
+
+    print("{:>8} {:<8} {:<8} {:<28}{:>7}{:>6}{:>10}{:>9}{:>9}{:>9}".format(
+        "size", "backend", "client", "endpoint", "reqs", "errs", "req/s", "p50 ms", "p95 ms", "p99 ms"))
+    for size in [int(s) for s in args.sizes.split(",")]:
+        pristine = tempfile.mkdtemp(prefix="bench-dataset-")
+        start = time.perf_counter()
+        generate.generate(pristine, size, size, args.seed)
+        print("dataset of {} users / {} tweets generated in {:.1f}s".format(size, size, time.perf_counter() - start))
+        for backend in args.backends.split(","):
+            for client in args.clients.split(","):
+                data_dir, env = prepare(pristine, backend)
+                try:
+                    if client == "asgi":
+                        child = subprocess.run(
+                            [sys.executable, os.path.abspath(__file__), "--asgi-child", str(size),
+                             "--seed", str(args.seed), "--requests", str(args.requests)],
+                            env=env, check=True, capture_output=True, text=True,
+                        )
+                        run = json.loads(child.stdout.strip().splitlines()[-1])
+                    else:
+                        run = run_uvicorn(env, size, args.seed, args.requests, args.concurrency)
+                finally:
+                    shutil.rmtree(data_dir, ignore_errors=True)
+                run = dict(size=size, backend=backend, client=client, **run)
+                report["runs"].append(run)
+                print("{:>8} {:<8} {:<8} {:<28}{:>.0f} ms".format(size, backend, client, "(startup)", run["startup_ms"]))
+                if "restart_ms" in run:
+                    print("{:>8} {:<8} {:<8} {:<28}{:>.0f} ms".format(size, backend, client, "(restart)", run["restart_ms"]))
+                for e in run["endpoints"]:
+                    print("{:>8} {:<8} {:<8} {:<28}{:>7}{:>6}{:>10.1f}{:>9.2f}{:>9.2f}{:>9.2f}".format(
+                        size, backend, client, e["endpoint"], e["requests"], e["errors"],
+                        e["throughput_rps"], e["p50_ms"], e["p95_ms"], e["p99_ms"]))
+        shutil.rmtree(pristine, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print("results written to {}".format(output))
+
+
+if __name__ == "__main__":
+    main()
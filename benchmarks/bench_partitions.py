@@ -0,0 +1,217 @@
+"""
+Write throughput of the tweets as the number of partitions grows
+(TWEET_PARTITIONS, see app/storage/partitioned.py).
+
+    python benchmarks/bench_partitions.py [--backends json,memory,sqlite] [--partitions 1,2,4,8,16]
+        [--scheme author] [--size N] [--writes N] [--threads N] [--output FILE]
+
+For every backend and partition count it loads ``--size`` tweets into a
+fresh directory (1 partition: the single collection, as without
+TWEET_PARTITIONS), then ``--threads`` threads create ``--writes`` tweets
+and update as many existing ones, through the storage directly (no
+HTTP). Creates include the check that their ids are used by no
+partition. It counts the partitions read per write (lookups and scans,
+not the write itself), times a page of an author's tweets and counts
+the partitions it opens.
+
+Prints and writes to ``--output`` (JSON, by default
+benchmarks/results/partitions-<commit>.json) the throughput and p50 /
+p95 / p99 latency per operation, backend and partition count.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+from bench_endpoints import APP_DIR, BENCH_DIR, commit, summarize
+
+
+def tweets(count: int, authors: List[str], seed: int) -> List[Dict]:
+    rng = random.Random(seed)
+    start = datetime(2021, 1, 1)
+    records = []
+    for i in range(count):
+        created = start + timedelta(minutes=i * 7)
+        records.append({
+            "id": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            "content": "Partition benchmark tweet {} #bench".format(i),
+            "created_by": authors[i % len(authors)],
+            "created_at": str(created),
+            "updated_at": None,
+            "deleted_at": None,
+        })
+    return records
+
+
+def create_backend(name: str, data_dir: str):
+    if name == "json":
+        from storage.jsonfile import JsonBackend
+        return JsonBackend(data_dir)
+    if name == "memory":
+        from storage.memory import MemoryBackend
+        return MemoryBackend(data_dir)
+    if name == "sqlite":
+        from storage.sqlite import SqliteBackend
+        return SqliteBackend(os.path.join(data_dir, "twitter.db"))
+    raise ValueError(name)
+
+
+def timed(name: str, operations: List[Callable[[], None]], threads: int) -> Dict:
+    latencies: List[float] = []
+    errors = []
+    lock = threading.Lock()
+    queue = iter(operations)
+
+    def worker():
+        local, failed = [], 0
+        while True:
+            with lock:
+                operation = next(queue, None)
+            if operation is None:
+                break
+            start = time.perf_counter()
+            try:
+                operation()
+            except Exception:
+                failed += 1
+            local.append((time.perf_counter() - start) * 1000)
+        with lock:
+            latencies.extend(local)
+            errors.append(failed)
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return summarize(name, latencies, sum(errors), time.perf_counter() - started)
+
+
+def count_reads(collection, reads: List[int]) -> None:
+    # every lookup or scan of a partition adds one to reads[0]
+    partitions = collection.partitions() if hasattr(collection, "partitions") else [("", collection)]
+    for _, partition in partitions:
+        for method in ("get", "get_many", "scan", "find", "page"):
+            original = getattr(partition, method)
+
+            def counted(*args, original=original, **kwargs):
+                reads[0] += 1
+                return original(*args, **kwargs)
+
+            setattr(partition, method, counted)
+
+
+def run(backend_name: str, partitions: int, scheme: str, size: int, writes: int, threads: int, seed: int) -> Dict:
+    from storage.partitioned import Layout, PartitionedCollection, manifest_path, parse_scheme
+
+    data_dir = tempfile.mkdtemp(prefix="bench-partitions-")
+    backend = create_backend(backend_name, data_dir)
+    try:
+        layout = Layout(parse_scheme(scheme) if partitions > 1 else (), partitions)
+        if layout.scheme:
+            collection = PartitionedCollection(backend, manifest_path(data_dir, "tweets"), "tweets",
+                                               ("created_by",), layout)
+        else:
+            collection = backend.collection("tweets", ("created_by",))
+        rng = random.Random(seed)
+        authors = [str(uuid.UUID(int=rng.getrandbits(128), version=4)) for _ in range(max(1, size // 10))]
+        loaded = tweets(size, authors, seed)
+        for start in range(0, len(loaded), 1000):
+            collection.insert_many(loaded[start:start + 1000])
+        new = tweets(writes, authors, seed + 1)
+        for tweet in new:  # written now: the current month with month partitions
+            tweet["created_at"] = loaded[-1]["created_at"] if loaded else tweet["created_at"]
+        changed = rng.sample(loaded, min(writes, len(loaded)))
+
+        reads = [0]
+        count_reads(collection, reads)
+        results = [
+            timed("create", [lambda t=t: collection.insert(t) for t in new], threads),
+            timed("update", [lambda t=t: collection.update(t["id"], {"content": "updated"}) for t in changed], threads),
+        ]
+        read_per_write = reads[0] / max(1, len(new) + len(changed))
+        results += [
+            timed("author page", [
+                lambda a=a: collection.page(20, field="created_by", value=a, reverse=True)
+                for a in rng.choices(authors, k=max(1, writes // 5))
+            ], threads),
+        ]
+        if layout.scheme:
+            keys = [key for key, _ in collection.partitions()]
+            opened = sum(len(layout.author_keys(keys, a)) for a in authors) / len(authors)
+            count = len(keys)
+        else:
+            opened, count = 1, 1
+        collection.close()
+        return dict(backend=backend_name, partitions=count, buckets=partitions, scheme=scheme if layout.scheme else "",
+                    size=size, author_partitions=round(opened, 2), reads_per_write=round(read_per_write, 2),
+                    operations=results)
+    finally:
+        backend.close()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", default="json,memory,sqlite")
+    parser.add_argument("--partitions", default="1,2,4,8,16", help="author buckets")
+    parser.add_argument("--scheme", default="author", help="author or author,month")
+    parser.add_argument("--size", type=int, default=10000, help="tweets loaded first")
+    parser.add_argument("--writes", type=int, default=500, help="creates, and as many updates")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="results file")
+    args = parser.parse_args()
+
+    # the settings are read on import: keep them away from any data
+    scratch = tempfile.mkdtemp(prefix="bench-partitions-")
+    os.environ.update(APP_NAME=os.environ.get("APP_NAME") or "bench", STORAGE_BACKEND="json", DATA_DIR=scratch,
+                      TWEET_PARTITIONS="", METRICS="0", WARM_START="0")
+    sys.path.insert(0, APP_DIR)
+
+    sha, dirty = commit()
+    output = args.output or os.path.join(BENCH_DIR, "results", "partitions-{}{}.json".format(
+        (sha or "unknown")[:10], "-dirty" if dirty else ""))
+    report = {
+        "commit": sha,
+        "dirty": dirty,
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "settings": {"size": args.size, "writes": args.writes, "threads": args.threads, "seed": args.seed},
+        "runs": [],
+    }
+    print("{:<8}{:>6}{:>8}{:>7}  {:<13}{:>8}{:>10}{:>9}{:>9}{:>9}".format(
+        "backend", "parts", "author", "reads", "operation", "ops", "ops/s", "p50 ms", "p95 ms", "p99 ms"))
+    try:
+        for backend in args.backends.split(","):
+            for partitions in (int(p) for p in args.partitions.split(",")):
+                result = run(backend, partitions, args.scheme, args.size, args.writes, args.threads, args.seed)
+                report["runs"].append(result)
+                for o in result["operations"]:
+                    print("{:<8}{:>6}{:>8}{:>7}  {:<13}{:>8}{:>10.1f}{:>9.2f}{:>9.2f}{:>9.2f}".format(
+                        backend, result["partitions"], result["author_partitions"], result["reads_per_write"],
+                        o["endpoint"],
+                        o["requests"], o["throughput_rps"], o["p50_ms"], o["p95_ms"], o["p99_ms"]))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print("results written to {}".format(output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Micro-benchmark of the response paths: models (default) vs fast
+(FAST_RESPONSES=1).
+
+    python benchmarks/bench_serialization.py [--users N] [--tweets N] [--requests N]
+
+For each endpoint it times the same requests in both modes through an
+in-process client, checks that both bodies are the same bytes, and
+prints the mean time per request. It also times the serialization of
+one record alone (model + jsonable_encoder + json vs dict + orjson).
+Runs on a temporary copy of the data, nothing is written to app/.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+
+
+def seed(data_dir: str, users: int, tweets: int):
+    now = datetime.now()
+    user_records = [{
+        "id": str(uuid.uuid4()),
+        "email": "user{}@example.com".format(i),
+        "first_name": "First",
+        "last_name": "Last",
+        "born_date": "1990-01-01",
+        "created_at": str(now),
+        "updated_at": None,
+        "deleted_at": None,
+        "password": "x",
+    } for i in range(users)]
+    tweet_records = [{
+        "id": str(uuid.uuid4()),
+        "content": "Tweet number {} with some content, ñandú ✓".format(i),
+        "created_by": user_records[i % users]["id"],
+        "created_at": str(now),
+        "updated_at": None,
+        "deleted_at": None,
+    } for i in range(tweets)]
+    for name, records in (("users", user_records), ("tweets", tweet_records)):
+        with open(os.path.join(data_dir, "{}.json".format(name)), "w", encoding="utf-8") as f:
+            f.write(json.dumps(records))
+    return user_records, tweet_records
+
+
+def timed(fn, n: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n * 1e6  # us
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--tweets", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=300)
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix="bench-serialization-")
+    users, tweets = seed(data_dir, args.users, args.tweets)
+    os.environ.update(DATA_DIR=data_dir, STORAGE_BACKEND="memory", APP_NAME=os.environ.get("APP_NAME") or "bench")
+    sys.path.insert(0, APP_DIR)
+
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.testclient import TestClient
+
+    import main as app_main
+    from helpers import jsonBytes, publicTweet, publicUser, orjson
+    from models import Tweet, UserOut
+
+    client = TestClient(app_main.app)
+    user, tweet = users[0], tweets[0]
+    endpoints = [
+        ("GET /users/{id}", lambda: client.get("/users/{}".format(user["id"]))),
+        ("GET /tweets/{id}", lambda: client.get("/tweets/{}".format(tweet["id"]))),
+        ("GET /tweets?limit=100", lambda: client.get("/tweets?limit=100")),
+        ("GET /users/{id}/tweets", lambda: client.get("/users/{}/tweets?limit=100".format(user["id"]))),
+        ("PUT /tweets/{id}/update", lambda: client.put(
+            "/tweets/{}/update".format(tweet["id"]), json={"content": "Updated", "created_by": tweet["created_by"]})),
+    ]
+
+    print("encoder: {}".format("orjson" if orjson is not None else "json"))
+    print("{:<26}{:>12}{:>12}{:>10}  {}".format("endpoint", "models us", "fast us", "speedup", "same bytes"))
+    for name, request in endpoints:
+        bodies, results = [], []
+        for fast in (False, True):
+            app_main.FAST_RESPONSES = fast
+            bodies.append(request().content)
+            results.append(timed(request, args.requests))
+        same = bodies[0] == bodies[1] or name.startswith("PUT")  # updated_at changes
+        print("{:<26}{:>12.1f}{:>12.1f}{:>9.2f}x  {}".format(name, results[0], results[1], results[0] / results[1], same))
+
+    print()
+    print("{:<26}{:>12}{:>12}{:>10}".format("serialization only", "models us", "fast us", "speedup"))
+    n = args.requests * 10
+    for name, record, model, public in (("user", user, UserOut, publicUser), ("tweet", tweet, Tweet, publicTweet)):
+        slow = timed(lambda: json.dumps(jsonable_encoder(model(**record)), ensure_ascii=False,
+                                        separators=(",", ":")).encode("utf-8"), n)
+        fast = timed(lambda: jsonBytes(public(record)), n)
+        print("{:<26}{:>12.2f}{:>12.2f}{:>9.2f}x".format(name, slow, fast, slow / fast))
+
+
+if __name__ == "__main__":
+    main()
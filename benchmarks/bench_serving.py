@@ -0,0 +1,186 @@
+"""
+Serving profiles compared: dev (the Dockerfile's single uvicorn process,
+--reload, default loop and parser) against production (gunicorn with
+app/gunicorn.conf.py: uvicorn workers with uvloop and httptools, one per
+CPU for the reader workers).
+
+    python benchmarks/bench_serving.py [--profiles dev,production] [--backend memory]
+        [--size N] [--requests N] [--concurrency N] [--output FILE]
+
+Both profiles serve a fresh copy of the same generated dataset (see
+generate.py). With the memory backend the production profile runs the
+multi-worker mode: a writer plus reader workers, GET requests are sent
+to the readers as nginx would (nginx/production.d), everything else to
+the writer. The sqlite backend runs one worker (it keeps the trends and
+timelines in memory).
+
+The load is a few read endpoints and tweet creation, sent over
+``--concurrency`` keep-alive HTTP/1.1 connections. The client runs on the
+same machine: give it spare CPUs or the app and the client compete.
+nginx (gzip, keepalive, micro-cache) is not included, point a load tool
+at the compose stacks for that.
+
+Prints and writes to ``--output`` (JSON, by default
+benchmarks/results/serving-<commit>.json) the throughput and p50 / p95 /
+p99 latency per endpoint and profile; ``bench_endpoints.py --compare``
+reads it.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Tuple
+
+import generate
+from bench_endpoints import APP_DIR, BENCH_DIR, Request, commit, drive, free_port, json_body, prepare, sample_ids
+
+
+def wait_ready(server: subprocess.Popen, port: int) -> None:
+    while True:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+            connection.request("GET", "/tweets/00000000-0000-0000-0000-000000000000")
+            connection.getresponse().read()
+            connection.close()
+            return
+        except ConnectionError:
+            if server.poll() is not None:
+                raise RuntimeError("the server exited with {}".format(server.returncode))
+            time.sleep(0.05)
+
+
+def start(profile: str, env: Dict[str, str], port: int) -> subprocess.Popen:
+    if profile == "dev":
+        command = [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", APP_DIR, "--port", str(port),
+                   "--reload", "--reload-dir", APP_DIR, "--no-access-log", "--log-level", "warning"]
+        cwd = env["DATA_DIR"]
+    else:
+        command = [sys.executable, "-m", "gunicorn", "main:app", "-c", "gunicorn.conf.py",
+                   "--bind", "127.0.0.1:{}".format(port), "--log-level", "warning"]
+        cwd = APP_DIR  # gunicorn.conf.py is read from there, the data is in DATA_DIR
+    server = subprocess.Popen(command, cwd=cwd, env=env)
+    wait_ready(server, port)
+    return server
+
+
+def plan(size: int, seed: int, requests: int) -> List[Tuple[str, int, Callable[[int], Request]]]:
+    users, tweets = sample_ids(size, seed, requests)
+
+    def get(path):
+        return lambda i: ("GET", path(i), None, None)
+
+    return [
+        ("GET /tweets?limit=20", requests, get(lambda i: "/tweets?limit=20")),
+        ("GET /tweets/{id}", requests, get(lambda i: "/tweets/{}".format(tweets[i % len(tweets)]["id"]))),
+        ("GET /users/{id}", requests, get(lambda i: "/users/{}".format(users[i % len(users)]))),
+        ("GET /users/{id}/tweets", requests, get(
+            lambda i: "/users/{}/tweets?limit=20".format(users[i % len(users)]))),
+        ("POST /tweets", requests, lambda i: ("POST", "/tweets", *json_body({
+            "content": "Serving benchmark {} #bench".format(i), "created_by": users[i % len(users)],
+        }))),
+    ]
+
+
+def run(profile: str, env: Dict[str, str], backend: str, size: int, seed: int, requests: int,
+        concurrency: int) -> List[Dict]:
+    servers = []
+    try:
+        write_port = free_port()
+        if profile == "production" and backend == "memory":
+            servers.append(start(profile, dict(env, WORKER_ROLE="writer"), write_port))
+            read_port = free_port()
+            servers.append(start(profile, dict(env, WORKER_ROLE="reader"), read_port))
+        else:
+            servers.append(start(profile, env, write_port))
+            read_port = write_port
+        local = threading.local()
+
+        def send(request: Request) -> int:
+            method, path, body, content_type = request
+            port = read_port if method in ("GET", "HEAD") else write_port
+            connections = getattr(local, "connections", None)
+            if connections is None:
+                connections = local.connections = {}
+            connection = connections.get(port)
+            if connection is None:
+                connection = connections[port] = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+            headers = {"content-type": content_type} if content_type else {}
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status
+
+        drive(send, plan(size, seed, max(10, requests // 10)), concurrency)  # warm up
+        return drive(send, plan(size, seed, requests), concurrency)
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profiles", default="dev,production", help="dev, production")
+    parser.add_argument("--backend", default="memory", help="memory, sqlite")
+    parser.add_argument("--size", type=int, default=10000, help="users and tweets of the dataset")
+    parser.add_argument("--requests", type=int, default=2000, help="per endpoint")
+    parser.add_argument("--concurrency", type=int, default=16, help="connections")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="results file")
+    args = parser.parse_args()
+
+    sha, dirty = commit()
+    output = args.output or os.path.join(BENCH_DIR, "results", "serving-{}{}.json".format(
+        (sha or "unknown")[:10], "-dirty" if dirty else ""))
+    report = {
+        "commit": sha,
+        "dirty": dirty,
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "settings": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+            "server_workers": os.environ.get("SERVER_WORKERS") or None,
+        },
+        "runs": [],
+    }
+
+    pristine = tempfile.mkdtemp(prefix="bench-dataset-")
+    generate.generate(pristine, args.size, args.size, args.seed)
+    print("{:<11} {:<24}{:>7}{:>6}{:>10}{:>9}{:>9}{:>9}".format(
+        "profile", "endpoint", "reqs", "errs", "req/s", "p50 ms", "p95 ms", "p99 ms"))
+    try:
+        for profile in args.profiles.split(","):
+            data_dir, env = prepare(pristine, args.backend)
+            try:
+                endpoints = run(profile, env, args.backend, args.size, args.seed, args.requests, args.concurrency)
+            finally:
+                shutil.rmtree(data_dir, ignore_errors=True)
+            # bench_endpoints.py --compare matches runs on size, backend and client
+            report["runs"].append(dict(size=args.size, backend=args.backend, client=profile, endpoints=endpoints))
+            for e in endpoints:
+                print("{:<11} {:<24}{:>7}{:>6}{:>10.1f}{:>9.2f}{:>9.2f}{:>9.2f}".format(
+                    profile, e["endpoint"], e["requests"], e["errors"],
+                    e["throughput_rps"], e["p50_ms"], e["p95_ms"], e["p99_ms"]))
+    finally:
+        shutil.rmtree(pristine, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print("results written to {}".format(output))
+
+
+if __name__ == "__main__":
+    main()
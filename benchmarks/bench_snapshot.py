@@ -0,0 +1,109 @@
+"""
+Cost of the snapshots of the multi-worker mode (WORKER_ROLE, see
+app/storage/snapshot.py) as the number of tweets grows.
+
+    python benchmarks/bench_snapshot.py [--sizes 10000,100000,500000] [--repeat N]
+
+For every size it loads that many tweets in a memory backend, then
+times, after one more write:
+
+- publish: the writer writing the whole snapshot segment again (done
+  at most once per SNAPSHOT_PUBLISH_MS while writes go on);
+- reader get: a reader mapping the new segment and reading one tweet;
+- reader page: a reader building the listing index (created_by) of the
+  new generation on its first page, then that page.
+
+Publish and reader page are O(tweets): when either takes longer than
+SNAPSHOT_PUBLISH_MS the readers spend their time rebuilding indexes
+under a steady stream of writes.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+
+
+def generate(users: int, tweets: int, seed: int):
+    rng = random.Random(seed)
+    authors = [str(uuid.UUID(int=rng.getrandbits(128), version=4)) for _ in range(users)]
+    start = datetime(2021, 1, 1)
+    for i in range(tweets):
+        created = start + timedelta(seconds=i)
+        yield {
+            "id": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            "content": "Snapshot benchmark tweet {} #bench".format(i),
+            "created_by": authors[i % users],
+            "created_at": str(created),
+            "updated_at": None,
+            "deleted_at": None,
+        }
+
+
+def run(size: int, repeat: int, seed: int):
+    from storage.memory import MemoryBackend
+    from storage.snapshot import SnapshotCollection, SnapshotPublisher, snapshot_path
+
+    data_dir = tempfile.mkdtemp(prefix="bench-snapshot-")
+    records = list(generate(max(1, size // 10), size, seed))
+    # the snapshot the memory backend loads on startup
+    with open(os.path.join(data_dir, "tweets.json"), "w", encoding="utf-8") as f:
+        json.dump(records, f)
+    backend = MemoryBackend(data_dir, checkpoint_seconds=0)
+    try:
+        tweets = backend.collection("tweets", ("created_by",))
+        path = snapshot_path(data_dir, "tweets")
+        # published by hand only: the thread waits for a change that never comes
+        publisher = SnapshotPublisher(path, tweets.published, interval_ms=3600 * 1000)
+        reader = SnapshotCollection(path, "tweets", ("created_by",))
+        author = records[0]["created_by"]
+        publish, get, page = [], [], []
+        for n in range(repeat):
+            tweets.update(records[n]["id"], {"content": "changed {}".format(n)})
+            start = time.perf_counter()
+            publisher.publish()
+            publish.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            reader.get(records[n]["id"])
+            get.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            reader.page(20, field="created_by", value=author, reverse=True)
+            page.append(time.perf_counter() - start)
+        return os.path.getsize(path), [statistics.median(t) * 1000 for t in (publish, get, page)]
+    finally:
+        backend.close()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000,500000")
+    parser.add_argument("--repeat", type=int, default=5, help="publishes per size (median)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # the settings are read on import: keep them away from any data
+    scratch = tempfile.mkdtemp(prefix="bench-snapshot-")
+    os.environ.update(APP_NAME=os.environ.get("APP_NAME") or "bench", STORAGE_BACKEND="json", DATA_DIR=scratch,
+                      TWEET_PARTITIONS="", METRICS="0", WARM_START="0")
+    sys.path.insert(0, APP_DIR)
+
+    print("{:>10}{:>12}{:>14}{:>16}{:>17}".format("tweets", "MB", "publish ms", "reader get ms", "reader page ms"))
+    try:
+        for size in (int(s) for s in args.sizes.split(",")):
+            segment, (publish, get, page) = run(size, args.repeat, args.seed)
+            print("{:>10}{:>12.1f}{:>14.1f}{:>16.2f}{:>17.1f}".format(size, segment / 2 ** 20, publish, get, page))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Memory footprint and read speed of the in-memory tweet stores: dict
+(RecordIndex, one dict per tweet) vs columnar (ColumnarTweetIndex,
+TWEET_STORE=columnar).
+
+    python benchmarks/bench_tweet_store.py [--users N] [--tweets N]
+
+Builds both stores from the same generated tweets, measures the bytes
+allocated per tweet with tracemalloc, checks that both give back the
+same records and times get / page / author page.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+
+
+def generate(users: int, tweets: int):
+    authors = [str(uuid.uuid4()) for _ in range(users)]
+    start = datetime(2021, 1, 1)
+    for i in range(tweets):
+        created = start + timedelta(seconds=i, microseconds=random.randrange(1000000))
+        yield {
+            "id": str(uuid.uuid4()),
+            "content": "Tweet number {} #python @user{} ñandú ✓".format(i, i % users),
+            "created_by": authors[i % users],
+            "created_at": str(created),
+            "updated_at": str(created + timedelta(minutes=5)) if i % 10 == 0 else None,
+            "deleted_at": str(created + timedelta(hours=1)) if i % 50 == 0 else None,
+        }
+
+
+def build(store, records):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    index = store(("created_by",), records)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return index, size
+
+
+def timed(fn, n: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n * 1e6  # us
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--tweets", type=int, default=200000)
+    args = parser.parse_args()
+
+    os.environ.setdefault("APP_NAME", "bench")
+    sys.path.insert(0, APP_DIR)
+    from storage.columnar import ColumnarTweetIndex
+    from storage.index import RecordIndex
+
+    records = list(generate(args.users, args.tweets))
+    # both stores get records decoded one at a time, as when they are
+    # loaded from the JSON file
+    dicts, dict_bytes = build(RecordIndex, (json.loads(json.dumps(r)) for r in records))
+    columns, columnar_bytes = build(ColumnarTweetIndex, (json.loads(json.dumps(r)) for r in records))
+
+    assert list(columns.values()) == records
+    assert dicts.page(100, field="created_by", value=records[0]["created_by"]) == \
+        columns.page(100, field="created_by", value=records[0]["created_by"])
+
+    print("{} tweets, {} authors".format(args.tweets, args.users))
+    print("{:<12}{:>14}{:>14}".format("store", "MB", "bytes/tweet"))
+    for name, size in (("dict", dict_bytes), ("columnar", columnar_bytes)):
+        print("{:<12}{:>14.1f}{:>14.0f}".format(name, size / 2 ** 20, size / args.tweets))
+
+    print()
+    print("{:<22}{:>12}{:>12}".format("read", "dict us", "columnar us"))
+    ids = [r["id"] for r in random.sample(records, 1000)]
+    middle = records[len(records) // 2]["id"]
+    author = records[1]["created_by"]
+    reads = (
+        ("get", lambda store: [store.get(id) for id in ids], 1),
+        ("page 100", lambda store: store.page(100, after=middle), 1000),
+        ("author page 100", lambda store: store.page(100, field="created_by", value=author, reverse=True), 1000),
+    )
+    for name, read, n in reads:
+        per = 1000 if name == "get" else 1
+        times = [timed(lambda: read(store), max(1, n // per * 10)) / per for store in (dicts, columns)]
+        print("{:<22}{:>12.2f}{:>12.2f}".format(name, *times))
+
+
+if __name__ == "__main__":
+    main()
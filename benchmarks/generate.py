@@ -0,0 +1,107 @@
+"""
+Synthetic dataset in the on-disk format of the app (users.json and
+tweets.json, JSON arrays of the stored records).
+
+    python benchmarks/generate.py --users N --tweets N [--out DIR] [--seed N]
+
+Every user has the password PASSWORD, hashed once with the current
+policy (PASSWORD_SCHEME / PASSWORD_ROUNDS) so logins don't rehash it.
+Records are written one at a time: 1M users and tweets don't need to fit
+in memory. Tweets are spread over the users and over the last year, with
+a few hashtags and mentions; 2% are soft deleted. The same seed gives the
+same data (ids included).
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Iterator
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+sys.path.insert(0, APP_DIR)
+
+PASSWORD = "benchmark-password"
+WORDS = ("python", "fastapi", "storage", "latency", "index", "cache", "tweet", "json", "worker", "nginx")
+START = datetime(2021, 1, 1)
+
+
+def user_id(seed: int, i: int) -> str:
+    return str(uuid.UUID(int=random.Random("{}-user-{}".format(seed, i)).getrandbits(128), version=4))
+
+
+def user_email(i: int) -> str:
+    return "user{}@example.com".format(i)
+
+
+def users(count: int, seed: int, password_hash: str) -> Iterator[Dict]:
+    for i in range(count):
+        created = START + timedelta(seconds=i)
+        yield {
+            "id": user_id(seed, i),
+            "email": user_email(i),
+            "first_name": "First{}".format(i % 1000),
+            "last_name": "Last{}".format(i % 997),
+            "born_date": str(START.date() - timedelta(days=7000 + i % 10000)),
+            "created_at": str(created),
+            "updated_at": None,
+            "deleted_at": None,
+            "password": password_hash,
+        }
+
+
+def tweets(count: int, user_count: int, seed: int) -> Iterator[Dict]:
+    rng = random.Random(seed)
+    authors = [user_id(seed, i) for i in range(user_count)]
+    step = 365 * 24 * 3600 / max(count, 1)
+    for i in range(count):
+        created = START + timedelta(seconds=i * step, microseconds=rng.randrange(1000000))
+        words = " ".join(rng.choice(WORDS) for _ in range(rng.randrange(3, 12)))
+        content = "{} #{} @user{} {}".format(words, rng.choice(WORDS), rng.randrange(user_count), i)
+        yield {
+            "id": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            "content": content,
+            "created_by": authors[rng.randrange(user_count)],
+            "created_at": str(created),
+            "updated_at": str(created + timedelta(minutes=5)) if i % 10 == 0 else None,
+            "deleted_at": str(created + timedelta(hours=1)) if i % 50 == 0 else None,
+        }
+
+
+def generate(out: str, user_count: int, tweet_count: int, seed: int = 0) -> None:
+    """
+    Write users.json and tweets.json to the directory ``out``.
+    """
+    from passwords import build_context
+    from storage.jsonfile import write_json_array
+
+    os.makedirs(out, exist_ok=True)
+    password_hash = build_context().hash(PASSWORD)
+    for name, records in (
+        ("users", users(user_count, seed, password_hash)),
+        ("tweets", tweets(tweet_count, user_count, seed)),
+    ):
+        path = os.path.join(out, "{}.json".format(name))
+        with open("{}.tmp".format(path), "w", encoding="utf-8") as f:
+            write_json_array(f, records)
+        os.replace("{}.tmp".format(path), path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--tweets", type=int, default=1000)
+    parser.add_argument("--out", default=".", help="directory (DATA_DIR of the app)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    generate(args.out, args.users, args.tweets, args.seed)
+    print("{} users, {} tweets written to {} in {:.1f}s".format(
+        args.users, args.tweets, os.path.abspath(args.out), time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
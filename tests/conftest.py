@@ -0,0 +1,53 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# the app reads its settings and opens its storage when imported: keep it
+# away from any data
+os.environ.update(
+    APP_NAME="test",
+    STORAGE_BACKEND="memory",
+    DATA_DIR=tempfile.mkdtemp(prefix="twitter-tests-"),
+    WARM_START="0",
+    TIER_INTERVAL_SECONDS="0",
+    PASSWORD_ROUNDS="4",
+    METRICS="0",
+)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+BACKENDS = ["json", "memory", "sqlite", "json-partitioned", "memory-partitioned", "sqlite-partitioned"]
+
+
+def open_backend(name: str, data_dir: str):
+    if name == "json":
+        from storage.jsonfile import JsonBackend
+        return JsonBackend(data_dir)
+    if name == "memory":
+        from storage.memory import MemoryBackend
+        return MemoryBackend(data_dir, checkpoint_seconds=0)
+    if name == "sqlite":
+        from storage.sqlite import SqliteBackend
+        return SqliteBackend(os.path.join(data_dir, "twitter.db"))
+    raise ValueError(name)
+
+
+@pytest.fixture(params=BACKENDS)
+def tweets(request, tmp_path):
+    """
+    The tweets collection of each backend, single or partitioned by
+    author into 4 buckets.
+    """
+    from storage.partitioned import Layout, PartitionedCollection, manifest_path
+
+    name, _, partitioned = request.param.partition("-")
+    backend = open_backend(name, str(tmp_path))
+    if partitioned:
+        collection = PartitionedCollection(backend, manifest_path(str(tmp_path), "tweets"), "tweets",
+                                           ("created_by",), Layout(("author",), 4))
+    else:
+        collection = backend.collection("tweets", ("created_by",))
+    yield collection
+    collection.close()
+    backend.close()
@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+from admission import AdmissionMiddleware, RouteLimit, TokenBuckets, parse_limits
+
+
+def admitted_app(release: asyncio.Event, **limits) -> AdmissionMiddleware:
+    async def slow(request):
+        await release.wait()
+        return PlainTextResponse("slow")
+
+    async def fast(request):
+        return PlainTextResponse("fast")
+
+    return AdmissionMiddleware(Starlette(routes=[Route("/slow/{n}", slow), Route("/fast", fast)]), **limits)
+
+
+async def call(app: AdmissionMiddleware, path: str, client: str = "10.0.0.1"):
+    # the status and headers of a GET of ``path``
+    scope = {"app": app.app, "type": "http", "http_version": "1.1", "method": "GET", "scheme": "http", "path": path,
+             "raw_path": path.encode(), "root_path": "", "query_string": b"", "headers": [],
+             "client": (client, 1234), "server": ("test", 80)}
+    started = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            started.append((message["status"], dict(message["headers"])))
+
+    await app(scope, receive, send)
+    return started[0]
+
+
+def test_requests_over_the_limit_wait_then_are_shed_when_the_queue_is_full():
+    async def run():
+        release = asyncio.Event()
+        app = admitted_app(release, limits={"GET /slow/{n}": 1}, client_rates={})
+        limit = app.limits["GET /slow/{n}"]
+        limit.queue_size, limit.queue_seconds = 1, 5
+        first = asyncio.ensure_future(call(app, "/slow/1"))
+        second = asyncio.ensure_future(call(app, "/slow/2"))
+        await asyncio.sleep(0.01)
+        assert (limit.active, limit.waiting) == (1, 1)
+        shed, headers = await call(app, "/slow/3")
+        assert shed == 503 and int(headers[b"retry-after"]) >= 1
+        assert (await call(app, "/fast"))[0] == 200  # other routes skip the line
+        release.set()
+        assert [(await first)[0], (await second)[0]] == [200, 200]
+        assert (limit.active, limit.waiting) == (0, 0)
+
+        # waited too long: shed too, and the slot goes on
+        release.clear()
+        limit.queue_seconds = 0.01
+        first = asyncio.ensure_future(call(app, "/slow/1"))
+        await asyncio.sleep(0)
+        assert (await call(app, "/slow/2"))[0] == 503
+        release.set()
+        assert (await first)[0] == 200 and limit.active == 0
+
+    asyncio.run(run())
+
+
+def test_route_limit_hands_its_slot_to_the_oldest_waiter():
+    async def run():
+        limit = RouteLimit("test", limit=1, queue_size=2, queue_seconds=5)
+        assert await limit.acquire()
+        waiters = [asyncio.ensure_future(limit.acquire()) for _ in range(2)]
+        await asyncio.sleep(0)
+        assert limit.waiting == 2 and not await limit.acquire()
+        limit.release(0.5)
+        assert await waiters[0] and not waiters[1].done()
+        limit.release(0.5)
+        assert await waiters[1] and limit.active == 1
+        limit.release()
+        assert limit.active == 0 and limit.service == 0.5
+
+    asyncio.run(run())
+
+
+def test_clients_over_their_rate_get_429():
+    async def run():
+        app = admitted_app(asyncio.Event(), limits={}, client_rates={"GET /fast": TokenBuckets(60, 2)})
+        statuses = [(await call(app, "/fast"))[0] for _ in range(3)]
+        assert statuses == [200, 200, 429]
+        assert (await call(app, "/fast", client="10.0.0.2"))[0] == 200
+        status, headers = await call(app, "/fast")
+        assert status == 429 and headers[b"retry-after"] == b"1"
+
+    asyncio.run(run())
+
+
+def test_parse_limits():
+    assert parse_limits(" post /login=4, GET /tweets=8,") == {"POST /login": 4, "GET /tweets": 8}
+    assert parse_limits("") == {}
+    for text in ("POST /login", "/login=4", "POST /login=four"):
+        with pytest.raises(ValueError):
+            parse_limits(text)
@@ -0,0 +1,323 @@
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+
+
+@pytest.fixture(scope="module")
+def client():
+    import main
+    with TestClient(main.app) as client:
+        yield client
+
+
+def signup(client, **fields):
+    user = dict(email="{}@example.com".format(uuid.uuid4().hex[:10]), password="12345678",
+                first_name="Jo", last_name="Doe", born_date="2000-01-01", **fields)
+    return client.post("/singup", json=user)
+
+
+def test_signup_with_a_used_id_is_a_conflict(client):
+    user = signup(client).json()
+    response = signup(client, id=user["id"])
+    assert response.status_code == 409
+    assert client.get("/users/{}".format(user["id"])).json()["email"] == user["email"]
+
+
+def test_tweet_with_a_used_id_is_a_conflict(client):
+    author = signup(client).json()["id"]
+    other = signup(client).json()["id"]
+    tweet = client.post("/tweets", json={"content": "mine", "created_by": author}).json()
+    response = client.post("/tweets", json={"id": tweet["id"], "content": "yours", "created_by": other})
+    assert response.status_code == 409
+    assert client.get("/tweets/{}".format(tweet["id"])).json()["content"] == "mine"
+
+
+def test_tweet_with_the_id_of_a_cold_tweet_is_a_conflict(client):
+    from storage import tweets
+    from storage.tiering import move
+
+    author = signup(client).json()["id"]
+    tweet = client.post("/tweets", json={"content": "old", "created_by": author}).json()
+    assert move(tweets.collection, tweets.cold, lambda t: t["id"] == tweet["id"]) == 1
+    response = client.post("/tweets", json={"id": tweet["id"], "content": "again", "created_by": author})
+    assert response.status_code == 409
+    batch = client.post("/tweets/batch", json=[{"id": tweet["id"], "content": "again", "created_by": author}])
+    assert batch.json()[0]["status"] == 409
+    assert client.get("/tweets/{}".format(tweet["id"])).json()["content"] == "old"
+
+
+def test_cold_tweet_can_be_updated_and_deleted(client):
+    from storage import tweets
+    from storage.tiering import move
+
+    author = signup(client).json()["id"]
+    tweet = client.post("/tweets", json={"content": "old", "created_by": author}).json()
+    assert move(tweets.collection, tweets.cold, lambda t: t["id"] == tweet["id"]) == 1
+    path = "/tweets/{}".format(tweet["id"])
+    other = signup(client).json()["id"]
+    assert client.put(path + "/update", json={"content": "not mine", "created_by": other}).status_code == 404
+    response = client.put(path + "/update", json={"content": "new", "created_by": author})
+    assert response.status_code == 200 and response.json()["content"] == "new"
+    assert client.get(path).json()["content"] == "new"
+    assert client.delete(path + "/delete", json=author).json()["deleted_at"] is not None
+    assert client.put(path + "/update", json={"content": "again", "created_by": author}).status_code == 404
+
+
+def test_batch_id_taken_after_the_check_fails_that_item_only(client, monkeypatch):
+    from storage import tweets
+
+    author = signup(client).json()["id"]
+    taken = client.post("/tweets", json={"content": "first", "created_by": author}).json()
+    used = tweets.used
+    checks = []
+
+    def racing(ids):
+        # the first check runs before the concurrent insert
+        checks.append(ids)
+        return set() if len(checks) == 1 else used(ids)
+
+    monkeypatch.setattr(tweets, "used", racing)
+    batch = client.post("/tweets/batch", json=[
+        {"id": taken["id"], "content": "again", "created_by": author},
+        {"content": "new", "created_by": author},
+    ]).json()
+    assert [r["status"] for r in batch] == [409, 201]
+    assert client.get("/tweets/{}".format(batch[1]["tweet"]["id"])).json()["content"] == "new"
+    assert client.get("/tweets/{}".format(taken["id"])).json()["content"] == "first"
+
+
+def test_admin_token(monkeypatch):
+    from fastapi import HTTPException
+
+    import main
+
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "s3cret")
+    main.verify_admin("s3cret")
+    for token in (None, "", "s3cre", "s3cret!", "sécret"):
+        with pytest.raises(HTTPException) as refused:
+            main.verify_admin(token)
+        assert refused.value.status_code == 403
+
+
+def test_author_tweets_are_paged_with_the_next_cursor(client):
+    author = signup(client).json()["id"]
+    other = signup(client).json()["id"]
+    ids = [client.post("/tweets", json={"content": "tweet {}".format(n), "created_by": author}).json()["id"]
+           for n in range(5)]
+    client.post("/tweets", json={"content": "not mine", "created_by": other})
+    path = "/users/{}/tweets".format(author)
+    pages, cursor = [], None
+    while True:
+        response = client.get(path, params={"limit": 2, "cursor": cursor} if cursor else {"limit": 2})
+        pages.append([t["id"] for t in response.json()])
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert pages == [ids[:2:-1], ids[2:0:-1], ids[:1]]
+    # the cursor of the last tweet: past the end
+    from storage.repository import encode_cursor
+    response = client.get(path, params={"cursor": encode_cursor(ids[0])})
+    assert response.status_code == 200 and response.json() == [] and "X-Next-Cursor" not in response.headers
+    assert client.get(path, params={"cursor": "not a cursor!"}).status_code == 400
+    assert client.get(path, params={"cursor": encode_cursor(str(uuid.uuid4()))}).status_code == 400
+    assert client.get("/users/{}/tweets".format(uuid.uuid4())).status_code == 404
+
+
+def test_all_tweets_are_paged_in_insertion_order(client):
+    author = signup(client).json()["id"]
+    ids = [client.post("/tweets", json={"content": "tweet {}".format(n), "created_by": author}).json()["id"]
+           for n in range(3)]
+    everything = [t["id"] for t in client.get("/tweets").json()]
+    seen, cursor = [], None
+    while True:
+        response = client.get("/tweets", params={"limit": 2, "cursor": cursor} if cursor else {"limit": 2})
+        assert len(response.json()) <= 2
+        seen.extend(t["id"] for t in response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+    assert seen == everything and seen[-3:] == ids
+
+
+def test_listings_stream_as_ndjson(client):
+    import json
+
+    author = signup(client).json()["id"]
+    client.post("/tweets", json={"content": "streamed", "created_by": author})
+    for path in ("/tweets", "/users"):
+        listed = client.get(path).json()
+        streamed = client.get(path, params={"stream": "true"})
+        assert streamed.headers["content-type"].startswith("application/x-ndjson")
+        assert [json.loads(line) for line in streamed.text.splitlines()] == listed
+        accepted = client.get(path, headers={"Accept": "application/x-ndjson"})
+        assert accepted.text == streamed.text
+
+
+def test_signup_and_login_answer_503_when_the_hasher_is_full(client, monkeypatch):
+    from passwords import hasher
+
+    email = signup(client).json()["email"]
+    login = {"email": email, "password": "12345678"}
+    monkeypatch.setattr(hasher, "max_pending", 0)
+    for response in (signup(client), client.post("/login", data=login)):
+        assert response.status_code == 503 and response.headers["Retry-After"] == "1"
+    monkeypatch.undo()
+    assert client.post("/login", data=login).status_code == 200
+
+
+def test_login_rehashes_a_password_of_an_older_policy(client):
+    from passwords import build_context
+    from storage import users
+
+    user = signup(client).json()
+    older = build_context("bcrypt", 5).hash("12345678")
+    users.update(user["id"], {"password": older})
+    login = {"email": user["email"], "password": "12345678"}
+    assert client.post("/login", data={"email": user["email"], "password": "87654321"}).status_code == 401
+    assert users.get(user["id"])["password"] == older
+    assert client.post("/login", data=login).status_code == 200
+    rehashed = users.get(user["id"])["password"]
+    assert rehashed.startswith("$2b$04$") and build_context("bcrypt", 4).verify("12345678", rehashed)
+    assert client.post("/login", data=login).status_code == 200
+    assert users.get(user["id"])["password"] == rehashed
+
+
+def test_conditional_gets_answer_304_until_the_data_changes(client):
+    author = signup(client).json()["id"]
+    tweet = client.post("/tweets", json={"content": "cached", "created_by": author}).json()
+    path = "/tweets/{}".format(tweet["id"])
+    etags = {}
+    for url in (path, "/tweets", "/users/{}/tweets".format(author)):
+        first = client.get(url)
+        etag = etags[url] = first.headers["ETag"]
+        for tag in (etag, "W/" + etag, '"other", ' + etag, "*"):
+            response = client.get(url, headers={"If-None-Match": tag})
+            assert response.status_code == 304 and response.content == b"" and response.headers["ETag"] == etag
+        assert client.get(url, headers={"If-None-Match": '"other"'}).status_code == 200
+        since = client.get(url, headers={"If-Modified-Since": first.headers["Last-Modified"]})
+        assert since.status_code == 304
+    client.put(path + "/update", json={"content": "changed", "created_by": author})
+    for url, before in etags.items():
+        response = client.get(url, headers={"If-None-Match": before})
+        assert response.status_code == 200 and response.headers["ETag"] != before
+    assert client.get(path).json()["content"] == "changed"
+
+
+def test_fast_responses_send_the_bytes_of_the_response_models(client, monkeypatch):
+    import main
+
+    user = signup(client).json()
+    tweet = client.post("/tweets", json={"content": 'héllo "✓" 😀', "created_by": user["id"]}).json()
+    client.put("/tweets/{}/update".format(tweet["id"]), json={"content": "né", "created_by": user["id"]})
+    urls = [
+        "/users/{}".format(user["id"]),
+        "/tweets/{}".format(tweet["id"]),
+        "/users/{}/tweets".format(user["id"]),
+        "/tweets?limit=3",
+        "/tweets?ids={},{}".format(tweet["id"], uuid.uuid4()),
+        "/users?limit=3",
+    ]
+    bodies = {}
+    for fast in (False, True):
+        monkeypatch.setattr(main, "FAST_RESPONSES", fast)
+        bodies[fast] = [client.get(url).content for url in urls]
+    assert bodies[True] == bodies[False]
+    assert "né".encode("utf-8") in bodies[True][1]
+
+
+def test_batch_create_answers_per_item_and_lookup_keeps_the_order(client):
+    author = signup(client).json()["id"]
+    existing = client.post("/tweets", json={"content": "existing", "created_by": author}).json()
+    twice = str(uuid.uuid4())
+    response = client.post("/tweets/batch", json=[
+        {"content": "one", "created_by": author},
+        {"content": "ghost", "created_by": str(uuid.uuid4())},
+        {"created_by": author},
+        {"id": existing["id"], "content": "again", "created_by": author},
+        {"id": twice, "content": "first", "created_by": author},
+        {"id": twice, "content": "second", "created_by": author},
+    ])
+    assert response.status_code == 207
+    results = response.json()
+    assert [r["index"] for r in results] == list(range(6))
+    assert [r["status"] for r in results] == [201, 401, 422, 409, 201, 409]
+    created = [results[0]["tweet"]["id"], twice]
+    assert client.get("/tweets/{}".format(twice)).json()["content"] == "first"
+
+    unknown = str(uuid.uuid4())
+    ids = [twice, unknown, existing["id"], created[0], twice]
+    expected = [twice, existing["id"], created[0]]
+    assert [t["id"] for t in client.post("/tweets/lookup", json={"ids": ids}).json()] == expected
+    assert [t["id"] for t in client.get("/tweets", params={"ids": ",".join(ids)}).json()] == expected
+    assert client.get("/tweets", params={"ids": "not-an-id"}).status_code == 422
+    assert client.post("/tweets/lookup", json={"ids": [unknown] * 1001}).status_code == 413
+    too_many = [{"content": "n", "created_by": author}] * 1001
+    assert client.post("/tweets/batch", json=too_many).status_code == 413
+
+
+def test_a_deleted_user_can_no_longer_tweet(client):
+    author = signup(client).json()["id"]
+    assert client.post("/tweets", json={"content": "before", "created_by": author}).status_code == 201
+    assert client.delete("/users/{}/delete".format(author)).status_code == 200
+    assert client.post("/tweets", json={"content": "after", "created_by": author}).status_code == 401
+    batch = client.post("/tweets/batch", json=[{"content": "after", "created_by": author}]).json()
+    assert batch[0]["status"] == 401
+    assert client.post("/tweets", json={"content": "nobody", "created_by": str(uuid.uuid4())}).status_code == 401
+
+
+def test_trends_count_the_tags_of_new_and_updated_tweets(client):
+    author = signup(client).json()["id"]
+    tag = "tag{}".format(uuid.uuid4().hex[:8])
+    tweet = client.post("/tweets", json={"content": "#{} hi".format(tag), "created_by": author}).json()
+    client.put("/tweets/{}/update".format(tweet["id"]),
+               json={"content": "#{} hi again #{}x".format(tag, tag), "created_by": author})
+    trends = client.get("/trends", params={"window": "5m", "limit": 100}).json()
+    counts = {h["name"]: h["count"] for h in trends["hashtags"]}
+    assert trends["window"] == "5m" and counts[tag] == 1 and counts[tag + "x"] == 1
+    assert client.get("/trends", params={"window": "2m"}).status_code == 422
+
+
+def test_metrics_label_requests_with_their_route(client, monkeypatch):
+    import metrics
+
+    monkeypatch.setattr(metrics, "METRICS", True)
+    author = signup(client).json()["id"]
+    tweet = client.post("/tweets", json={"content": "counted", "created_by": author}).json()
+    client.get("/tweets/{}".format(tweet["id"]))
+    client.get("/no/such/path")
+    text = client.get("/metrics").text
+    assert 'http_request_duration_seconds_count{method="GET",route="/tweets/{tweet_id}",status="200"}' in text
+    assert 'http_request_duration_seconds_count{method="GET",route="other",status="404"}' in text
+    assert 'http_request_size_bytes_count{method="POST",route="/tweets"}' in text
+    assert tweet["id"] not in text
+    assert 'storage_write_bytes_total{collection="tweets"}' in text
+
+
+def test_admin_profile_and_slow_requests(client, monkeypatch):
+    import main
+    from profiling import sampler, slow_requests
+
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "s3cret")
+    admin = {"X-Admin-Token": "s3cret"}
+    assert client.post("/admin/profile").status_code == 403
+    assert client.get("/admin/slow", headers={"X-Admin-Token": "wrong"}).status_code == 403
+    try:
+        response = client.post("/admin/profile", params={"seconds": 60, "rate": 500}, headers=admin)
+        assert response.status_code == 202 and response.json()["running"]
+        assert client.post("/admin/profile", headers=admin).status_code == 409
+        while sampler.samples < 3:
+            client.get("/tweets", params={"limit": 1})
+    finally:
+        stopped = client.delete("/admin/profile", headers=admin).json()
+    assert not stopped["running"] and stopped["samples"] >= 3
+    profile = client.get("/admin/profile", headers=admin)
+    assert profile.headers["X-Profile-Running"] == "false"
+    assert int(profile.headers["X-Profile-Samples"]) == stopped["samples"]
+    assert profile.text and all(line.rsplit(" ", 1)[1].isdigit() for line in profile.text.splitlines())
+
+    monkeypatch.setattr(slow_requests, "threshold", 1e-9)
+    client.get("/tweets", params={"limit": 1})
+    slow = client.get("/admin/slow", headers=admin).json()
+    traced = [r for r in slow if r["path"] == "/tweets"][-1]
+    assert traced["method"] == "GET" and traced["status"] == 200 and "scan" in traced["phases_ms"]
@@ -0,0 +1,24 @@
+import json
+
+from starlette.responses import JSONResponse
+
+import helpers
+
+
+def test_ndjson_stream_is_sent_in_chunks_of_whole_lines(monkeypatch):
+    monkeypatch.setattr(helpers, "STREAM_CHUNK_SIZE", 100)
+    records = [{"id": n, "content": "x" * 30} for n in range(10)]
+    chunks = list(helpers.ndjsonStream(iter(records), lambda r: r))
+    assert len(chunks) > 1
+    assert all(chunk.endswith(b"\n") for chunk in chunks)
+    assert all(len(chunk) < 100 + 60 for chunk in chunks)
+    assert [json.loads(line) for line in b"".join(chunks).splitlines()] == records
+    assert list(helpers.ndjsonStream(iter([]), lambda r: r)) == []
+
+
+def test_json_bytes_match_the_json_response_with_or_without_orjson(monkeypatch):
+    content = [{"content": 'héllo "✓" 😀\n', "n": 1, "none": None, "list": [1.5, True]}]
+    expected = JSONResponse(content).body
+    assert helpers.jsonBytes(content) == expected
+    monkeypatch.setattr(helpers, "orjson", None)
+    assert helpers.jsonBytes(content) == expected
@@ -0,0 +1,42 @@
+import threading
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    # metrics made by a test stay out of the app registry
+    monkeypatch.setattr(metrics, "METRICS", True)
+    monkeypatch.setattr(metrics, "REGISTRY", [])
+
+
+def test_histogram_buckets_are_cumulative_over_every_thread(enabled):
+    histogram = metrics.Histogram("test_seconds", "Test.", ("route",), buckets=(0.1, 1.0))
+
+    def observe():
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value, ('/a"b',))
+
+    threads = [threading.Thread(target=observe) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert histogram.collect() == [
+        'test_seconds_bucket{route="/a\\"b",le="0.1"} 6',
+        'test_seconds_bucket{route="/a\\"b",le="1.0"} 9',
+        'test_seconds_bucket{route="/a\\"b",le="+Inf"} 12',
+        'test_seconds_sum{route="/a\\"b"} 10.95',
+        'test_seconds_count{route="/a\\"b"} 12',
+    ]
+    assert "# TYPE test_seconds histogram" in metrics.render()
+
+
+def test_counters_do_nothing_while_metrics_are_off(enabled, monkeypatch):
+    counter = metrics.Counter("test_total", "Test.", ("collection",))
+    counter.inc(("tweets",), 2)
+    monkeypatch.setattr(metrics, "METRICS", False)
+    counter.inc(("tweets",), 5)
+    assert counter.collect() == ['test_total{collection="tweets"} 2']
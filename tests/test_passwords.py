@@ -0,0 +1,41 @@
+import pytest
+
+from passwords import build_context
+
+
+def test_hashes_with_other_rounds_or_schemes_need_an_update():
+    context = build_context("bcrypt", 5)
+    assert not context.needs_update(context.hash("secret"))
+    assert context.needs_update(build_context("bcrypt", 4).hash("secret"))
+    assert context.needs_update(build_context("bcrypt", 6).hash("secret"))
+    legacy = context.hash("secret")
+    context = build_context("pbkdf2_sha256", 1000)
+    assert context.verify("secret", legacy) and context.needs_update(legacy)
+
+
+def test_hasher_pool_hashes_verifies_and_refuses_past_max_pending():
+    import asyncio
+
+    from passwords import HasherBusy, PasswordHasher
+
+    hasher = PasswordHasher(workers=1, max_pending=1)
+    hasher.configure("bcrypt", 4)
+
+    async def run():
+        hashed = await hasher.hash("secret")
+        assert await hasher.verify_and_update("secret", hashed) == (True, None)
+        assert (await hasher.verify_and_update("wrong", hashed))[0] is False
+        first = asyncio.ensure_future(hasher.hash("one"))
+        await asyncio.sleep(0)
+        with pytest.raises(HasherBusy):
+            await hasher.hash("two")
+        await first
+        assert hasher.pending == 0
+        return hashed
+
+    try:
+        assert asyncio.run(run()).startswith("$2b$04$")
+        # processes are spawned, never forked from a threaded server
+        assert hasher._pool._mp_context.get_start_method() == "spawn"
+    finally:
+        hasher.shutdown()
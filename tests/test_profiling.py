@@ -0,0 +1,53 @@
+import threading
+import time
+
+from profiling import SlowRequests, StackSampler, add_phase, phase
+
+
+def waiting_for_the_test(event):
+    event.wait()
+
+
+def test_sampler_counts_the_stacks_of_the_other_threads():
+    event = threading.Event()
+    thread = threading.Thread(target=waiting_for_the_test, args=(event,), name="waiter")
+    thread.start()
+    sampler = StackSampler()
+    try:
+        assert sampler.start(rate=500, seconds=0)
+        assert not sampler.start(rate=500, seconds=0)
+        while sampler.samples < 3:
+            time.sleep(0.01)
+    finally:
+        sampler.stop()
+        event.set()
+        thread.join()
+    assert not sampler.running
+    lines = sampler.collapsed().splitlines()
+    waiting = [line for line in lines if line.startswith("waiter;")]
+    assert waiting and "test_profiling.py:waiting_for_the_test;" in waiting[0]
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert not any(line.startswith("stack-sampler;") for line in lines)
+
+
+def test_sampler_stops_by_itself():
+    sampler = StackSampler()
+    assert sampler.start(rate=200, seconds=0.05)
+    sampler._thread.join(5)
+    assert not sampler.running and sampler.status()["stopped_at"] is not None
+    assert sampler.start(rate=200, seconds=0.05)
+    sampler.stop()
+
+
+def test_slow_requests_keep_the_last_ones_with_their_phases():
+    slow = SlowRequests(threshold_ms=10, kept=2)
+    assert slow.threshold == 0.01
+    for n in range(3):
+        slow.record("GET", "/tweets/{}".format(n), 200, 0.5, {"scan": 0.25, "parse": 0.001})
+    recent = slow.recent()
+    assert [r["path"] for r in recent] == ["/tweets/1", "/tweets/2"]
+    assert recent[0]["ms"] == 500.0 and recent[0]["phases_ms"] == {"parse": 1.0, "scan": 250.0}
+    # outside of a traced request, phases go nowhere
+    add_phase("scan", 1.0)
+    with phase("storage"):
+        pass
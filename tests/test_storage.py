@@ -0,0 +1,625 @@
+import os
+import uuid
+
+import pytest
+
+from storage.base import DuplicateId
+
+
+def tweet(content: str, author: str = None, id: str = None) -> dict:
+    return {
+        "id": id or str(uuid.uuid4()),
+        "content": content,
+        "created_by": author or str(uuid.uuid4()),
+        "created_at": "2021-03-01 10:00:00",
+        "updated_at": None,
+        "deleted_at": None,
+    }
+
+
+def test_insert_refuses_a_used_id(tweets):
+    original = tweets.insert(tweet("original"))
+    # same author (same partition) and another author (another partition)
+    for author in (original["created_by"], str(uuid.uuid4())):
+        with pytest.raises(DuplicateId):
+            tweets.insert(tweet("overwrite", author, original["id"]))
+    assert tweets.get(original["id"]) == original
+    assert [t["id"] for t in tweets.scan()] == [original["id"]]
+
+
+def test_insert_many_writes_nothing_on_a_used_id(tweets):
+    original = tweets.insert(tweet("original"))
+    batch = [tweet("new"), tweet("overwrite", id=original["id"])]
+    with pytest.raises(DuplicateId):
+        tweets.insert_many(batch)
+    repeated = tweet("twice")
+    with pytest.raises(DuplicateId):
+        tweets.insert_many([repeated, dict(repeated, content="again")])
+    assert [t["id"] for t in tweets.scan()] == [original["id"]]
+    assert tweets.get(original["id"]) == original
+
+
+def test_memory_log_survives_a_torn_write(tmp_path):
+    from storage.memory import MemoryBackend
+
+    backend = MemoryBackend(str(tmp_path), checkpoint_seconds=0)
+    first = backend.collection("tweets").insert(tweet("before the crash"))
+    backend.close()
+    with open(tmp_path / "tweets.log", "a", encoding="utf-8") as f:
+        f.write('{"op": "create", "record": {"id": "torn", "cont')  # crash in the middle of an append
+
+    backend = MemoryBackend(str(tmp_path), checkpoint_seconds=0)
+    second = backend.collection("tweets").insert(tweet("after the crash"))
+    backend.close()
+
+    for _ in range(2):  # every later start sees them
+        backend = MemoryBackend(str(tmp_path), checkpoint_seconds=0)
+        tweets = backend.collection("tweets")
+        assert [t["id"] for t in tweets.scan()] == [first["id"], second["id"]]
+        backend.close()
+
+
+def test_memory_log_damaged_before_its_end_is_refused(tmp_path):
+    from storage.memory import MemoryBackend
+
+    backend = MemoryBackend(str(tmp_path), checkpoint_seconds=0)
+    backend.collection("tweets").insert(tweet("first"))
+    backend.close()
+    log = tmp_path / "tweets.log"
+    log.write_text("garbage\n" + log.read_text(encoding="utf-8"), encoding="utf-8")
+    with pytest.raises(ValueError):
+        MemoryBackend(str(tmp_path), checkpoint_seconds=0).collection("tweets")
+
+
+def test_search_catches_up_with_the_changes_only(tweets, tmp_path, monkeypatch):
+    from storage.search import SearchIndex
+
+    kept = tweets.insert(tweet("python stays"))
+    gone = tweets.insert(tweet("python goes"))
+    index = SearchIndex(tweets, str(tmp_path / "search.json"))
+    assert set(index.search("python", 10)) == {kept["id"], gone["id"]}
+    since = tweets.version()[0]
+
+    # written by another process: no apply
+    added = tweets.insert(tweet("python arrives"))
+    tweets.update(kept["id"], {"content": "python changed", "updated_at": "2021-03-02 10:00:00"})
+    tweets.remove([gone["id"]])
+    if tweets.changes(since) is None:
+        pytest.skip("no change tracking, read whole")
+    monkeypatch.setattr(tweets, "scan", lambda: pytest.fail("read whole"))
+    assert set(index.search("python", 10)) == {kept["id"], added["id"]}
+    assert index.search("changed", 10) == [kept["id"]]
+
+
+def test_search_on_a_reader_catches_up_with_the_published_changes(tmp_path, monkeypatch):
+    from storage.memory import MemoryBackend
+    from storage.search import SearchIndex
+    from storage.snapshot import SnapshotCollection, SnapshotPublisher, snapshot_path
+
+    backend = MemoryBackend(str(tmp_path), checkpoint_seconds=0)
+    written = backend.collection("tweets")
+    path = snapshot_path(str(tmp_path), "tweets")
+    publisher = SnapshotPublisher(path, written.published, interval_ms=3600 * 1000)
+    first = written.insert(tweet("python one"))
+    publisher.publish()
+    reader = SnapshotCollection(path, "tweets")
+    index = SearchIndex(reader, str(tmp_path / "search.json"))
+    assert index.search("python", 10) == [first["id"]]
+
+    second = written.insert(tweet("python two"))
+    publisher.publish()
+    written.remove([first["id"]])
+    publisher.publish()
+    monkeypatch.setattr(reader, "scan", lambda: pytest.fail("read whole"))
+    assert index.search("python", 10) == [second["id"]]
+    backend.close()
+
+
+def test_snapshot_publish_failure_is_retried(tmp_path, monkeypatch):
+    import time
+
+    from storage import snapshot
+    from storage.memory import MemoryBackend
+
+    backend = MemoryBackend(str(tmp_path), checkpoint_seconds=0)
+    written = backend.collection("tweets")
+    path = snapshot.snapshot_path(str(tmp_path), "tweets")
+    publisher = snapshot.SnapshotPublisher(path, written.published, interval_ms=1)
+    write_segment = snapshot.write_segment
+    failures = []
+
+    def fail_once(*args, **kwargs):
+        if not failures:
+            failures.append(args)
+            raise OSError(28, "No space left on device")
+        return write_segment(*args, **kwargs)
+
+    monkeypatch.setattr(snapshot, "write_segment", fail_once)
+    monkeypatch.setattr(snapshot, "RETRY_SECONDS", 0.01)
+    record = written.insert(tweet("python"))
+    publisher.changed()
+    reader = snapshot.SnapshotCollection(path, "tweets")
+    deadline = time.monotonic() + 5
+    while reader.get(record["id"]) is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert failures and reader.get(record["id"]) == record
+    assert publisher._thread.is_alive()
+    backend.close()
+
+
+def test_json_scan_never_sees_a_partial_write(tmp_path):
+    import threading
+
+    from storage.jsonfile import JsonBackend
+
+    tweets = JsonBackend(str(tmp_path)).collection("tweets")
+    tweets.insert(tweet("first"))
+    done = threading.Event()
+
+    def write():
+        for n in range(200):
+            tweets.insert(tweet("tweet {}".format(n) * 50))
+        done.set()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    seen = 1
+    while not done.is_set():
+        count = len(list(tweets.scan()))  # ValueError on an empty or truncated file
+        assert count >= seen
+        seen = count
+    writer.join()
+    assert len(list(tweets.scan())) == 201
+
+
+def test_json_version_changes_with_same_size_writes(tmp_path):
+    from storage.jsonfile import JsonBackend
+
+    tweets = JsonBackend(str(tmp_path)).collection("tweets")
+    first = tweets.insert(tweet("aaaa"))
+    path = str(tmp_path / "tweets.json")
+    before = tweets.version()[0]
+    mtime = os.stat(path).st_mtime_ns
+    tweets.update(first["id"], {"content": "bbbb"})
+    os.utime(path, ns=(mtime, mtime))  # within the resolution of the mtime
+    assert tweets.version()[0] != before
+
+
+def test_multi_worker_mode_needs_the_memory_backend():
+    from storage import check_role
+
+    check_role("single", "sqlite")
+    check_role("writer", "memory")
+    check_role("reader", "memory")
+    for role, name in (("writer", "sqlite"), ("reader", "json"), ("readers", "memory")):
+        with pytest.raises(ValueError):
+            check_role(role, name)
+
+
+@pytest.mark.parametrize("name", ["json", "memory", "sqlite"])
+def test_concurrent_follows_count_once(name, tmp_path):
+    import threading
+
+    from conftest import open_backend
+    from storage.repository import FollowRepository
+
+    backend = open_backend(name, str(tmp_path))
+    follows = FollowRepository(backend.collection("follows", ("follower_id", "followed_id")))
+    written = []
+    follows.listeners.append(lambda *args: written.append(args))
+    for round in range(3):  # new, then reactivated after each unfollow
+        start = threading.Barrier(8)
+        new = []
+
+        def follow():
+            start.wait()
+            new.append(follows.follow("a", "b", "2021-03-01 10:00:00")[1])
+
+        threads = [threading.Thread(target=follow) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sorted(new) == [False] * 7 + [True]
+        assert [active for *_, active, _ in written] == [True]
+        assert follows.graph.follower_count("b") == 1
+        follows.unfollow("a", "b", "2021-03-01 11:00:00")
+        written.clear()
+    assert len(list(follows.collection.scan())) == 1
+    backend.close()
+
+
+def test_tiering_moves_the_batches_of_one_scan(tweets, tmp_path, monkeypatch):
+    from storage.cold import ColdTier
+    from storage.tiering import move
+
+    for n in range(25):
+        tweets.insert(tweet("tweet {}".format(n), id="{:02d}".format(n)))
+    scans = []
+    scan = tweets.scan
+    monkeypatch.setattr(tweets, "scan", lambda: scans.append(1) or scan())
+    cold = ColdTier(str(tmp_path), "tweets")
+    assert move(tweets, cold, lambda t: int(t["id"]) % 2 == 0, batch=4) == 13
+    assert len(scans) == 1
+    assert sorted(t["id"] for t in tweets.scan()) == ["{:02d}".format(n) for n in range(1, 25, 2)]
+    assert cold.get("24")["content"] == "tweet 24"
+
+
+def test_tiering_leaves_a_record_changed_meanwhile_out_of_the_cold_tier(tmp_path, monkeypatch):
+    from storage.cold import ColdTier
+    from storage.memory import MemoryBackend
+    from storage.tiering import move
+
+    backend = MemoryBackend(str(tmp_path), checkpoint_seconds=0)
+    tweets = backend.collection("tweets")
+    for n in range(4):
+        tweets.insert(tweet("tweet {}".format(n), id=str(n)))
+    remove = tweets.remove
+
+    def changed_meanwhile(ids, where=None):
+        tweets.update("1", {"content": "changed"})
+        return remove(ids, where)
+
+    monkeypatch.setattr(tweets, "remove", changed_meanwhile)
+    cold = ColdTier(str(tmp_path), "tweets", max_files=2)
+    assert move(tweets, cold, lambda t: True) == 3
+    assert [t["id"] for t in tweets.scan()] == ["1"]
+    assert cold.get("1") is None and len(cold) == 3
+    assert sorted(t["id"] for t in cold) == ["0", "2", "3"]
+    backend.close()
+
+
+@pytest.mark.parametrize("name", ["json", "memory", "sqlite"])
+def test_partitioned_write_reads_its_partition_only(name, tmp_path, monkeypatch):
+    from conftest import open_backend
+    from storage.partitioned import Layout, PartitionedCollection, manifest_path
+
+    backend = open_backend(name, str(tmp_path))
+
+    def partitioned(**kwargs):
+        return PartitionedCollection(backend, manifest_path(str(tmp_path), "tweets"), "tweets",
+                                     ("created_by",), Layout(("author",), 4), **kwargs)
+
+    tweets = partitioned()
+    written = tweets.insert_many([tweet("tweet {}".format(n)) for n in range(20)])
+    record = written[0]
+    key = tweets.layout.key(record)
+    other = next(r for r in written if tweets.layout.key(r) != key)
+    read = []
+    for partition_key, partition in tweets.partitions():
+        for method in ("get", "get_many", "scan", "find", "page"):
+            monkeypatch.setattr(partition, method, lambda *args, original=getattr(partition, method),
+                                k=partition_key, **kwargs: read.append(k) or original(*args, **kwargs))
+    assert tweets.update(record["id"], {"content": "changed"})["content"] == "changed"
+    assert tweets.get(record["id"])["content"] == "changed"
+    with pytest.raises(DuplicateId):
+        tweets.insert(dict(record, created_by=other["created_by"]))
+    assert set(read) == {key}
+    monkeypatch.undo()
+
+    if name != "memory":  # the only backends written by several processes
+        # an id written by another process is found, and refused once rechecked
+        elsewhere = partitioned().insert(tweet("elsewhere"))
+        assert tweets.get(elsewhere["id"]) == elsewhere
+        with pytest.raises(DuplicateId):
+            partitioned(recheck_ms=0).insert(dict(elsewhere, created_by=other["created_by"]))
+    backend.close()
+
+
+def test_migrate_copies_by_batches_and_skips_the_copied_records(tmp_path, monkeypatch, capsys):
+    import storage.__main__ as commands
+    from conftest import open_backend
+
+    for name in ("json", "sqlite"):
+        (tmp_path / name).mkdir()
+    monkeypatch.setattr(commands, "create_backend", lambda name: open_backend(name, str(tmp_path / name)))
+    source = open_backend("json", str(tmp_path / "json"))
+    records = [tweet("tweet {}".format(n)) for n in range(25)]
+    source.collection("tweets", ("created_by",)).insert_many(records)
+    target = open_backend("sqlite", str(tmp_path / "sqlite"))
+    target.collection("tweets", ("created_by",)).insert_many(records[:3])  # an interrupted migrate
+    target.close()
+
+    commands.migrate("json", "sqlite", batch=10)
+    assert "tweets: 22 records copied" in capsys.readouterr().out
+    target = open_backend("sqlite", str(tmp_path / "sqlite"))
+    assert list(target.collection("tweets", ("created_by",)).scan()) == records
+    target.close()
+
+
+def test_segment_convert_includes_the_records_still_in_the_log(tmp_path, monkeypatch, capsys):
+    import storage.__main__ as commands
+    from conftest import open_backend
+    from storage.segment import Segment
+
+    monkeypatch.setattr(commands, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(commands, "STORAGE_BACKEND", "memory")
+    monkeypatch.setattr(commands, "create_backend", lambda name: open_backend(name, str(tmp_path)))
+    backend = open_backend("memory", str(tmp_path))
+    tweets = backend.collection("tweets", ("created_by",))
+    records = [tweet("tweet {}".format(n)) for n in range(5)]
+    tweets.insert_many(records)
+    tweets.compact()
+    records.append(tweets.insert(tweet("only in the log")))
+    tweets.update(records[0]["id"], {"content": "changed"})
+    records[0] = dict(records[0], content="changed")
+    backend.close()
+
+    commands.convert()
+    assert commands.verify()
+    assert "tweets: 6 records, ok" in capsys.readouterr().out
+    segment = Segment(str(tmp_path / "tweets.seg"))
+    assert list(segment) == records and segment.get(records[-1]["id"]) == records[-1]
+    segment.close()
+
+
+def test_memory_write_seen_once_durable(tmp_path, monkeypatch):
+    import threading
+
+    import storage.writer
+    from storage.memory import MemoryBackend
+
+    backend = MemoryBackend(str(tmp_path), checkpoint_seconds=0)
+    tweets = backend.collection("tweets")
+    syncing, release = threading.Event(), threading.Event()
+    fsync = storage.writer.os.fsync
+
+    def slow_fsync(fd):
+        syncing.set()
+        release.wait()
+        fsync(fd)
+
+    monkeypatch.setattr(storage.writer.os, "fsync", slow_fsync)
+    new = tweet("not durable yet")
+    writer = threading.Thread(target=tweets.insert, args=(new,))
+    writer.start()
+    syncing.wait()
+    assert tweets.get(new["id"]) is None and list(tweets.scan()) == []
+    with pytest.raises(DuplicateId):  # but the next writes see it
+        tweets.insert(dict(new))
+    release.set()
+    writer.join()
+    assert tweets.get(new["id"]) == new
+    backend.close()
+
+
+def test_memory_failed_commit_leaves_no_trace(tmp_path, monkeypatch):
+    import storage.writer
+    from storage.memory import MemoryBackend
+
+    backend = MemoryBackend(str(tmp_path), checkpoint_seconds=0)
+    tweets = backend.collection("tweets")
+    first = tweets.insert(tweet("first"))
+    size = os.path.getsize(tmp_path / "tweets.log")
+    version = tweets.version()[0]
+
+    def full(fd):
+        raise OSError(28, "No space left on device")
+
+    with monkeypatch.context() as patched:
+        patched.setattr(storage.writer.os, "fsync", full)
+        lost = tweet("lost")
+        with pytest.raises(OSError):
+            tweets.insert(lost)
+        with pytest.raises(OSError):
+            tweets.update(first["id"], {"content": "lost too"})
+    assert tweets.get(lost["id"]) is None and tweets.get(first["id"]) == first
+    assert tweets.version()[0] == version
+    assert os.path.getsize(tmp_path / "tweets.log") == size
+    second = tweets.insert(tweet("second"))
+    backend.close()
+
+    backend = MemoryBackend(str(tmp_path), checkpoint_seconds=0)
+    assert [t["id"] for t in backend.collection("tweets").scan()] == [first["id"], second["id"]]
+    backend.close()
+
+
+def test_columnar_store_reads_like_the_record_index():
+    from storage.columnar import ColumnarTweetIndex
+    from storage.index import RecordIndex
+
+    author = str(uuid.uuid4())
+    records = [tweet("tweet {} é".format(n), author if n % 2 else None) for n in range(10)]
+    records[3]["likes"] = 7                    # not a column: kept as is
+    records[4]["created_by"] = "not-a-uuid"
+    records[5]["deleted_at"] = "2021-01-02 00:00:00"
+    stores = [ColumnarTweetIndex(("created_by",), records), RecordIndex(("created_by",), records)]
+    for store in stores:
+        store.put(dict(records[1], content="changed"))
+        store.remove(records[2]["id"])
+    columnar, index = stores
+    assert sorted(columnar.values(), key=lambda r: r["id"]) == sorted(index.values(), key=lambda r: r["id"])
+    for id in (records[3]["id"], records[4]["id"], records[2]["id"], str(uuid.uuid4())):
+        assert columnar.get(id) == index.get(id)
+    assert columnar.find("created_by", author) == index.find("created_by", author)
+    first = columnar.page(2, field="created_by", value=author, reverse=True)
+    assert first == index.page(2, field="created_by", value=author, reverse=True)
+    assert columnar.page(2, after=first[-1]["id"], field="created_by", value=author, reverse=True) == \
+        index.page(2, after=first[-1]["id"], field="created_by", value=author, reverse=True)
+    assert columnar.page(5, after=records[9]["id"]) == []
+
+
+def test_columnar_scan_keeps_its_view_and_copies_only_on_write():
+    import pickle
+
+    from storage.columnar import ColumnarTweetIndex
+
+    records = [tweet("tweet {}".format(n)) for n in range(4)]
+    records[0]["likes"] = 1
+    store = ColumnarTweetIndex(("created_by",), records)
+    columns = store._columns
+    assert list(store.values()) == records
+    assert store._columns is columns           # nothing written: nothing copied
+
+    scan = iter(store.values())
+    assert next(scan) == records[0]
+    store.put(dict(records[0], likes=2))
+    store.put(dict(records[1], content="changed"))
+    store.remove(records[2]["id"])
+    store.put(tweet("new"))
+    assert list(scan) == records[1:]
+    assert store._columns is not columns
+    changed = list(store.values())
+    assert [r["content"] for r in changed] == ["tweet 0", "changed", "tweet 3", "new"]
+    assert changed[0]["likes"] == 2
+    # pickled for a warm start while a view is in use
+    view = store.values()
+    assert list(pickle.loads(pickle.dumps(store)).values()) == list(view) == changed
+
+
+def test_author_pages_newest_first_skip_the_deleted_tweets(tweets):
+    author, other = str(uuid.uuid4()), str(uuid.uuid4())
+    mine = [tweet("mine {}".format(n), author) for n in range(5)]
+    tweets.insert_many(mine + [tweet("other", other)])
+    tweets.update(mine[2]["id"], {"deleted_at": "2021-01-02 00:00:00"})
+    expected = [t["id"] for t in reversed(mine) if t is not mine[2]]
+    pages, after = [], None
+    while True:
+        page = tweets.page(2, after, field="created_by", value=author, reverse=True)
+        if not page:
+            break
+        pages.append([t["id"] for t in page])
+        after = page[-1]["id"]
+    assert pages == [expected[:2], expected[2:]]
+    assert tweets.page(2, field="created_by", value=str(uuid.uuid4()), reverse=True) == []
+    with pytest.raises(KeyError):
+        tweets.page(2, str(uuid.uuid4()), field="created_by", value=author, reverse=True)
+
+
+def test_segment_round_trip(tmp_path):
+    from storage.segment import Segment, read_header, write_segment
+
+    path = str(tmp_path / "tweets.seg")
+    records = [tweet("tweet {} é".format(n)) for n in range(50)] + [tweet("not a uuid", id="legacy-1")]
+    records.append(dict(records[3], content="later"))   # the last one wins
+    assert write_segment(path, iter(records), generation=7) == len(records)
+    assert read_header(path)[:2] == (7, len(records))
+    segment = Segment(path)
+    assert list(segment) == records
+    for record in records[4:]:
+        assert segment.get(record["id"]) == record
+    assert segment.get(records[3]["id"])["content"] == "later"
+    assert segment.get(str(uuid.uuid4())) is None and segment.get("legacy-2") is None
+
+    # a replaced file: the open segment keeps reading the one it mapped
+    write_segment(path, records[:1], generation=8)
+    assert segment.get(records[10]["id"]) == records[10]
+    segment.close()
+    assert len(Segment(path)) == 1
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 1)
+    with pytest.raises(ValueError):
+        Segment(path)
+    assert read_header(str(tmp_path / "missing.seg")) is None
+
+
+def test_active_users_follow_local_and_outside_writes(tmp_path):
+    from storage.jsonfile import JsonBackend
+    from storage.repository import ActiveUserSet
+
+    backend, elsewhere = JsonBackend(str(tmp_path)), JsonBackend(str(tmp_path))
+    users = backend.collection("users", ("email",))
+    first, second = {"id": str(uuid.uuid4()), "deleted_at": None}, {"id": str(uuid.uuid4()), "deleted_at": None}
+    users.insert(first)
+    active = ActiveUserSet(users, recheck_ms=0)
+    scans = []
+    scan = users.scan
+    users.scan = lambda: scans.append(1) or scan()
+    assert first["id"] in active and second["id"] not in active
+    assert len(scans) == 1
+
+    # a write of this process: applied, no new scan
+    before = users.version()[0]
+    users.insert(second)
+    active.apply(second["id"], True, before)
+    assert second["id"] in active and len(scans) == 1
+
+    # a write of another process: noticed through the version
+    elsewhere.collection("users", ("email",)).update(first["id"], {"deleted_at": "2021-01-02 00:00:00"})
+    assert first["id"] not in active and second["id"] in active
+    assert len(scans) == 2
+
+    # checked only every recheck_ms
+    active.recheck = 3600
+    elsewhere.collection("users", ("email",)).update(second["id"], {"deleted_at": "2021-01-02 00:00:00"})
+    assert second["id"] in active
+    backend.close()
+    elsewhere.close()
+
+
+@pytest.mark.parametrize("store", ["records", "columnar"])
+def test_warm_start_loads_the_checkpoint_and_replays_the_log_past_it(store, tmp_path, caplog):
+    from storage.columnar import ColumnarTweetIndex
+    from storage.index import RecordIndex
+    from storage.memory import MemoryCollection
+    from storage.writer import GroupCommitWriter
+
+    store = ColumnarTweetIndex if store == "columnar" else RecordIndex
+    path = str(tmp_path / "tweets.json")
+
+    def open_tweets(indexes=("created_by",)):
+        writer = GroupCommitWriter()
+        return MemoryCollection(path, "tweets", indexes, writer, store=store, warm_start=True), writer
+
+    author = str(uuid.uuid4())
+    tweets, writer = open_tweets()
+    records = [tweet("tweet {}".format(n), author) for n in range(3)]
+    tweets.insert_many(records)
+    tweets.checkpoint()
+    # past the checkpoint: in the log only, then a crash (no checkpoint)
+    records.append(tweets.insert(tweet("after", author)))
+    records[0] = tweets.update(records[0]["id"], {"content": "changed"})
+    writer.close()
+
+    caplog.set_level("INFO", logger="uvicorn.error")
+    tweets, writer = open_tweets()
+    assert "warm start" in caplog.text and "4 records and 2 log entries" in caplog.text
+    assert list(tweets.scan()) == records
+    assert tweets.page(2, field="created_by", value=author, reverse=True) == records[:1:-1]
+    writer.close()
+
+    # a checkpoint made with other settings is ignored
+    caplog.clear()
+    tweets, writer = open_tweets(indexes=())
+    assert "cold start" in caplog.text and list(tweets.scan()) == records
+    writer.close()
+
+
+@pytest.mark.parametrize("name", ["json", "memory", "sqlite"])
+def test_rebalance_keeps_every_record(name, tmp_path):
+    from conftest import open_backend
+    from storage.partitioned import Layout, PartitionedCollection, manifest_path, read_manifest, rebalance
+
+    backend = open_backend(name, str(tmp_path))
+    authors = [str(uuid.uuid4()) for _ in range(5)]
+    records = []
+    for n in range(30):
+        record = tweet("tweet {}".format(n), authors[n % 5])
+        record["created_at"] = "2021-0{}-1{} 00:00:00".format(1 + n % 3, n % 10)
+        records.append(record)
+    records[7]["deleted_at"] = "2021-04-01 00:00:00"
+    backend.collection("tweets", ("created_by",)).insert_many(records)
+    path = manifest_path(str(tmp_path), "tweets")
+
+    def stored(layout):
+        if not layout.scheme:
+            collection = backend.collection("tweets", ("created_by",))
+        else:
+            collection = PartitionedCollection(backend, path, "tweets", ("created_by",), layout)
+        return sorted(collection.scan(), key=lambda r: r["id"])
+
+    expected = sorted(records, key=lambda r: r["id"])
+    for layout in (Layout(("author",), 4), Layout(("month", "author"), 2), Layout(())):
+        counts = rebalance(backend, str(tmp_path), "tweets", ("created_by",), layout, batch=7)
+        assert sum(counts.values()) == len(records)
+        assert stored(layout) == expected
+        if layout.scheme:
+            partitions = read_manifest(path)["partitions"]
+            assert len(partitions) == len(counts) > 1
+            for key, collection in partitions.items():
+                assert all(layout.key(r) == key for r in backend.collection(collection, ("created_by",)).scan())
+    assert rebalance(backend, str(tmp_path), "tweets", ("created_by",), Layout(())) == {}
+    assert read_manifest(path) is None
+    for key in partitions.values():   # emptied
+        assert list(backend.collection(key, ("created_by",)).scan()) == []
+    backend.close()
@@ -0,0 +1,30 @@
+import uuid
+
+from conftest import open_backend
+
+
+def test_big_account_tweets_written_while_small_are_read(tmp_path):
+    from storage.repository import FollowRepository, TweetRepository
+    from timelines import Timelines
+
+    backend = open_backend("memory", str(tmp_path))
+    tweets = TweetRepository(backend.collection("tweets", ("created_by",)))
+    follows = FollowRepository(backend.collection("follows", ("follower_id", "followed_id")))
+    timelines = Timelines(tweets, follows, fanout_max_followers=1)
+
+    def post(content, at):
+        return tweets.create({"id": str(uuid.uuid4()), "content": content, "created_by": "star",
+                              "created_at": at, "updated_at": None, "deleted_at": None})
+
+    def home(user_id):
+        return [t["content"] for t in timelines.page(user_id, 10)[0]]
+
+    follows.follow("fan", "star", "2021-03-01 10:00:00")
+    follows.follow("other", "star", "2021-03-01 10:00:00")  # over the fan-out limit
+    post("first", "2021-03-01 10:01:00")
+    assert home("fan") == ["first"]
+    follows.unfollow("other", "star", "2021-03-01 10:02:00")  # back under it
+    post("second", "2021-03-01 10:03:00")
+    follows.follow("other", "star", "2021-03-01 10:04:00")  # over it again
+    assert home("fan") == ["second", "first"]
+    backend.close()
@@ -0,0 +1,34 @@
+from trends import HeavyHitters, Trends, extract
+
+START = 1000 * 3600  # on the boundary of every bucket
+
+
+def test_extract_hashtags_and_mentions():
+    hashtags, mentions = extract("#Python and #python, @Ana: mail a@b.com, a#b ##no #ok!")
+    assert hashtags == {"python", "ok"}
+    assert mentions == {"ana"}
+    assert extract("nothing here") == (set(), set())
+
+
+def test_heavy_hitters_expire_with_their_window():
+    hitters = HeavyHitters()
+    for key in ["a", "a", "a", "b"]:
+        hitters.add(key, START)
+    hitters.add("c", START + 4 * 60)
+    assert hitters.top("5m", 2, START + 4 * 60) == [("a", 3), ("b", 1)]
+    # the first minute left the 5 minutes window, not the others
+    assert hitters.top("5m", 10, START + 5 * 60) == [("c", 1)]
+    assert hitters.top("15m", 10, START + 5 * 60) == [("a", 3), ("b", 1), ("c", 1)]
+    assert hitters.top("24h", 1, START + 23 * 3600) == [("a", 3)]
+    # idle for longer than every window
+    assert hitters.top("24h", 10, START + 48 * 3600) == []
+
+
+def test_updated_tweets_count_their_new_tags_only():
+    trends = Trends()
+    trends.record("#one @ana")
+    trends.record("#one #two @ana", previous="#one @ana")
+    trends.record("no tags", previous="#three")
+    top = trends.top("1h", 10)
+    assert top["hashtags"] == [("one", 1), ("two", 1)]
+    assert top["mentions"] == [("ana", 1)]